@@ -0,0 +1,169 @@
+import os, threading, time
+from collections import OrderedDict
+from nas.metrics import Collected
+
+ACL_CACHE_SIZE = int(os.getenv("ACL_CACHE_SIZE", "10000"))
+# Invalidation only reaches the worker process that made the change; other
+# workers keep serving a revoked share until their entry expires, so this is
+# also how long a revocation can take to apply everywhere
+ACL_CACHE_TTL = float(os.getenv("ACL_CACHE_TTL", "5"))
+
+MISS = object()
+
+class LRUCache:
+    """Thread-safe LRU mapping whose entries expire after a TTL"""
+
+    def __init__(self, maxsize=ACL_CACHE_SIZE, ttl=ACL_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return the cached value or MISS"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return MISS
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def update(self, key, fn):
+        """Apply fn to a live value in place, keeping its original expiry"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                fn(entry[1])
+                return True
+            return False
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def pop_tree(self, path):
+        """Drop the entry for a path and every entry below it (path keys only)"""
+        prefix = path + "/"
+        with self._lock:
+            for key in [k for k in self._data if k == path or k.startswith(prefix)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+class ACLCache:
+    """Caches file metadata by path and resolved permissions by (user, path).
+
+    Permissions are grouped per path so a rename or delete drops every user's
+    entry for that path in one step. Writers that race with an invalidation
+    are ignored via a generation counter, so a lookup that started before a
+    share/revoke can never re-insert the old answer.
+    """
+
+    def __init__(self, maxsize=ACL_CACHE_SIZE, ttl=ACL_CACHE_TTL):
+        self.metadata = LRUCache(maxsize, ttl)
+        self.perms = LRUCache(maxsize, ttl)
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.perms_hits = 0
+        self.perms_misses = 0
+
+    def generation(self):
+        """Token to pass to set_* so stale lookups are discarded"""
+        return self._generation
+
+    def get_metadata(self, path):
+        return self.metadata.get(path)
+
+    def set_metadata(self, path, metadata, generation):
+        with self._lock:
+            if generation == self._generation:
+                self.metadata.set(path, metadata)
+
+    def get_perms(self, user_id, path):
+        group = self.perms.get(path)
+        perms = MISS if group is MISS else group.get(user_id, MISS)
+        if perms is MISS:
+            self.perms_misses += 1
+        else:
+            self.perms_hits += 1
+        return perms
+
+    def set_perms(self, user_id, path, perms, generation):
+        with self._lock:
+            if generation != self._generation:
+                return
+            if not self.perms.update(path, lambda group: group.__setitem__(user_id, perms)):
+                self.perms.set(path, {user_id: perms})
+
+    def invalidate_path(self, path):
+        """Forget metadata and every user's permissions for a path"""
+        with self._lock:
+            self._generation += 1
+            self.metadata.pop(path)
+            self.perms.pop(path)
+
+    def invalidate_tree(self, path):
+        """Forget metadata and permissions for a directory and everything under it"""
+        with self._lock:
+            self._generation += 1
+            self.metadata.pop_tree(path)
+            self.perms.pop_tree(path)
+
+    def invalidate_user(self, path, user_id):
+        """Forget one user's permissions for a path"""
+        with self._lock:
+            self._generation += 1
+            self.perms.update(path, lambda group: group.pop(user_id, None))
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self.metadata.clear()
+            self.perms.clear()
+
+    def stats(self):
+        return {
+            'metadata_hits': self.metadata.hits,
+            'metadata_misses': self.metadata.misses,
+            'metadata_evictions': self.metadata.evictions,
+            'metadata_entries': len(self.metadata),
+            'perms_hits': self.perms_hits,
+            'perms_misses': self.perms_misses,
+            'perms_evictions': self.perms.evictions,
+            'perms_entries': len(self.perms),
+        }
+
+acl_cache = ACLCache()
+
+def _cache_metric(name, help, kind, key):
+    def read():
+        stats = acl_cache.stats()
+        return {("metadata",): stats[f"metadata_{key}"], ("permissions",): stats[f"perms_{key}"]}
+    Collected(name, help, kind, read, ("cache",))
+
+_cache_metric("nas_acl_cache_hits_total", "Lookups answered from the ACL cache", "counter", "hits")
+_cache_metric("nas_acl_cache_misses_total", "Lookups that went to the database", "counter", "misses")
+_cache_metric("nas_acl_cache_evictions_total", "Entries dropped to stay within ACL_CACHE_SIZE", "counter",
+              "evictions")
+_cache_metric("nas_acl_cache_entries", "Paths currently cached", "gauge", "entries")
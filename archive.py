@@ -0,0 +1,417 @@
+import os, gzip, time, zlib, bisect, struct, hashlib, tarfile, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BACKUP_COMPRESSION = os.getenv("BACKUP_COMPRESSION", "gzip")  # gzip | zstd
+BACKUP_COMPRESS_WORKERS = int(os.getenv("BACKUP_COMPRESS_WORKERS", str(os.cpu_count() or 1)))
+BACKUP_COMPRESS_LEVEL = os.getenv("BACKUP_COMPRESS_LEVEL", "")
+BACKUP_BLOCK_SIZE = int(os.getenv("BACKUP_BLOCK_SIZE", str(4 * 1024 * 1024)))
+ZIP_COMPRESSION = os.getenv("ZIP_COMPRESSION", "deflate")  # deflate | stored
+ZIP_COMPRESS_LEVEL = int(os.getenv("ZIP_COMPRESS_LEVEL", "6"))
+ZIP_WORKERS = int(os.getenv("ZIP_WORKERS", "1"))
+ZIP_PARALLEL_MAX = int(os.getenv("ZIP_PARALLEL_MAX", str(8 * 1024 * 1024)))
+
+SUFFIXES = {"gzip": ".tar.gz", "zstd": ".tar.zst"}
+DEFAULT_LEVELS = {"gzip": 6, "zstd": 3}
+
+def archive_suffix(codec=BACKUP_COMPRESSION):
+    """File extension for archives written with a codec"""
+    return SUFFIXES[codec]
+
+def archive_codec(path):
+    """Codec of an existing archive, from its extension"""
+    return "zstd" if str(path).endswith(".tar.zst") else "gzip"
+
+_zstd_local = threading.local()
+
+def _compress_block(codec, level, data):
+    """Compress one block into a self-contained gzip member or zstd frame"""
+    if codec == "zstd":
+        cctx = getattr(_zstd_local, "cctx", None)
+        if cctx is None or _zstd_local.level != level:
+            cctx = _zstd_local.cctx = zstandard.ZstdCompressor(level=level)
+            _zstd_local.level = level
+        return cctx.compress(data)
+    # wbits=31 writes a complete gzip member (header, deflate data, CRC32, size)
+    c = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return c.compress(data) + c.flush()
+
+class ParallelCompressWriter:
+    """Write-only file object that compresses fixed-size blocks on a thread pool.
+
+    Every block becomes an independent gzip member (or zstd frame) and blocks
+    are written in order, so the output is a normal .gz/.zst stream that
+    gunzip/zstd and tarfile read unchanged. zlib and zstd release the GIL, so
+    throughput scales with the worker count.
+    """
+
+    def __init__(self, fileobj, codec=BACKUP_COMPRESSION, level=None,
+                 workers=BACKUP_COMPRESS_WORKERS, block_size=BACKUP_BLOCK_SIZE):
+        if codec not in SUFFIXES:
+            raise ValueError(f"Unknown compression codec '{codec}'")
+        if codec == "zstd" and zstandard is None:
+            raise RuntimeError("BACKUP_COMPRESSION=zstd requires the 'zstandard' package")
+        self._fileobj = fileobj
+        self.codec = codec
+        self.level = level if level is not None else int(BACKUP_COMPRESS_LEVEL or DEFAULT_LEVELS[codec])
+        self.block_size = block_size
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        self._max_pending = max(1, workers) * 2
+        self._pending = deque()
+        self._buffer = bytearray()
+        self.uncompressed_size = 0
+        self.compressed_size = 0
+        self.sha256 = hashlib.sha256()  # of the compressed output, i.e. the archive file
+        # (uncompressed offset, compressed offset) of every block, for seeking
+        self.blocks = []
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[:self.block_size]))
+            del self._buffer[:self.block_size]
+        return len(data)
+
+    def _submit(self, block):
+        self._pending.append((len(block), self._executor.submit(
+            _compress_block, self.codec, self.level, block)))
+        while len(self._pending) > self._max_pending:
+            self._drain_one()
+
+    def _drain_one(self):
+        raw_len, future = self._pending.popleft()
+        compressed = future.result()
+        self.blocks.append((self.uncompressed_size, self.compressed_size))
+        self._fileobj.write(compressed)
+        self.sha256.update(compressed)
+        self.uncompressed_size += raw_len
+        self.compressed_size += len(compressed)
+
+    def close(self):
+        """Flush remaining data; the underlying file is left open"""
+        try:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer.clear()
+            while self._pending:
+                self._drain_one()
+            self._fileobj.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def abort(self):
+        for _, future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._executor.shutdown(wait=True)
+
+@contextmanager
+def create_archive(path, codec=BACKUP_COMPRESSION, level=None, workers=BACKUP_COMPRESS_WORKERS):
+    """Open a new tar archive written through ParallelCompressWriter.
+
+    Yields (tar, writer); the writer exposes sizes and block offsets.
+    """
+    with open(path, "wb") as raw:
+        writer = ParallelCompressWriter(raw, codec, level, workers)
+        try:
+            tar = tarfile.open(fileobj=writer, mode="w|", format=tarfile.PAX_FORMAT)
+            with tar:
+                yield tar, writer
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
+
+@contextmanager
+def open_archive(path):
+    """Open an archive for sequential reading, whatever its codec"""
+    if archive_codec(path) == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Reading .tar.zst archives requires the 'zstandard' package")
+        with open(path, "rb") as raw:
+            reader = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True)
+            with tarfile.open(fileobj=reader, mode="r|") as tar:
+                yield tar
+    else:
+        # GzipFile reads across the concatenated per-block gzip members;
+        # tarfile's own "r|gz" stream stops after the first one
+        with gzip.open(path, "rb") as reader:
+            with tarfile.open(fileobj=reader, mode="r|") as tar:
+                yield tar
+
+@contextmanager
+def open_at(path, blocks, offset):
+    """Open a decompressing reader positioned at an uncompressed offset.
+
+    blocks is the (uncompressed offset, compressed offset) list recorded by
+    ParallelCompressWriter. The reader starts at the block holding offset,
+    so at most one block is decompressed and thrown away.
+    """
+    i = bisect.bisect_right([b[0] for b in blocks], offset) - 1
+    raw_offset, compressed_offset = blocks[max(i, 0)]
+    with open(path, "rb") as raw:
+        raw.seek(compressed_offset)
+        if archive_codec(path) == "zstd":
+            if zstandard is None:
+                raise RuntimeError("Reading .tar.zst archives requires the 'zstandard' package")
+            reader = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=False)
+        else:
+            reader = gzip.GzipFile(fileobj=raw, mode="rb")
+        with reader:
+            _skip(reader, offset - raw_offset)
+            yield reader
+
+def _skip(reader, n):
+    while n > 0:
+        data = reader.read(min(n, 1024 * 1024))
+        if not data:
+            raise EOFError("Archive ended before the indexed offset")
+        n -= len(data)
+
+def iter_spans(path, blocks, spans):
+    """Yield (key, data chunks) for sorted (offset, size, key) spans of one archive.
+
+    Spans close to the previous one are reached by reading forward on the
+    same reader; anything further away seeks straight to its block.
+    """
+    with ExitStack() as stack:
+        reader, position = None, 0
+        for offset, size, key in spans:
+            if reader is None or offset < position or offset - position > BACKUP_BLOCK_SIZE:
+                stack.close()
+                reader = stack.enter_context(open_at(path, blocks, offset))
+            else:
+                _skip(reader, offset - position)
+            chunks = _read_exact(reader, size)
+            yield key, chunks
+            for _ in chunks:
+                pass  # drain whatever the caller left unread
+            position = offset + size
+
+def _read_exact(reader, size):
+    while size > 0:
+        data = reader.read(min(size, 1024 * 1024))
+        if not data:
+            raise EOFError("Archive member is truncated")
+        size -= len(data)
+        yield data
+
+class IterReader:
+    """Readable file object over an iterator of byte strings"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = b""
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buf) < size:
+            data = next(self._chunks, None)
+            if data is None:
+                break
+            self._buf += data
+        if size < 0:
+            data, self._buf = self._buf, b""
+        else:
+            data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+def stream_tar(members):
+    """Generate an uncompressed tar from (TarInfo, file object or None) pairs, with no temp file.
+    
+    Headers are built with TarInfo.tobuf() and file data is copied through in
+    STREAM_CHUNK_SIZE pieces, so memory stays flat however large a member is.
+    Small members are batched into chunks of about that size.
+    """
+    buf = bytearray()
+    total = 0
+    for info, fileobj in members:
+        buf += info.tobuf(tarfile.PAX_FORMAT, tarfile.ENCODING, "surrogateescape")
+        if fileobj is None:
+            continue
+        remaining = info.size
+        while remaining > 0:
+            data = fileobj.read(min(remaining, STREAM_CHUNK_SIZE))
+            if not data:
+                raise OSError(f"{info.name}: unexpected end of data")
+            remaining -= len(data)
+            buf += data
+            if len(buf) >= STREAM_CHUNK_SIZE:
+                total += len(buf)
+                yield bytes(buf)
+                buf.clear()
+        buf += tarfile.NUL * (-info.size % tarfile.BLOCKSIZE)
+    # End-of-archive marker, padded to a whole record as tarfile writes it
+    buf += tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+    buf += tarfile.NUL * (-(total + len(buf)) % tarfile.RECORDSIZE)
+    yield bytes(buf)
+
+# ---------------------------------------------------------------------------
+# Streaming ZIP
+#
+# Written front to back with no seeking: each entry is a local header, its
+# data and (when sizes are only known afterwards) a data descriptor, followed
+# by the central directory. ZIP64 records are used per entry and for the end
+# of the archive only where a size, offset or count needs them.
+# ---------------------------------------------------------------------------
+
+ZIP_STORED, ZIP_DEFLATED = 0, 8
+_ZIP32_MAX = 0xFFFFFFFF
+_ZIP_UTF8 = 0x0800        # general purpose flag: names are UTF-8
+_ZIP_DESCRIPTOR = 0x0008  # general purpose flag: CRC and sizes follow the data
+_ZIP_MADE_BY = (3 << 8) | 45  # Unix, spec 4.5
+
+def _dos_datetime(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+def _deflater(level):
+    return zlib.compressobj(level, zlib.DEFLATED, -15)  # raw deflate, as ZIP stores it
+
+def _compress_whole(path, method, level):
+    """Read and compress one small file: (crc, size, data)"""
+    with open(path, "rb") as f:
+        data = f.read()
+    crc = zlib.crc32(data)
+    if method == ZIP_DEFLATED:
+        c = _deflater(level)
+        return crc, len(data), c.compress(data) + c.flush()
+    return crc, len(data), data
+
+class _ZipEntry:
+    __slots__ = ("name", "flags", "method", "dostime", "dosdate", "crc", "csize", "usize",
+                 "offset", "mode", "zip64")
+
+def _local_header(e):
+    extra = b""
+    csize, usize = e.csize, e.usize
+    if e.zip64:
+        extra = struct.pack("<HHQQ", 0x0001, 16, usize, csize)
+        csize = usize = _ZIP32_MAX
+    return struct.pack("<IHHHHHIIIHH", 0x04034b50, 45 if e.zip64 else 20, e.flags, e.method,
+                       e.dostime, e.dosdate, e.crc, csize, usize, len(e.name), len(extra)) + e.name + extra
+
+def _central_header(e):
+    fields = [v for v in (e.usize, e.csize, e.offset) if v >= _ZIP32_MAX]
+    extra = struct.pack("<HH" + "Q" * len(fields), 0x0001, 8 * len(fields), *fields) if fields else b""
+    needed = 45 if fields or e.zip64 else 20
+    return struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50, _ZIP_MADE_BY, needed, e.flags, e.method,
+                       e.dostime, e.dosdate, e.crc, min(e.csize, _ZIP32_MAX), min(e.usize, _ZIP32_MAX),
+                       len(e.name), len(extra), 0, 0, 0, (e.mode & 0xFFFF) << 16,
+                       min(e.offset, _ZIP32_MAX)) + e.name + extra
+
+def _end_records(count, cd_offset, cd_size):
+    out = b""
+    if count >= 0xFFFF or cd_offset >= _ZIP32_MAX or cd_size >= _ZIP32_MAX:
+        zip64_offset = cd_offset + cd_size
+        out += struct.pack("<IQHHIIQQQQ", 0x06064b50, 44, _ZIP_MADE_BY, 45, 0, 0,
+                           count, count, cd_size, cd_offset)
+        out += struct.pack("<IIQI", 0x07064b50, 0, zip64_offset, 1)
+    return out + struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                             min(cd_size, _ZIP32_MAX), min(cd_offset, _ZIP32_MAX), 0)
+
+def stream_zip(files, compression=ZIP_COMPRESSION, level=ZIP_COMPRESS_LEVEL, workers=ZIP_WORKERS,
+               chunk_size=1024 * 1024):
+    """Generate a ZIP of (archive name, file path) pairs, with no temp file.
+
+    Memory stays flat apart from the central directory (one small record per
+    file). With workers > 1, files up to ZIP_PARALLEL_MAX are read and
+    deflated ahead of time on a thread pool; larger ones are streamed in
+    chunks. Files that vanish before they are read are left out.
+    """
+    method = ZIP_DEFLATED if compression == "deflate" else ZIP_STORED
+    parallel = method == ZIP_DEFLATED and workers > 1
+    pool = ThreadPoolExecutor(max_workers=workers) if parallel else None
+    entries, offset = [], 0
+
+    def prepared():
+        """(name, path, stat, future or None), with up to 2 * workers small files compressing ahead"""
+        ahead = deque()
+        for name, path in files:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            future = None
+            if parallel and st.st_size <= ZIP_PARALLEL_MAX:
+                future = pool.submit(_compress_whole, path, method, level)
+            ahead.append((name, path, st, future))
+            if len(ahead) > workers * 2:
+                yield ahead.popleft()
+        while ahead:
+            yield ahead.popleft()
+
+    try:
+        for name, path, st, future in prepared():
+            e = _ZipEntry()
+            e.name = name.encode("utf-8")
+            e.method = method
+            e.dostime, e.dosdate = _dos_datetime(st.st_mtime)
+            e.mode = st.st_mode
+            e.offset = offset
+            if future is not None:
+                try:
+                    e.crc, e.usize, data = future.result()
+                except OSError:
+                    continue
+                e.flags, e.csize = _ZIP_UTF8, len(data)
+                e.zip64 = e.usize >= _ZIP32_MAX
+                header = _local_header(e)
+                yield header
+                yield data
+                offset += len(header) + len(data)
+            else:
+                try:
+                    f = open(path, "rb")
+                except OSError:
+                    continue
+                with f:
+                    # Sizes are only final once read; leave room in case deflate grows the data
+                    e.flags, e.crc, e.csize, e.usize = _ZIP_UTF8 | _ZIP_DESCRIPTOR, 0, 0, 0
+                    e.zip64 = st.st_size >= _ZIP32_MAX - (1 << 20)
+                    header = _local_header(e)
+                    yield header
+                    offset += len(header)
+                    c = _deflater(level) if method == ZIP_DEFLATED else None
+                    crc = usize = csize = 0
+                    for block in iter(lambda: f.read(chunk_size), b""):
+                        crc = zlib.crc32(block, crc)
+                        usize += len(block)
+                        out = c.compress(block) if c else block
+                        if out:
+                            csize += len(out)
+                            yield out
+                    if c:
+                        out = c.flush()
+                        csize += len(out)
+                        yield out
+                if not e.zip64 and max(usize, csize) >= _ZIP32_MAX:
+                    raise ValueError(f"{path} grew past 4 GiB while it was being zipped")
+                e.crc, e.usize, e.csize = crc, usize, csize
+                descriptor = struct.pack("<IIQQ" if e.zip64 else "<IIII", 0x08074b50, crc, csize, usize)
+                yield descriptor
+                offset += csize + len(descriptor)
+            entries.append(e)
+
+        cd_offset, buf = offset, []
+        for e in entries:
+            record = _central_header(e)
+            buf.append(record)
+            offset += len(record)
+            if len(buf) >= 1024:
+                yield b"".join(buf)
+                buf = []
+        yield b"".join(buf) + _end_records(len(entries), cd_offset, offset - cd_offset)
+    finally:
+        if pool:
+            pool.shutdown(wait=False, cancel_futures=True)
@@ -1,25 +1,45 @@
-import os, tarfile, time, shutil
+import os, stat, time, shutil, gzip, json, hashlib, tarfile, threading, uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime, timedelta
-from flask import render_template, request, redirect, url_for, flash, send_file
-from flask_login import login_required
+from flask import render_template, request, redirect, url_for, flash, jsonify
+from flask_login import login_required, current_user
 from nas.__init__ import backup_bp
 from nas.roles import role_required
-from app import get_db
+from nas.db_pool import get_db
+from nas.transfer import send_file_ranged, send_stream
+from nas.archive import create_archive, open_archive, archive_suffix, SUFFIXES, iter_spans, IterReader, stream_tar
+from nas import chunkstore, jobs, snapshot
 
 DATA_ROOT = Path(os.getenv("DATA_ROOT","/srv/nas_data"))
 BACKUP_ROOT = Path(os.getenv("BACKUP_ROOT","/srv/nas_backups"))
 
-def create_backup_entry(archive_name):
-    """Record backup in database"""
+ARCHIVE_ROOT = "nas_data"
+# Upload staging, pending deletes, restore snapshots and shared upload contents, never backed up;
+# every file in .blobs is also linked from a user's path, which is what gets archived
+STAGING_DIRS = (".uploads", ".trash", ".snapshots", ".blobs")
+BACKUP_HASH_FILES = os.getenv("BACKUP_HASH_FILES", "0") == "1"
+BACKUP_FULL_EVERY = int(os.getenv("BACKUP_FULL_EVERY", "7"))
+BACKUPS_PER_PAGE = int(os.getenv("BACKUPS_PER_PAGE", "50"))
+BACKUP_RECONCILE_INTERVAL = float(os.getenv("BACKUP_RECONCILE_INTERVAL", "600"))
+RESTORE_WORKERS = int(os.getenv("RESTORE_WORKERS", str(min(8, os.cpu_count() or 1))))
+RESTORE_INLINE_MAX = int(os.getenv("RESTORE_INLINE_MAX", str(8 * 1024 * 1024)))
+SNAPSHOT_PROMOTE = os.getenv("SNAPSHOT_PROMOTE", "0") == "1"
+
+def create_backup_entry(archive_name, kind="full", parent_id=None, size_bytes=None,
+                        logical_bytes=None, file_count=None, duration_ms=None, checksum=None):
+    """Record backup in database, with its catalog details; returns its id"""
     try:
         conn = get_db()
         cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO backups (archive_path) VALUES (%s)",
-            (archive_name,)
-        )
+        cur.execute("""
+            INSERT INTO backups (archive_path, kind, parent_id, size_bytes, logical_bytes,
+                                 file_count, duration_ms, checksum)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """, (archive_name, kind, parent_id, size_bytes, logical_bytes,
+              file_count, duration_ms, checksum))
         conn.commit()
+        return cur.lastrowid
     except Exception as e:
         print(f"Error recording backup: {e}")
     finally:
@@ -29,16 +49,20 @@ def create_backup_entry(archive_name):
         except:
             pass
 
-def get_backups_from_db():
-    """Get all backups from database"""
+def get_backup_page(page=1, per_page=None):
+    """One page of the backup catalog, newest first"""
+    per_page = per_page or BACKUPS_PER_PAGE
     try:
         conn = get_db()
         cur = conn.cursor()
         cur.execute("""
-            SELECT id, archive_path, created_at 
-            FROM backups 
-            ORDER BY created_at DESC
-        """)
+            SELECT id, archive_path, created_at, kind, parent_id, size_bytes,
+                   logical_bytes, file_count, state
+            FROM backups
+            WHERE state <> 'missing'
+            ORDER BY created_at DESC, id DESC
+            LIMIT %s OFFSET %s
+        """, (per_page, (page - 1) * per_page))
         return cur.fetchall()
     except Exception as e:
         print(f"Error getting backups: {e}")
@@ -50,6 +74,69 @@ def get_backups_from_db():
         except:
             pass
 
+def get_backup_summary():
+    """(count, total bytes, latest created_at) over the whole catalog"""
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT COUNT(*), COALESCE(SUM(size_bytes), 0), MAX(created_at)
+            FROM backups
+            WHERE state <> 'missing'
+        """)
+        return cur.fetchone()
+    except Exception as e:
+        print(f"Error getting backup summary: {e}")
+        return (0, 0, None)
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+
+def daily_backup_exists(day):
+    """True if a scheduled backup was created on or after the start of `day`"""
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        # Range on created_at uses idx_backups_created
+        cur.execute("""
+            SELECT id FROM backups
+            WHERE created_at >= %s AND archive_path LIKE %s
+            LIMIT 1
+        """, (datetime.combine(day, datetime.min.time()), "nas_backup_%"))
+        return cur.fetchone() is not None
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+
+def get_latest_backup(kinds=("full", "incremental")):
+    """Get (id, archive_path) of the newest backup of the given kinds"""
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT id, archive_path
+            FROM backups
+            WHERE kind IN (%s)
+            ORDER BY created_at DESC, id DESC
+            LIMIT 1
+        """ % ", ".join(["%s"] * len(kinds)), tuple(kinds))
+        return cur.fetchone()
+    except Exception as e:
+        print(f"Error getting latest backup: {e}")
+        return None
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+
 def delete_backup_from_db(backup_id):
     """Delete backup record from database"""
     try:
@@ -66,74 +153,748 @@ def delete_backup_from_db(backup_id):
         except:
             pass
 
-def perform_backup():
-    """Create a backup archive"""
+def sidecar_path(archive_name, suffix):
+    """Path of a file kept next to an archive, e.g. its manifest"""
+    return BACKUP_ROOT / (archive_name.split(".tar")[0] + suffix)
+
+def load_manifest(archive_name):
+    """Load an archive's manifest, or None for archives made before manifests"""
+    p = sidecar_path(archive_name, ".manifest.json.gz")
+    if not p.is_file():
+        return None
+    with gzip.open(p, "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_manifest(archive_name, manifest):
+    p = sidecar_path(archive_name, ".manifest.json.gz")
+    tmp = p.with_name(p.name + ".tmp")
+    with gzip.open(tmp, "wt", encoding="utf-8") as f:
+        json.dump(manifest, f, separators=(",", ":"))
+    os.replace(tmp, p)
+
+def scan_data_root(data_root=None):
+    """Walk DATA_ROOT (or a snapshot of it) and return ({rel_path: stat entry}, [rel_dirs])"""
+    data_root = data_root or DATA_ROOT
+    files, dirs = {}, []
+    for root, dirnames, filenames in os.walk(data_root):
+        rel_root = os.path.relpath(root, data_root)
+        rel_root = "" if rel_root == "." else rel_root
+        if not rel_root:
+            dirnames[:] = [d for d in dirnames if d not in STAGING_DIRS]
+        dirnames.sort()
+        for d in dirnames:
+            dirs.append(os.path.join(rel_root, d))
+        for name in sorted(filenames):
+            rel = os.path.join(rel_root, name)
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                files[rel] = {'size': st.st_size, 'mtime': st.st_mtime_ns, 'inode': st.st_ino}
+    return files, dirs
+
+class _HashingReader:
+    """File wrapper that hashes everything read through it"""
+
+    def __init__(self, f):
+        self._f = f
+        self.hasher = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self.hasher.update(data)
+        return data
+
+def _add_file(tar, rel, entry, data_root, files):
+    """Append one regular file to the archive, hashing it if configured.
+    
+    A file sharing its inode with one already in this archive (a deduplicated
+    upload) is stored as a hard link member; its entry points at the first
+    copy's data and names it under 'link'.
+    """
+    full = data_root / rel
+    tarinfo = tar.gettarinfo(full, arcname=f"{ARCHIVE_ROOT}/{rel}")
+    if tarinfo.islnk():
+        target = tarinfo.linkname[len(ARCHIVE_ROOT) + 1:]
+        if 'offset' in files.get(target, {}):
+            tar.addfile(tarinfo)
+            for key in ('offset', 'size', 'mode', 'sha256'):
+                if key in files[target]:
+                    entry[key] = files[target][key]
+            entry['link'] = target
+            return
+        # The first copy vanished mid-backup; store this one in full
+        tarinfo.type, tarinfo.linkname = tarfile.REGTYPE, ""
+        tarinfo.size = full.stat().st_size
+    with open(full, "rb") as f:
+        reader = _HashingReader(f) if BACKUP_HASH_FILES else f
+        tar.addfile(tarinfo, reader)
+    # Data ends at tar.offset, padded to whole 512-byte records
+    padded = -(-tarinfo.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+    entry['offset'] = tar.offset - padded
+    entry['size'] = tarinfo.size
+    entry['mode'] = tarinfo.mode
+    if BACKUP_HASH_FILES:
+        entry['sha256'] = reader.hasher.hexdigest()
+
+def _unchanged(old, new):
+    return (old['size'], old['mtime'], old['inode']) == (new['size'], new['mtime'], new['inode'])
+
+def perform_backup(kind="full", prefix="nas_backup", progress=None, data_root=None):
+    """Create a backup archive.
+    
+    An incremental backup archives only files added or changed since the latest
+    backup; its manifest still lists every file along with the archive that
+    holds its content, plus the paths deleted since the parent. Each file's
+    data offset and the archive's block offsets are recorded as well, so
+    single files can be extracted by seeking. `progress` (a jobs.Job) is told
+    about every file archived and can cancel the backup between files.
+    `data_root` archives a snapshot tree instead of DATA_ROOT.
+    """
     BACKUP_ROOT.mkdir(parents=True, exist_ok=True)
+    data_root = Path(data_root or DATA_ROOT)
+    
+    parent_id, parent = None, None
+    if kind == "incremental":
+        latest = get_latest_backup()
+        parent = load_manifest(latest[1]) if latest else None
+        if parent is None:
+            kind = "full"  # nothing to be incremental against
+        else:
+            parent_id = latest[0]
+    
+    started = time.monotonic()
     ts = time.strftime("%Y%m%d_%H%M%S")
-    archive_name = f"nas_backup_{ts}.tar.gz"
+    suffix = archive_suffix()
+    archive_name = f"{prefix}_{ts}_incr{suffix}" if kind == "incremental" else f"{prefix}_{ts}{suffix}"
     out = BACKUP_ROOT / archive_name
     
+    files, dirs = scan_data_root(data_root)
+    parent_files = parent['files'] if parent else {}
+    changed = []
+    for rel, entry in files.items():
+        old = parent_files.get(rel)
+        if old and _unchanged(old, entry):
+            for key in ('archive', 'offset', 'mode', 'sha256', 'link'):
+                if key in old:
+                    entry[key] = old[key]
+        else:
+            entry['archive'] = archive_name
+            changed.append(rel)
+    
+    if progress:
+        progress.set_total(sum(files[rel]['size'] for rel in changed), len(changed))
+    
     try:
-        with tarfile.open(out, "w:gz") as tar:
-            tar.add(DATA_ROOT, arcname="nas_data")
+        with create_archive(out) as (tar, writer):
+            tar.add(data_root, arcname=ARCHIVE_ROOT, recursive=False)
+            for d in dirs:
+                tar.add(data_root / d, arcname=f"{ARCHIVE_ROOT}/{d}", recursive=False)
+            for rel in changed:
+                try:
+                    _add_file(tar, rel, files[rel], data_root, files)
+                except FileNotFoundError:
+                    del files[rel]  # removed while the backup was running
+                    continue
+                if progress:
+                    progress.advance(files[rel]['size'], 1)
+        
+        save_manifest(archive_name, {
+            'version': 2,
+            'kind': kind,
+            'archive': archive_name,
+            'parent': parent['archive'] if parent else None,
+            'depth': parent['depth'] + 1 if parent else 0,
+            'created': ts,
+            'files': files,
+            'dirs': dirs,
+            'deleted': sorted(set(parent_files) - set(files)),
+            # (uncompressed, compressed) offset of every compressed block,
+            # so single members can be read without decompressing the rest
+            'blocks': writer.blocks,
+        })
         
-        # Record in database
-        create_backup_entry(archive_name)
+        # Record in database, with the details the catalog page shows
+        create_backup_entry(archive_name, kind, parent_id,
+                            size_bytes=writer.compressed_size,
+                            logical_bytes=sum(files[rel]['size'] for rel in changed if rel in files),
+                            file_count=len(files),
+                            duration_ms=int((time.monotonic() - started) * 1000),
+                            checksum=writer.sha256.hexdigest())
         return archive_name
     except Exception as e:
         if out.exists():
             out.unlink()
+        manifest = sidecar_path(archive_name, ".manifest.json.gz")
+        if manifest.exists():
+            manifest.unlink()
         raise e
 
+def perform_dedup_backup(progress=None):
+    """Create a deduplicated snapshot in the content-addressed chunk repository"""
+    latest = get_latest_backup(kinds=("dedup",))
+    name = f"nas_snapshot_{time.strftime('%Y%m%d_%H%M%S')}"
+    if progress and latest and chunkstore.snapshot_exists(latest[1]):
+        # The previous snapshot's totals are the best estimate available up front
+        header = chunkstore.snapshot_header(latest[1])
+        progress.set_total(header['logical_bytes'], header['file_count'])
+    started = time.monotonic()
+    header = chunkstore.create_snapshot(name, DATA_ROOT,
+                                        previous=latest[1] if latest else None,
+                                        skip_dirs=STAGING_DIRS, progress=progress)
+    create_backup_entry(name, "dedup",
+                        size_bytes=header['stored_bytes'],
+                        logical_bytes=header['logical_bytes'],
+                        file_count=header['file_count'],
+                        duration_ms=int((time.monotonic() - started) * 1000))
+    return name
+
+def take_restore_snapshot():
+    """Snapshot DATA_ROOT before a restore and record it as a 'snapshot' backup.
+    
+    Returns (backup id, snapshot name).
+    """
+    name = base = f"pre_restore_snapshot_{time.strftime('%Y%m%d_%H%M%S')}"
+    n = 1
+    while snapshot.snapshot_path(name).exists():  # e.g. rolling back within the same second
+        n += 1
+        name = f"{base}_{n}"
+    header = snapshot.create_snapshot(name, DATA_ROOT, skip_dirs=STAGING_DIRS)
+    backup_id = create_backup_entry(name, "snapshot",
+                                    size_bytes=header['stored_bytes'],
+                                    logical_bytes=header['logical_bytes'],
+                                    file_count=header['file_count'],
+                                    duration_ms=header['duration_ms'])
+    return backup_id, name
+
+def promote_snapshot(backup_id, progress=None):
+    """Archive a restore snapshot as a compressed full backup, then drop the snapshot"""
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute("SELECT archive_path, kind FROM backups WHERE id = %s", (backup_id,))
+        row = cur.fetchone()
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+    if not row or row[1] != "snapshot" or not snapshot.snapshot_exists(row[0]):
+        raise ValueError("Snapshot not found.")
+    name = row[0]
+    archive_name = perform_backup(prefix="pre_restore_backup", progress=progress,
+                                  data_root=snapshot.snapshot_path(name))
+    delete_backup_from_db(backup_id)
+    snapshot.delete_snapshot(name)
+    return archive_name
+
+def _restore_target(name):
+    """DATA_ROOT path for an archive member, or None if it falls outside nas_data/"""
+    if name == ARCHIVE_ROOT:
+        return DATA_ROOT
+    if not name.startswith(ARCHIVE_ROOT + "/"):
+        return None
+    rel = name[len(ARCHIVE_ROOT) + 1:]
+    if rel.startswith("/") or ".." in Path(rel).parts:
+        return None
+    return DATA_ROOT / rel
+
+def _is_current(dest, size, mtime):
+    """True if dest already has this size and (whole-second) mtime"""
+    try:
+        st = os.stat(dest)
+    except FileNotFoundError:
+        return False
+    return st.st_size == size and int(st.st_mtime) == int(mtime)
+
+def _write_atomic(dest, source, mtime, mode):
+    """Write bytes, a file object or an iterator of chunks to a temp name beside dest, then rename over it"""
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dest.with_name(f".{dest.name}.{uuid.uuid4().hex[:8]}.restore")
+    try:
+        with open(tmp, "wb") as out:
+            if isinstance(source, bytes):
+                out.write(source)
+            elif hasattr(source, "read"):
+                shutil.copyfileobj(source, out, 1024 * 1024)
+            else:
+                out.writelines(source)
+        os.chmod(tmp, mode & 0o7777)
+        os.utime(tmp, (mtime, mtime))
+        os.replace(tmp, dest)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+def _link_atomic(dest, target):
+    """Hard-link dest to target (copying if linking fails), replacing dest"""
+    tmp = dest.with_name(f".{dest.name}.{uuid.uuid4().hex[:8]}.restore")
+    try:
+        try:
+            os.link(target, tmp)
+        except OSError:
+            shutil.copy2(target, tmp)
+        os.replace(tmp, dest)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+def _reap(futures):
+    """Drop finished writes (re-raising their errors) and return the rest"""
+    pending = []
+    for fut in futures:
+        if fut.done():
+            fut.result()
+        else:
+            pending.append(fut)
+    return pending
+
+def _restore_members(archive_path, wanted, stats, progress=None):
+    """Stream one archive's members straight into DATA_ROOT.
+    
+    Members are read in archive order; small files are handed to a worker pool
+    so writes overlap decompression, large ones are streamed inline. Hard link
+    members (deduplicated uploads) are linked to their target once every write
+    has finished; returns the names of those whose target isn't on disk.
+    """
+    links, unresolved = [], []
+    with open_archive(archive_path) as tar, ThreadPoolExecutor(max_workers=RESTORE_WORKERS) as pool:
+        slots = threading.BoundedSemaphore(RESTORE_WORKERS * 2)
+        futures = []
+        for member in tar:
+            if wanted is not None and member.name not in wanted:
+                continue
+            dest = _restore_target(member.name)
+            if dest is None:
+                continue
+            if member.isdir():
+                dest.mkdir(parents=True, exist_ok=True)
+                continue
+            if member.islnk():
+                target = _restore_target(member.linkname)
+                if target is not None:
+                    links.append((member, dest, target))
+                continue
+            if not member.isfile():
+                continue  # symlinks and special files are not restored
+            if _is_current(dest, member.size, member.mtime):
+                stats['skipped'] += 1
+                continue
+            
+            source = tar.extractfile(member)
+            if member.size > RESTORE_INLINE_MAX:
+                _write_atomic(dest, source, member.mtime, member.mode)
+            else:
+                data = source.read()
+                slots.acquire()
+                fut = pool.submit(_write_atomic, dest, data, member.mtime, member.mode)
+                fut.add_done_callback(lambda _: slots.release())
+                futures.append(fut)
+                if len(futures) >= 1024:
+                    futures = _reap(futures)
+            stats['restored'] += 1
+            if progress:
+                progress.advance(member.size, 1)
+        for fut in futures:
+            fut.result()
+    
+    for member, dest, target in links:
+        try:
+            if os.path.samefile(dest, target):
+                stats['skipped'] += 1
+                continue
+        except FileNotFoundError:
+            pass
+        if not target.is_file():
+            unresolved.append(member.name)
+            continue
+        _link_atomic(dest, target)
+        stats['restored'] += 1
+        if progress:
+            progress.advance(target.stat().st_size, 1)
+    return unresolved
+
+def restore_backup(archive_name, progress=None):
+    """Restore DATA_ROOT to the state captured by an archive, in place.
+    
+    Members are streamed out of the archive and written next to their
+    destination before an atomic rename; files whose size and mtime already
+    match are skipped. For archives with a manifest, each file is read from
+    whichever archive in the full+incremental chain holds it (archives with
+    nothing to restore are not opened), and paths deleted along the chain are
+    removed. Older archives are streamed whole.
+    """
+    stats = {'restored': 0, 'skipped': 0, 'deleted': 0}
+    manifest = load_manifest(archive_name)
+    DATA_ROOT.mkdir(parents=True, exist_ok=True)
+    
+    if manifest is None:
+        _restore_members(BACKUP_ROOT / archive_name, None, stats, progress)
+        return stats
+    
+    for d in manifest['dirs']:
+        (DATA_ROOT / d).mkdir(parents=True, exist_ok=True)
+    
+    sources, total_bytes = {}, 0
+    for rel, entry in manifest['files'].items():
+        if _is_current(DATA_ROOT / rel, entry['size'], entry['mtime'] / 1e9):
+            stats['skipped'] += 1
+        else:
+            sources.setdefault(entry['archive'], set()).add(f"{ARCHIVE_ROOT}/{rel}")
+            total_bytes += entry['size']
+    if progress:
+        progress.set_total(total_bytes, sum(len(names) for names in sources.values()))
+    unresolved = {}
+    for source, names in sources.items():
+        for name in _restore_members(BACKUP_ROOT / source, names, stats, progress):
+            rel = name[len(ARCHIVE_ROOT) + 1:]
+            unresolved[rel] = manifest['files'][rel]
+    # Links whose first copy is not part of this state: read the shared data directly
+    for rel, chunks in iter_backup_files(unresolved):
+        entry = unresolved[rel]
+        _write_atomic(DATA_ROOT / rel, chunks, entry['mtime'] / 1e9, entry.get('mode', 0o644))
+        stats['restored'] += 1
+    
+    # Apply deletions recorded anywhere along the chain
+    deleted = set()
+    step = manifest
+    while step is not None:
+        deleted.update(step['deleted'])
+        step = load_manifest(step['parent']) if step['parent'] else None
+    for rel in deleted - set(manifest['files']):
+        target = DATA_ROOT / rel
+        if target.is_file():
+            target.unlink()
+            stats['deleted'] += 1
+    return stats
+
+def is_indexed(manifest):
+    """True if a manifest records the offsets needed for single-file access"""
+    return manifest is not None and manifest['version'] >= 2
+
+def select_entries(manifest, rel):
+    """Manifest files at rel or below it ("" selects everything)"""
+    rel = rel.strip("/")
+    if not rel:
+        return dict(manifest['files'])
+    prefix = rel + "/"
+    return {p: e for p, e in manifest['files'].items() if p == rel or p.startswith(prefix)}
+
+def list_directory(manifest, rel):
+    """Immediate subdirectories and files of a directory inside a backup"""
+    rel = rel.strip("/")
+    prefix = rel + "/" if rel else ""
+    dirs = set()
+    files = []
+    for d in manifest['dirs']:
+        if d.startswith(prefix) and "/" not in d[len(prefix):]:
+            dirs.add(d[len(prefix):])
+    for p, entry in manifest['files'].items():
+        if not p.startswith(prefix):
+            continue
+        name = p[len(prefix):]
+        if "/" in name:
+            dirs.add(name.split("/", 1)[0])
+        else:
+            files.append(dict(entry, name=name, path=p))
+    files.sort(key=lambda f: f['name'])
+    return sorted(dirs), files
+
+def iter_backup_files(entries):
+    """Yield (rel_path, data chunks) for manifest entries, seeking into each archive.
+    
+    Entries are grouped by the archive that holds them and read in offset
+    order, so nearby members share one decompression pass.
+    """
+    by_archive = {}
+    for rel, entry in entries.items():
+        if 'offset' not in entry:
+            raise ValueError(f"{entry['archive']} has no member index")
+        by_archive.setdefault(entry['archive'], []).append((entry['offset'], entry['size'], rel))
+    for archive_name, spans in by_archive.items():
+        source = load_manifest(archive_name)
+        if not is_indexed(source):
+            raise ValueError(f"{archive_name} has no member index")
+        spans.sort()
+        yield from iter_spans(BACKUP_ROOT / archive_name, source['blocks'], spans)
+
+def restore_entries(manifest, rel, progress=None):
+    """Restore one file or directory subtree from a backup, in place"""
+    stats = {'restored': 0, 'skipped': 0}
+    rel = rel.strip("/")
+    for d in manifest['dirs']:
+        if not rel or d == rel or d.startswith(rel + "/"):
+            (DATA_ROOT / d).mkdir(parents=True, exist_ok=True)
+    wanted = {}
+    for p, entry in select_entries(manifest, rel).items():
+        if _is_current(DATA_ROOT / p, entry['size'], entry['mtime'] / 1e9):
+            stats['skipped'] += 1
+        else:
+            wanted[p] = entry
+    if progress:
+        progress.set_total(sum(e['size'] for e in wanted.values()), len(wanted))
+    for p, chunks in iter_backup_files(wanted):
+        entry = wanted[p]
+        _write_atomic(DATA_ROOT / p, chunks, entry['mtime'] / 1e9, entry.get('mode', 0o644))
+        stats['restored'] += 1
+        if progress:
+            progress.advance(entry['size'], files=1)
+    return stats
+
+def stream_entries_tar(manifest, rel):
+    """Generate a tar of a backup subtree, reading only the members it contains"""
+    rel = rel.strip("/")
+    entries = select_entries(manifest, rel)
+    def members():
+        for d in manifest['dirs']:
+            if not rel or d == rel or d.startswith(rel + "/"):
+                info = tarfile.TarInfo(f"{ARCHIVE_ROOT}/{d}")
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                yield info, None
+        for p, chunks in iter_backup_files(entries):
+            entry = entries[p]
+            info = tarfile.TarInfo(f"{ARCHIVE_ROOT}/{p}")
+            info.size = entry['size']
+            info.mtime = entry['mtime'] // 1_000_000_000
+            info.mode = entry.get('mode', 0o644)
+            yield info, IterReader(chunks)
+    return stream_tar(members())
+
+def get_indexed_backup(backup_id):
+    """(archive_name, manifest) of a browsable archive backup, or None"""
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute("SELECT archive_path, kind FROM backups WHERE id = %s", (backup_id,))
+        row = cur.fetchone()
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+    if not row or row[1] == "dedup":
+        return None
+    manifest = load_manifest(row[0])
+    return (row[0], manifest) if is_indexed(manifest) else None
+
+def reconcile_catalog(progress=None):
+    """Bring the backups table in line with what is actually in BACKUP_ROOT.
+    
+    Records orphaned archives (state 'discovered'), fills in sizes for rows
+    created before the catalog columns existed, and flags rows whose archive
+    has disappeared as 'missing' (or back to 'ok' if it returns). Archives
+    modified within the reconcile interval are left alone, since they may
+    still be being written.
+    """
+    BACKUP_ROOT.mkdir(parents=True, exist_ok=True)
+    on_disk = {f.name: f for suffix in SUFFIXES.values() for f in BACKUP_ROOT.glob("*" + suffix)}
+    counts = {'discovered': 0, 'missing': 0, 'updated': 0}
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute("SELECT id, archive_path, kind, size_bytes, state FROM backups")
+        rows = cur.fetchall()
+        for backup_id, archive_name, kind, size_bytes, state in rows:
+            if kind == "dedup":
+                exists = chunkstore.snapshot_exists(archive_name)
+            elif kind == "snapshot":
+                exists = snapshot.snapshot_exists(archive_name)
+            else:
+                exists = archive_name in on_disk
+            if not exists:
+                if state != "missing":
+                    cur.execute("UPDATE backups SET state = 'missing' WHERE id = %s", (backup_id,))
+                    counts['missing'] += 1
+                continue
+            if state == "missing":
+                cur.execute("UPDATE backups SET state = 'ok' WHERE id = %s", (backup_id,))
+            if size_bytes is None:
+                if kind in ("dedup", "snapshot"):
+                    header = (chunkstore if kind == "dedup" else snapshot).snapshot_header(archive_name)
+                    size_bytes, logical_bytes, file_count = header['stored_bytes'], header['logical_bytes'], header['file_count']
+                else:
+                    manifest = load_manifest(archive_name)
+                    size_bytes = on_disk[archive_name].stat().st_size
+                    logical_bytes = None
+                    file_count = len(manifest['files']) if manifest else None
+                cur.execute("""
+                    UPDATE backups SET size_bytes = %s, logical_bytes = %s, file_count = %s
+                    WHERE id = %s
+                """, (size_bytes, logical_bytes, file_count, backup_id))
+                counts['updated'] += 1
+            if progress:
+                progress.advance(0, 1)
+        
+        known = {row[1] for row in rows}
+        cutoff = time.time() - BACKUP_RECONCILE_INTERVAL
+        for name, path in on_disk.items():
+            if name in known:
+                continue
+            st = path.stat()
+            if st.st_mtime > cutoff:
+                continue  # possibly a backup still being written
+            manifest = load_manifest(name)
+            cur.execute("""
+                INSERT INTO backups (archive_path, created_at, kind, size_bytes, file_count, state)
+                VALUES (%s, %s, %s, %s, %s, 'discovered')
+            """, (name, datetime.fromtimestamp(st.st_mtime), manifest['kind'] if manifest else "full",
+                  st.st_size, len(manifest['files']) if manifest else None))
+            counts['discovered'] += 1
+        conn.commit()
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+    return f"{counts['discovered']} discovered, {counts['missing']} missing, {counts['updated']} updated"
+
+_last_reconcile = 0.0
+
+def _maybe_reconcile():
+    """Queue a catalog reconcile if this process has not done one recently"""
+    global _last_reconcile
+    if time.monotonic() - _last_reconcile < BACKUP_RECONCILE_INTERVAL:
+        return
+    _last_reconcile = time.monotonic()
+    try:
+        jobs.submit("reconcile", dedupe_key="catalog")
+    except Exception as e:
+        print(f"Error queueing catalog reconcile: {e}")
+
 @backup_bp.route("/")
 @role_required("admin")
 def index():
-    """Backup management page"""
-    BACKUP_ROOT.mkdir(parents=True, exist_ok=True)
+    """Backup management page, served from the catalog in the backups table"""
+    _maybe_reconcile()
+    page = max(1, request.args.get("page", 1, type=int))
+    count, total_bytes, latest = get_backup_summary()
+    
+    backups = []
+    for (backup_id, archive_name, created_at, kind, parent_id, size_bytes,
+         logical_bytes, file_count, state) in get_backup_page(page):
+        backups.append({
+            'id': backup_id,
+            'name': archive_name,
+            'created_at': created_at,
+            'size_mb': round(size_bytes / (1024 * 1024), 2) if size_bytes is not None else None,
+            'logical_mb': round(logical_bytes / (1024 * 1024), 2) if logical_bytes is not None else None,
+            'file_count': file_count,
+            'kind': kind,
+            'parent_id': parent_id,
+            'discovered': state == "discovered"
+        })
     
-    # Get backups from database
-    db_backups = get_backups_from_db()
+    summary = {
+        'count': count,
+        'total_mb': round(total_bytes / (1024 * 1024), 2),
+        'latest': latest,
+    }
+    pages = max(1, -(-count // BACKUPS_PER_PAGE))
+    return render_template("backup/index.html", backups=backups, summary=summary,
+                           page=page, pages=pages)
+
+@backup_bp.route("/reconcile", methods=["POST"])
+@role_required("admin")
+def reconcile():
+    """Rescan BACKUP_ROOT for archives the catalog does not know about"""
+    try:
+        job_id, created = jobs.submit("reconcile", dedupe_key="catalog", user_id=int(current_user.id))
+        if created:
+            flash(f"Rescanning backup storage in the background (job #{job_id}).", "info")
+        else:
+            flash(f"A backup or restore is already in progress (job #{job_id}); rescan later.", "info")
+    except Exception as e:
+        flash(f"Rescan failed: {str(e)}", "danger")
+    return redirect(url_for("backup.index"))
+
+def _backup_job(job, kind="full"):
+    if kind == "dedup":
+        return perform_dedup_backup(progress=job)
+    return perform_backup(kind, progress=job)
+
+def _restore_job(job, backup_id):
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute("SELECT archive_path, kind FROM backups WHERE id = %s", (backup_id,))
+        row = cur.fetchone()
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+    if not row:
+        raise ValueError("Backup not found.")
+    archive_name, kind = row
     
-    # Get actual files from filesystem
-    actual_files = {f.name: f for f in BACKUP_ROOT.glob("*.tar.gz")}
+    # Snapshot the current state first; with reflinks this takes seconds
+    job.set_message("Taking safety snapshot")
+    snapshot_id, _ = take_restore_snapshot()
     
-    # Combine database info with file stats
-    backups = []
-    for backup_id, archive_name, created_at in db_backups:
-        if archive_name in actual_files:
-            file_path = actual_files[archive_name]
-            size_mb = file_path.stat().st_size / (1024 * 1024)
-            backups.append({
-                'id': backup_id,
-                'name': archive_name,
-                'created_at': created_at,
-                'size_mb': round(size_mb, 2)
-            })
-    
-    # Also show orphaned files (files not in database)
-    db_names = {name for _, name, _ in db_backups}
-    for filename, filepath in actual_files.items():
-        if filename not in db_names:
-            size_mb = filepath.stat().st_size / (1024 * 1024)
-            backups.append({
-                'id': None,
-                'name': filename,
-                'created_at': datetime.fromtimestamp(filepath.stat().st_mtime),
-                'size_mb': round(size_mb, 2)
-            })
-    
-    # Sort by creation time (newest first)
-    backups.sort(key=lambda x: x['created_at'], reverse=True)
-    
-    return render_template("backup/index.html", backups=backups)
+    job.set_message(f"Restoring from {archive_name}")
+    if kind == "dedup":
+        restored, skipped = chunkstore.restore_snapshot(archive_name, DATA_ROOT, progress=job)
+    elif kind == "snapshot":
+        stats = snapshot.restore_snapshot(archive_name, DATA_ROOT, skip_dirs=STAGING_DIRS, progress=job)
+        restored, skipped = stats['restored'], stats['skipped']
+    else:
+        # Restore from backup (and its incremental chain)
+        stats = restore_backup(archive_name, progress=job)
+        restored, skipped = stats['restored'], stats['skipped']
+    job.set_message(f"{restored} files restored, {skipped} already up to date")
+    # Queued once this job releases DATA_ROOT
+    if SNAPSHOT_PROMOTE and snapshot_id:
+        job.then("promote", {"backup_id": snapshot_id}, dedupe_key=snapshot_id)
+    # Restored files change sizes behind the usage counters, and are
+    # separate copies until re-linked to the shared blobs
+    job.then("usage_reconcile", dedupe_key="all")
+    job.then("blob_reconcile", dedupe_key="all")
+    return archive_name
+
+def _restore_path_job(job, backup_id, path):
+    found = get_indexed_backup(backup_id)
+    if not found:
+        raise ValueError("This backup has no member index.")
+    archive_name, manifest = found
+    job.set_message(f"Restoring '{path}' from {archive_name}")
+    stats = restore_entries(manifest, path, progress=job)
+    # Same follow-ups as a full restore, for the files it rewrote
+    if stats['restored']:
+        job.then("usage_reconcile", dedupe_key="all")
+        job.then("blob_reconcile", dedupe_key="all")
+    return f"'{path}': {stats['restored']} files restored, {stats['skipped']} already up to date"
+
+# Jobs that read or rewrite DATA_ROOT or the archives in BACKUP_ROOT run one at a time
+jobs.register("backup", _backup_job, exclusive="data_root")
+jobs.register("restore", _restore_job, exclusive="data_root")
+jobs.register("restore_path", _restore_path_job, exclusive="data_root")
+jobs.register("promote", lambda job, backup_id: promote_snapshot(backup_id, progress=job), exclusive="data_root")
+jobs.register("reconcile", lambda job: reconcile_catalog(progress=job), exclusive="data_root")
+
+def _submit_backup(kind):
+    """Queue a backup job; concurrent requests share the one already queued or running"""
+    job_id, created = jobs.submit("backup", {"kind": kind}, dedupe_key="data",
+                                  user_id=int(current_user.id))
+    if created:
+        flash(f"{kind.capitalize()} backup started in the background (job #{job_id}).", "success")
+    else:
+        flash(f"A backup or restore is already in progress (job #{job_id}).", "info")
 
 @backup_bp.route("/create", methods=["POST"])
 @role_required("admin")
 def create():
-    """Create a new backup"""
+    """Start a new full, incremental or deduplicated backup"""
+    kind = request.form.get("kind", "full")
+    if kind not in ("full", "incremental", "dedup"):
+        kind = "full"
     try:
-        archive_name = perform_backup()
-        flash(f"Backup created successfully: {archive_name}", "success")
+        _submit_backup(kind)
     except Exception as e:
         flash(f"Backup failed: {str(e)}", "danger")
     
@@ -145,19 +906,14 @@ def auto_create():
     """Create automatic daily backups"""
     try:
         # Check if a backup was created today
-        today = datetime.now().strftime("%Y%m%d")
-        backups = get_backups_from_db()
-        
-        today_backup_exists = any(
-            backup[1].startswith(f"nas_backup_{today}") 
-            for backup in backups
-        )
-        
-        if today_backup_exists:
+        if daily_backup_exists(datetime.now().date()):
             flash("A backup for today already exists.", "info")
         else:
-            archive_name = perform_backup()
-            flash(f"Daily backup created: {archive_name}", "success")
+            # Incremental on most days; start a new full chain every BACKUP_FULL_EVERY runs
+            latest = get_latest_backup()
+            parent = load_manifest(latest[1]) if latest else None
+            kind = "incremental" if parent and parent['depth'] + 1 < BACKUP_FULL_EVERY else "full"
+            _submit_backup(kind)
     except Exception as e:
         flash(f"Auto backup failed: {str(e)}", "danger")
     
@@ -170,7 +926,7 @@ def download(backup_id):
     try:
         conn = get_db()
         cur = conn.cursor()
-        cur.execute("SELECT archive_path FROM backups WHERE id = %s", (backup_id,))
+        cur.execute("SELECT archive_path, kind FROM backups WHERE id = %s", (backup_id,))
         row = cur.fetchone()
         
         if not row:
@@ -178,13 +934,27 @@ def download(backup_id):
             return redirect(url_for("backup.index"))
         
         archive_name = row[0]
+        if row[1] == "dedup":
+            if not chunkstore.snapshot_exists(archive_name):
+                flash("Invalid backup file.", "danger")
+                return redirect(url_for("backup.index"))
+            # Rebuilt from the chunk repository on the fly as a plain tar
+            return send_stream(chunkstore.stream_snapshot_tar(archive_name), f"{archive_name}.tar",
+                               mimetype="application/x-tar")
+        if row[1] == "snapshot":
+            if not snapshot.snapshot_exists(archive_name):
+                flash("Invalid backup file.", "danger")
+                return redirect(url_for("backup.index"))
+            return send_stream(snapshot.stream_snapshot_tar(archive_name), f"{archive_name}.tar",
+                               mimetype="application/x-tar")
+        
         p = (BACKUP_ROOT / archive_name).resolve()
         
         if not p.is_file() or not str(p).startswith(str(BACKUP_ROOT.resolve())):
             flash("Invalid backup file.", "danger")
             return redirect(url_for("backup.index"))
         
-        return send_file(p, as_attachment=True)
+        return send_file_ranged(p, as_attachment=True)
     except Exception as e:
         flash(f"Error: {str(e)}", "danger")
         return redirect(url_for("backup.index"))
@@ -202,46 +972,32 @@ def restore(backup_id):
     try:
         conn = get_db()
         cur = conn.cursor()
-        cur.execute("SELECT archive_path FROM backups WHERE id = %s", (backup_id,))
+        cur.execute("SELECT archive_path, kind FROM backups WHERE id = %s", (backup_id,))
         row = cur.fetchone()
         
         if not row:
             flash("Backup not found.", "danger")
             return redirect(url_for("backup.index"))
         
-        archive_name = row[0]
-        p = (BACKUP_ROOT / archive_name).resolve()
-        
-        if not p.is_file() or not str(p).startswith(str(BACKUP_ROOT.resolve())):
+        archive_name, kind = row
+        if kind == "dedup":
+            valid = chunkstore.snapshot_exists(archive_name)
+        elif kind == "snapshot":
+            valid = snapshot.snapshot_exists(archive_name)
+        else:
+            p = (BACKUP_ROOT / archive_name).resolve()
+            valid = p.is_file() and str(p).startswith(str(BACKUP_ROOT.resolve()))
+        if not valid:
             flash("Invalid backup file.", "danger")
             return redirect(url_for("backup.index"))
         
-        # Create a safety backup before restore
-        safety_backup_name = f"pre_restore_backup_{time.strftime('%Y%m%d_%H%M%S')}.tar.gz"
-        safety_backup = BACKUP_ROOT / safety_backup_name
-        with tarfile.open(safety_backup, "w:gz") as tar:
-            tar.add(DATA_ROOT, arcname="nas_data")
-        create_backup_entry(safety_backup_name)
-        
-        # Restore from backup
-        tmp = BACKUP_ROOT / "_restore_tmp"
-        if tmp.exists(): 
-            shutil.rmtree(tmp)
-        tmp.mkdir(parents=True, exist_ok=True)
-        
-        with tarfile.open(p, "r:gz") as tar:
-            tar.extractall(tmp)
-        
-        src = tmp / "nas_data"
-        for root, dirs, files in os.walk(src):
-            rel = os.path.relpath(root, src)
-            dest_dir = (DATA_ROOT / rel)
-            dest_dir.mkdir(parents=True, exist_ok=True)
-            for f in files:
-                shutil.copy2(os.path.join(root,f), dest_dir / f)
-        
-        shutil.rmtree(tmp)
-        flash(f"Restore completed from {archive_name}. A safety backup was created before restore.", "success")
+        job_id, created = jobs.submit("restore", {"backup_id": backup_id}, dedupe_key="data",
+                                      user_id=int(current_user.id))
+        if created:
+            flash(f"Restore from {archive_name} started in the background (job #{job_id}). "
+                  f"A safety snapshot is taken first.", "success")
+        else:
+            flash(f"A backup or restore is already in progress (job #{job_id}).", "info")
     except Exception as e:
         flash(f"Restore failed: {str(e)}", "danger")
     finally:
@@ -253,6 +1009,133 @@ def restore(backup_id):
     
     return redirect(url_for("backup.index"))
 
+@backup_bp.route("/promote/<int:backup_id>", methods=["POST"])
+@role_required("admin")
+def promote(backup_id):
+    """Archive a pre-restore snapshot as a compressed backup in the background"""
+    try:
+        job_id, created = jobs.submit("promote", {"backup_id": backup_id}, dedupe_key=backup_id,
+                                      user_id=int(current_user.id))
+        if created:
+            flash(f"Archiving snapshot in the background (job #{job_id}).", "success")
+        else:
+            flash(f"A backup or restore is already in progress (job #{job_id}).", "info")
+    except Exception as e:
+        flash(f"Archiving failed: {str(e)}", "danger")
+    return redirect(url_for("backup.index"))
+
+@backup_bp.route("/browse/<int:backup_id>")
+@role_required("admin")
+def browse(backup_id):
+    """Browse the contents of a backup by directory"""
+    found = get_indexed_backup(backup_id)
+    if not found:
+        flash("This backup has no member index and can only be restored as a whole.", "warning")
+        return redirect(url_for("backup.index"))
+    
+    archive_name, manifest = found
+    rel = request.args.get("path", "").strip("/")
+    dirs, files = list_directory(manifest, rel)
+    for f in files:
+        f['modified'] = datetime.fromtimestamp(f['mtime'] / 1e9)
+        f['size_kb'] = round(f['size'] / 1024, 1)
+    crumbs = []
+    if rel:
+        parts = rel.split("/")
+        crumbs = [(part, "/".join(parts[:i + 1])) for i, part in enumerate(parts)]
+    
+    return render_template("backup/browse.html", backup_id=backup_id, archive_name=archive_name,
+                           path=rel, crumbs=crumbs, dirs=dirs, files=files)
+
+@backup_bp.route("/contents/<int:backup_id>")
+@role_required("admin")
+def contents(backup_id):
+    """List the files in a backup (optionally under ?path=) as JSON"""
+    found = get_indexed_backup(backup_id)
+    if not found:
+        return jsonify({"error": "Backup not found or not indexed"}), 404
+    
+    archive_name, manifest = found
+    entries = select_entries(manifest, request.args.get("path", ""))
+    return jsonify({
+        "archive": archive_name,
+        "files": [{"path": p, "size": e['size'], "mtime": e['mtime'] // 1_000_000_000,
+                   "archive": e['archive']} for p, e in sorted(entries.items())],
+    })
+
+@backup_bp.route("/extract/<int:backup_id>")
+@role_required("admin")
+def extract(backup_id):
+    """Download one file, or a directory as a tar, straight out of a backup"""
+    found = get_indexed_backup(backup_id)
+    if not found:
+        flash("This backup has no member index and can only be restored as a whole.", "warning")
+        return redirect(url_for("backup.index"))
+    
+    archive_name, manifest = found
+    rel = request.args.get("path", "").strip("/")
+    entry = manifest['files'].get(rel)
+    if entry is not None:
+        def body():
+            for _, chunks in iter_backup_files({rel: entry}):
+                yield from chunks
+        rv = send_stream(body(), os.path.basename(rel))
+        rv.content_length = entry['size']
+        return rv
+    
+    if rel and rel not in manifest['dirs']:
+        flash(f"'{rel}' is not in {archive_name}.", "danger")
+        return redirect(url_for("backup.browse", backup_id=backup_id))
+    name = os.path.basename(rel) or archive_name.split(".tar")[0]
+    return send_stream(stream_entries_tar(manifest, rel), f"{name}.tar", mimetype="application/x-tar")
+
+@backup_bp.route("/restore-path/<int:backup_id>", methods=["POST"])
+@role_required("admin")
+def restore_path(backup_id):
+    """Restore a single file or directory from a backup"""
+    found = get_indexed_backup(backup_id)
+    if not found:
+        flash("This backup has no member index and can only be restored as a whole.", "warning")
+        return redirect(url_for("backup.index"))
+    
+    archive_name, manifest = found
+    rel = request.form.get("path", "").strip("/")
+    if not rel or (rel not in manifest['files'] and rel not in manifest['dirs']):
+        flash(f"'{rel}' is not in {archive_name}.", "danger")
+        return redirect(url_for("backup.browse", backup_id=backup_id, path=os.path.dirname(rel)))
+    try:
+        job_id, created = jobs.submit("restore_path", {"backup_id": backup_id, "path": rel},
+                                      dedupe_key="data", user_id=int(current_user.id))
+        if created:
+            flash(f"Restoring '{rel}' from {archive_name} in the background (job #{job_id}).", "success")
+        else:
+            flash(f"A backup or restore is already in progress (job #{job_id}).", "info")
+    except Exception as e:
+        flash(f"Restore failed: {str(e)}", "danger")
+    
+    return redirect(url_for("backup.index"))
+
+@backup_bp.route("/jobs")
+@role_required("admin")
+def job_list():
+    """Recent backup and restore jobs with progress, for polling"""
+    return jsonify({"jobs": jobs.list_jobs()})
+
+@backup_bp.route("/jobs/<int:job_id>")
+@role_required("admin")
+def job_status(job_id):
+    job = jobs.get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found."}), 404
+    return jsonify(job)
+
+@backup_bp.route("/jobs/<int:job_id>/cancel", methods=["POST"])
+@role_required("admin")
+def job_cancel(job_id):
+    """Ask a queued or running job to stop"""
+    jobs.cancel(job_id)
+    return jsonify(jobs.get_job(job_id) or {"error": "Job not found."})
+
 @backup_bp.route("/delete/<int:backup_id>", methods=["POST"])
 @role_required("admin")
 def delete(backup_id):
@@ -260,7 +1143,7 @@ def delete(backup_id):
     try:
         conn = get_db()
         cur = conn.cursor()
-        cur.execute("SELECT archive_path FROM backups WHERE id = %s", (backup_id,))
+        cur.execute("SELECT archive_path, kind FROM backups WHERE id = %s", (backup_id,))
         row = cur.fetchone()
         
         if not row:
@@ -268,11 +1151,33 @@ def delete(backup_id):
             return redirect(url_for("backup.index"))
         
         archive_name = row[0]
+        if row[1] == "dedup":
+            # Drop the snapshot index, then sweep chunks nothing else references
+            removed, freed = chunkstore.delete_snapshot(archive_name)
+            delete_backup_from_db(backup_id)
+            flash(f"Backup '{archive_name}' deleted; {removed} unused chunks "
+                  f"({freed / (1024 * 1024):.2f} MB) reclaimed.", "info")
+            return redirect(url_for("backup.index"))
+        if row[1] == "snapshot":
+            freed = snapshot.delete_snapshot(archive_name)
+            delete_backup_from_db(backup_id)
+            flash(f"Snapshot '{archive_name}' deleted; {freed / (1024 * 1024):.2f} MB reclaimed.", "info")
+            return redirect(url_for("backup.index"))
+        
         p = (BACKUP_ROOT / archive_name).resolve()
         
+        # Incrementals read unchanged files from their ancestors
+        cur.execute("SELECT COUNT(*) FROM backups WHERE parent_id = %s", (backup_id,))
+        if cur.fetchone()[0]:
+            flash(f"'{archive_name}' has incremental backups based on it. Delete those first.", "danger")
+            return redirect(url_for("backup.index"))
+        
         # Delete file if it exists
         if p.is_file() and str(p).startswith(str(BACKUP_ROOT.resolve())):
             p.unlink()
+        manifest = sidecar_path(archive_name, ".manifest.json.gz")
+        if manifest.exists():
+            manifest.unlink()
         
         # Delete from database
         delete_backup_from_db(backup_id)
@@ -0,0 +1,397 @@
+"""Repeatable benchmarks for the files and backup subsystems.
+
+Builds a synthetic dataset (users, folders, files, shares) under a temporary
+DATA_ROOT, backed by an SQLite stand-in for MySQL so it runs offline, then
+times folder listings, accessible-file queries, downloads, uploads, backups
+and restores. Results are written as JSON and can be compared to a baseline:
+
+    python -m nas.benchmark --users 50 --files 20000 --out bench.json
+    python -m nas.benchmark --users 50 --files 20000 --baseline bench.json
+"""
+import os, io, re, sys, json, time, types, random, shutil, sqlite3, inspect, argparse, platform, tempfile, subprocess
+from datetime import datetime
+
+SCHEMA = """
+CREATE TABLE users (id INTEGER PRIMARY KEY, username TEXT NOT NULL, role TEXT NOT NULL DEFAULT 'user');
+CREATE TABLE files (id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT NOT NULL, parent_dir TEXT NOT NULL DEFAULT '',
+                    size BIGINT NOT NULL DEFAULT 0, sha256 TEXT, owner_id INT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+CREATE INDEX idx_files_parent_dir ON files (parent_dir);
+CREATE INDEX idx_files_path ON files (path);
+CREATE INDEX idx_files_created ON files (created_at, id);
+CREATE INDEX idx_files_sha256 ON files (sha256);
+CREATE TABLE file_permissions (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                               file_id INT NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+                               user_id INT NOT NULL, can_read INT DEFAULT 1, can_write INT DEFAULT 0,
+                               granted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, UNIQUE (file_id, user_id));
+CREATE TABLE file_blobs (sha256 TEXT PRIMARY KEY, size BIGINT NOT NULL, ref_count INT NOT NULL DEFAULT 0,
+                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE user_usage (user_id INT PRIMARY KEY, bytes_used BIGINT NOT NULL DEFAULT 0,
+                         file_count INT NOT NULL DEFAULT 0, quota_bytes BIGINT, reconciled_at TIMESTAMP);
+CREATE TABLE file_trigrams (trigram TEXT NOT NULL, file_id INT NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+                            PRIMARY KEY (trigram, file_id));
+CREATE TABLE upload_sessions (id TEXT PRIMARY KEY, owner_id INT, rel_dir TEXT, filename TEXT, size BIGINT,
+                              received TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                              updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE backups (id INTEGER PRIMARY KEY AUTOINCREMENT, archive_path TEXT NOT NULL, kind TEXT NOT NULL DEFAULT 'full',
+                      parent_id INT, size_bytes BIGINT, logical_bytes BIGINT, file_count INT, duration_ms INT,
+                      checksum TEXT, state TEXT NOT NULL DEFAULT 'ok', created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, params TEXT,
+                   status TEXT NOT NULL DEFAULT 'queued', active_key TEXT UNIQUE, created_by INT, worker TEXT,
+                   bytes_done BIGINT NOT NULL DEFAULT 0, bytes_total BIGINT NOT NULL DEFAULT 0,
+                   files_done INT NOT NULL DEFAULT 0, files_total INT NOT NULL DEFAULT 0,
+                   cancel_requested INT NOT NULL DEFAULT 0, message TEXT, result TEXT,
+                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, started_at TIMESTAMP,
+                   heartbeat_at TIMESTAMP, finished_at TIMESTAMP);
+"""
+
+# Unique key that each ON DUPLICATE KEY UPDATE insert can collide on, by table
+_CONFLICT_KEYS = {'file_permissions': "file_id, user_id", 'file_blobs': "sha256"}
+
+# MySQL dialect used by the app -> SQLite equivalent
+_REWRITES = [
+    (re.compile(r"%s"), "?"),
+    (re.compile(r"\s+FOR UPDATE"), ""),
+    (re.compile(r"INSERT IGNORE"), "INSERT OR IGNORE"),
+    (re.compile(r"(INSERT INTO (\w+).*?)ON DUPLICATE KEY UPDATE", re.S),
+     lambda m: f"{m[1]}ON CONFLICT ({_CONFLICT_KEYS[m[2]]}) DO UPDATE SET"),
+    (re.compile(r"LIKE \?"), "LIKE ? ESCAPE '\\\\'"),
+]
+
+def _translate(sql):
+    for pattern, replacement in _REWRITES:
+        sql = pattern.sub(replacement, sql)
+    return sql
+
+class StandInCursor:
+    """DB-API cursor that accepts the app's MySQL-flavoured SQL"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, sql, params=()):
+        return self._cursor.execute(_translate(sql), tuple(params))
+
+    def executemany(self, sql, params):
+        return self._cursor.executemany(_translate(sql), params)
+
+class StandInConnection:
+    """SQLite connection standing in for the app's MySQL connection"""
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False,
+                                     detect_types=sqlite3.PARSE_DECLTYPES)
+        self._conn.execute("PRAGMA foreign_keys = ON")
+        self._conn.create_function("CONCAT", -1, lambda *parts: "".join(str(p) for p in parts))
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def cursor(self, *args, **kwargs):
+        return StandInCursor(self._conn.cursor())
+
+    def ping(self, reconnect=False):
+        self._conn.execute("SELECT 1")
+
+def install_stand_in(db_path):
+    """Create the schema and make `app.get_db` hand out stand-in connections"""
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.executescript(SCHEMA)
+    conn.close()
+    module = types.ModuleType("app")
+    module.get_db = lambda: StandInConnection(db_path)
+    sys.modules["app"] = module
+
+def parse_size(text):
+    """'64k' / '4M' / '1G' -> bytes"""
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([kmg]?)b?", str(text).strip().lower())
+    if not match:
+        raise argparse.ArgumentTypeError(f"invalid size '{text}'")
+    return int(float(match.group(1)) * 1024 ** " kmg".index(match.group(2) or " "))
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, round(pct / 100 * (len(ordered) - 1)))]
+
+def latency(samples):
+    """Summary of a list of durations in seconds, in milliseconds"""
+    return {
+        'n': len(samples),
+        'p50_ms': round(percentile(samples, 50) * 1000, 3),
+        'p95_ms': round(percentile(samples, 95) * 1000, 3),
+        'p99_ms': round(percentile(samples, 99) * 1000, 3),
+        'mean_ms': round(sum(samples) / len(samples) * 1000, 3),
+    }
+
+def throughput(nbytes, seconds, files=None):
+    result = {'bytes': nbytes, 'seconds': round(seconds, 4),
+              'mb_s': round(nbytes / seconds / 1e6, 2) if seconds > 0 else None}
+    if files is not None:
+        result['files'] = files
+    return result
+
+def build_dataset(args, data_root, db_path):
+    """Create users, a folder tree, files on disk, their rows and shares. Returns the file list."""
+    rng = random.Random(args.seed)
+    block = rng.randbytes(1024 * 1024)
+    # Half random, half repeated, so compression has realistic work to do
+    block = block[:len(block) // 2] + block[:64] * (len(block) // 128)
+
+    dirs = [""]
+    level = [""]
+    for _ in range(args.depth):
+        level = [f"{d}/dir{i}" if d else f"dir{i}" for d in level for i in range(args.fanout)]
+        dirs.extend(level)
+    for d in dirs[1:]:
+        os.makedirs(os.path.join(data_root, d), exist_ok=True)
+
+    conn = sqlite3.connect(db_path)
+    conn.executemany("INSERT INTO users (id, username, role) VALUES (?, ?, ?)",
+                     [(uid, f"user{uid}", "admin" if uid == 1 else "user") for uid in range(1, args.users + 1)])
+    files, rows = [], []
+    for i in range(args.files):
+        parent = rng.choice(dirs)
+        rel = f"{parent}/file{i}.{rng.choice(('txt', 'jpg', 'pdf', 'bin'))}" if parent else f"file{i}.dat"
+        size = min(int(rng.lognormvariate(0, 0.75) * args.file_size), args.file_size * 64)
+        with open(os.path.join(data_root, rel), "wb") as f:
+            remaining = size
+            while remaining > 0:
+                f.write(block[:remaining])
+                remaining -= len(block)
+        owner = rng.randint(1, args.users)
+        files.append((rel, size, owner))
+        rows.append((i + 1, rel, parent, owner, size))
+    conn.executemany("INSERT INTO files (id, path, parent_dir, owner_id, size) VALUES (?, ?, ?, ?, ?)", rows)
+    conn.execute("""INSERT INTO user_usage (user_id, bytes_used, file_count)
+                    SELECT owner_id, SUM(size), COUNT(*) FROM files GROUP BY owner_id""")
+
+    grants = {}
+    for file_id, _, _, owner, _ in rows:
+        for _ in range(min(args.shares, args.users - 1)):
+            user = rng.randint(1, args.users)
+            if user != owner:
+                grants[(file_id, user)] = rng.random() < 0.3
+    conn.executemany("INSERT INTO file_permissions (file_id, user_id, can_read, can_write) VALUES (?, ?, 1, ?)",
+                     [(file_id, user, can_write) for (file_id, user), can_write in sorted(grants.items())])
+
+    from nas.search import trigrams
+    conn.executemany("INSERT INTO file_trigrams (trigram, file_id) VALUES (?, ?)",
+                     [(g, file_id) for file_id, rel, _, _, _ in rows for g in trigrams(rel.rsplit("/", 1)[-1])])
+    conn.commit()
+    conn.close()
+    return dirs, files
+
+STUB_TEMPLATES = {
+    "files/index.html": "{% for item in items %}{{ item.name }} {{ item.owner }}\n{% endfor %}",
+    "files/my_files.html": "{% for file in files %}{{ file.path }} {{ file.owner_name }}\n{% endfor %}",
+    "files/search.html": "{% for file in files %}{{ file.path }}\n{% endfor %}",
+}
+
+def make_app(templates):
+    from flask import Flask
+    from flask_login import LoginManager, UserMixin
+    from jinja2 import ChoiceLoader, DictLoader, FileSystemLoader
+    from nas.__init__ import files_bp, backup_bp
+
+    class User(UserMixin):
+        def __init__(self, uid):
+            self.id = uid
+            self.username = f"user{uid}"
+            self.role = "admin" if uid == 1 else "user"
+
+    app = Flask("nas_benchmark")
+    app.secret_key = "benchmark"
+    loaders = [FileSystemLoader(templates)] if templates and os.path.isdir(templates) else []
+    app.jinja_loader = ChoiceLoader(loaders + [DictLoader(STUB_TEMPLATES)])
+    login = LoginManager(app)
+    login.user_loader(lambda uid: User(int(uid)))
+    app.register_blueprint(files_bp)
+    app.register_blueprint(backup_bp)
+    return app, User
+
+def call_view(app, user, view, path, method="GET", data=None, **kwargs):
+    """Run a view function directly, bypassing auth decorators; returns bytes produced"""
+    from flask_login import login_user
+    with app.test_request_context(path, method=method, data=data):
+        login_user(user)
+        rv = app.make_response(inspect.unwrap(view)(**kwargs))
+        total = 0
+        for chunk in rv.response:
+            total += len(chunk)
+        rv.close()
+        return total
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+def run(args):
+    work = tempfile.mkdtemp(prefix="nas_bench_")
+    data_root = os.path.join(work, "data")
+    os.makedirs(data_root)
+    os.environ["DATA_ROOT"] = data_root
+    os.environ["BACKUP_ROOT"] = os.path.join(work, "backups")
+    os.environ.setdefault("DIRCACHE_INOTIFY", "0")
+    db_path = os.path.join(work, "nas.db")
+    install_stand_in(db_path)
+    try:
+        from nas import files, backup
+        from nas.dircache import dir_cache
+        from nas.acl_cache import acl_cache
+
+        start = time.perf_counter()
+        dirs, dataset = build_dataset(args, data_root, db_path)
+        build_seconds = time.perf_counter() - start
+        total_bytes = sum(size for _, size, _ in dataset)
+        app, User = make_app(args.templates)
+        rng = random.Random(args.seed + 1)
+        users = [User(uid) for uid in range(1, args.users + 1)]
+        results = {}
+
+        # Folder listings: cold (caches dropped) and warm
+        for label, clear in (("listing_cold", True), ("listing_warm", False)):
+            samples = []
+            for _ in range(args.iterations):
+                rel, user = rng.choice(dirs), rng.choice(users)
+                if clear:
+                    dir_cache.invalidate_tree(data_root)
+                    acl_cache.clear()
+                samples.append(timed(call_view, app, user, files.index, f"/files/?p={rel}")[0])
+            results[label] = latency(samples)
+
+        samples = [timed(call_view, app, rng.choice(users[1:] or users), files.my_files_export,
+                         "/files/my-files.ndjson")[0] for _ in range(args.iterations)]
+        results['accessible_files_user'] = latency(samples)
+        samples = [timed(call_view, app, users[0], files.my_files_export, "/files/my-files.ndjson")[0]
+                   for _ in range(max(1, args.iterations // 10))]
+        results['accessible_files_admin'] = latency(samples)
+        samples = [timed(call_view, app, rng.choice(users), files.my_files, "/files/my-files")[0]
+                   for _ in range(args.iterations)]
+        results['my_files'] = latency(samples)
+
+        # Downloads of the largest files, read through the response body
+        largest = sorted(dataset, key=lambda f: -f[1])[:args.transfers]
+        nbytes, seconds = 0, 0.0
+        for rel, size, owner in largest:
+            elapsed, sent = timed(call_view, app, users[owner - 1], files.download, f"/files/download?rel={rel}")
+            nbytes += sent
+            seconds += elapsed
+        results['download'] = throughput(nbytes, seconds, len(largest))
+
+        payload = random.Random(args.seed + 2).randbytes(args.upload_size)
+        seconds = 0.0
+        for i in range(args.transfers):
+            data = {'rel': rng.choice(dirs), 'file': (io.BytesIO(payload), f"upload{i}.bin")}
+            seconds += timed(call_view, app, rng.choice(users), files.upload, "/files/upload", "POST", data)[0]
+        results['upload'] = throughput(args.upload_size * args.transfers, seconds, args.transfers)
+
+        if not args.skip_backup:
+            backup_bytes = total_bytes + args.upload_size * args.transfers
+            seconds, name = timed(backup.perform_backup, "full")
+            results['backup_full'] = throughput(backup_bytes, seconds, len(dataset) + args.transfers)
+            seconds, _ = timed(backup.perform_backup, "incremental")
+            results['backup_incremental_unchanged'] = {'seconds': round(seconds, 4)}
+            seconds, _ = timed(backup.perform_dedup_backup)
+            results['backup_dedup'] = throughput(backup_bytes, seconds, len(dataset) + args.transfers)
+            for entry in os.listdir(data_root):
+                path = os.path.join(data_root, entry)
+                shutil.rmtree(path) if os.path.isdir(path) else os.unlink(path)
+            seconds, stats = timed(backup.restore_backup, name)
+            results['restore'] = throughput(backup_bytes, seconds, stats['restored'])
+
+        return {
+            'meta': {
+                'timestamp': datetime.now().isoformat(timespec="seconds"),
+                'commit': _git_commit(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'database': "sqlite stand-in",
+                'dataset': {
+                    'users': args.users, 'files': args.files, 'folders': len(dirs),
+                    'depth': args.depth, 'fanout': args.fanout, 'shares': args.shares,
+                    'file_size': args.file_size, 'bytes': total_bytes, 'seed': args.seed,
+                    'build_seconds': round(build_seconds, 2),
+                },
+            },
+            'results': results,
+        }
+    finally:
+        if args.keep:
+            print(f"Dataset kept in {work}", file=sys.stderr)
+        else:
+            shutil.rmtree(work, ignore_errors=True)
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+def compare(results, baseline, tolerance):
+    """Print each metric against the baseline; returns the metrics that got worse than tolerance"""
+    regressions = []
+    print(f"{'metric':42} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, current in results['results'].items():
+        old = baseline.get('results', {}).get(name)
+        if not old:
+            continue
+        for key in ('p50_ms', 'p95_ms', 'mb_s', 'seconds'):
+            if key not in current or not old.get(key) or current[key] is None:
+                continue
+            change = (current[key] - old[key]) / old[key] * 100
+            worse = -change if key == 'mb_s' else change
+            flag = "  REGRESSION" if worse > tolerance else ""
+            print(f"{name + '.' + key:42} {old[key]:>12} {current[key]:>12} {change:>+7.1f}%{flag}")
+            if flag:
+                regressions.append(f"{name}.{key}")
+    if baseline.get('meta', {}).get('dataset') != results['meta']['dataset']:
+        print("Note: the baseline was recorded with a different dataset", file=sys.stderr)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--depth", type=int, default=2, help="folder tree depth")
+    parser.add_argument("--fanout", type=int, default=5, help="sub-folders per folder")
+    parser.add_argument("--shares", type=int, default=2, help="users each file is shared with")
+    parser.add_argument("--file-size", type=parse_size, default="64k", help="median file size")
+    parser.add_argument("--upload-size", type=parse_size, default="8M")
+    parser.add_argument("--transfers", type=int, default=10, help="downloads and uploads to time")
+    parser.add_argument("--iterations", type=int, default=200, help="samples per latency benchmark")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--templates", default="templates", help="template folder; stubs are used if missing")
+    parser.add_argument("--skip-backup", action="store_true")
+    parser.add_argument("--keep", action="store_true", help="keep the generated dataset")
+    parser.add_argument("--out", help="write results JSON here")
+    parser.add_argument("--baseline", help="compare against a results JSON; exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=10.0, help="allowed slowdown in percent")
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    text = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s): {', '.join(regressions)}", file=sys.stderr)
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,221 @@
+import os, time, uuid, errno, hashlib
+from pathlib import Path
+from nas.db_pool import get_db, iter_rows
+
+DATA_ROOT = Path(os.getenv("DATA_ROOT","/srv/nas_data")).resolve()
+# Inside DATA_ROOT so every stored file can be a hardlink to its blob
+BLOB_ROOT = DATA_ROOT / ".blobs"
+DEDUP_MIN_SIZE = int(os.getenv("DEDUP_MIN_SIZE", str(64 * 1024)))  # smaller files are stored as plain copies
+BLOB_ORPHAN_GRACE = 3600  # seconds before an unreferenced blob file may be swept; uploads link it first
+_IN_BATCH = 500
+
+def blob_path(sha256):
+    return BLOB_ROOT / sha256[:2] / sha256
+
+def hash_file(path):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+def _link_over(src, dest):
+    """Hardlink src at dest, atomically replacing whatever is there"""
+    tmp = dest.with_name(f".{dest.name}.{uuid.uuid4().hex[:8]}.link")
+    os.link(src, tmp)
+    try:
+        os.replace(tmp, dest)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+def _add_ref(cur, sha256, size):
+    cur.execute("""
+        INSERT INTO file_blobs (sha256, size, ref_count) VALUES (%s, %s, 1)
+        ON DUPLICATE KEY UPDATE ref_count = ref_count + 1
+    """, (sha256, size))
+
+def store(cur, tmp, dest, size):
+    """Put a fully written temp file at dest, sharing storage with identical content.
+
+    tmp is hashed here, from the bytes being stored: a digest supplied by a
+    client, or kept while chunks arrived, could name content other than what
+    is on disk and link someone else's file to it. No other process may write
+    to tmp. dest becomes a hardlink to the blob for that hash, which is created
+    from tmp if this content is new; tmp is consumed either way. Raises
+    FileExistsError, leaving tmp alone, if dest already exists. Returns the
+    sha256 to record on the files row, or None for a file stored on its own.
+    The caller commits.
+    """
+    if size < DEDUP_MIN_SIZE:
+        os.link(tmp, dest)
+        tmp.unlink()
+        return None
+    sha256 = hash_file(tmp)
+    blob = blob_path(sha256)
+    # Locks the blob row, so a delete can't remove the blob while it is linked
+    cur.execute("SELECT size FROM file_blobs WHERE sha256 = %s FOR UPDATE", (sha256,))
+    if cur.fetchone() is None or not blob.is_file():
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        _link_over(tmp, blob)
+    try:
+        os.link(blob, dest)
+    except OSError as e:
+        if e.errno != errno.EMLINK:
+            raise
+        os.link(tmp, dest)  # the blob is at the filesystem's link limit
+        tmp.unlink()
+        return None
+    tmp.unlink()
+    _add_ref(cur, sha256, size)
+    return sha256
+
+def release(cur, hashes):
+    """Drop one reference per deleted file; blobs left unreferenced are removed. The caller commits.
+
+    Blob files are unlinked before the commit, while their rows are locked. If
+    the commit then fails, the row outlives its file and the next upload of
+    that content re-creates it.
+    """
+    counts = {}
+    for sha256 in hashes:
+        if sha256:
+            counts[sha256] = counts.get(sha256, 0) + 1
+    if not counts:
+        return
+    cur.executemany("UPDATE file_blobs SET ref_count = ref_count - %s WHERE sha256 = %s",
+                    [(n, sha256) for sha256, n in sorted(counts.items())])
+    names = sorted(counts)
+    for i in range(0, len(names), _IN_BATCH):
+        batch = names[i:i + _IN_BATCH]
+        marks = ", ".join(["%s"] * len(batch))
+        cur.execute(f"SELECT sha256 FROM file_blobs WHERE sha256 IN ({marks}) AND ref_count <= 0", batch)
+        dead = [row[0] for row in cur.fetchall()]
+        if dead:
+            cur.execute("DELETE FROM file_blobs WHERE sha256 IN (%s)" % ", ".join(["%s"] * len(dead)), dead)
+            for sha256 in dead:
+                blob_path(sha256).unlink(missing_ok=True)
+
+def _adopt(file_id, full, st, old_sha256, sha256):
+    """Turn an existing file into a link to the blob for its content; returns True if linked"""
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute("SELECT size FROM file_blobs WHERE sha256 = %s FOR UPDATE", (sha256,))
+        exists = cur.fetchone() is not None
+        now = os.stat(full)
+        if (now.st_ino, now.st_size, now.st_mtime_ns) != (st.st_ino, st.st_size, st.st_mtime_ns):
+            conn.rollback()
+            return False  # changed while it was being hashed
+        blob = blob_path(sha256)
+        if exists and blob.is_file():
+            _link_over(blob, full)
+        else:
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            _link_over(full, blob)
+        if sha256 != old_sha256:
+            cur.execute("UPDATE files SET sha256 = %s WHERE id = %s", (sha256, file_id))
+            _add_ref(cur, sha256, st.st_size)
+            release(cur, [old_sha256])
+        elif not exists:
+            _add_ref(cur, sha256, st.st_size)  # the blob row was lost; this file is already counted
+        conn.commit()
+        return True
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+
+def _sweep(cur, conn):
+    """Remove unreferenced blob rows, and blob files with no row that are past the grace period"""
+    cur.execute("SELECT sha256 FROM file_blobs WHERE ref_count <= 0")
+    for (sha256,) in cur.fetchall():
+        cur.execute("SELECT ref_count FROM file_blobs WHERE sha256 = %s FOR UPDATE", (sha256,))
+        row = cur.fetchone()
+        if row and row[0] <= 0:
+            blob_path(sha256).unlink(missing_ok=True)
+            cur.execute("DELETE FROM file_blobs WHERE sha256 = %s", (sha256,))
+        conn.commit()
+
+    removed = 0
+    cutoff = time.time() - BLOB_ORPHAN_GRACE
+    for sub in sorted(BLOB_ROOT.glob("??")):
+        names = [p.name for p in sub.iterdir() if not p.name.startswith(".")]
+        known = set()
+        for i in range(0, len(names), _IN_BATCH):
+            batch = names[i:i + _IN_BATCH]
+            cur.execute("SELECT sha256 FROM file_blobs WHERE sha256 IN (%s)" % ", ".join(["%s"] * len(batch)), batch)
+            known.update(row[0] for row in cur.fetchall())
+        for name in names:
+            p = sub / name
+            if name not in known and p.stat().st_ctime < cutoff:
+                p.unlink(missing_ok=True)
+                removed += 1
+    return removed
+
+def reconcile_blobs(progress=None):
+    """Bring blob storage in line with the files table.
+
+    Files stored before deduplication, or replaced by a restore, are hashed and
+    re-linked to the shared copy of their content. Reference counts are then
+    recomputed from files.sha256, and blobs nothing references are removed.
+    Returns a summary string.
+    """
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*) FROM files")
+        total = cur.fetchone()[0]
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+    if progress:
+        progress.set_total(0, total)
+
+    linked = 0
+    for file_id, path, old_sha256 in iter_rows("SELECT id, path, sha256 FROM files ORDER BY id"):
+        if progress:
+            progress.advance(files=1)
+        full = DATA_ROOT / path
+        try:
+            st = os.stat(full)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        if st.st_size < DEDUP_MIN_SIZE:
+            continue
+        if old_sha256:
+            try:
+                blob = os.stat(blob_path(old_sha256))
+                if (blob.st_ino, blob.st_dev) == (st.st_ino, st.st_dev):
+                    continue  # still linked to its blob
+            except FileNotFoundError:
+                pass
+        try:
+            sha256 = hash_file(full)
+            if _adopt(file_id, full, st, old_sha256, sha256):
+                linked += 1
+        except FileNotFoundError:
+            continue
+
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE file_blobs
+            SET ref_count = (SELECT COUNT(*) FROM files WHERE files.sha256 = file_blobs.sha256)
+        """)
+        conn.commit()
+        removed = _sweep(cur, conn)
+        conn.commit()
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+    return f"{linked} files linked to shared copies, {removed} orphaned blobs removed"
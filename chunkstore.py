@@ -0,0 +1,258 @@
+import os, stat, json, gzip, zlib, fcntl, hashlib, random, tarfile, threading, time
+from collections import deque
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from nas.archive import IterReader, stream_tar
+
+BACKUP_ROOT = Path(os.getenv("BACKUP_ROOT","/srv/nas_backups"))
+REPO_ROOT = BACKUP_ROOT / "repo"
+CHUNK_AVG_SIZE = int(os.getenv("CHUNK_AVG_SIZE", str(1024 * 1024)))
+CHUNK_MIN_SIZE = CHUNK_AVG_SIZE // 4
+CHUNK_MAX_SIZE = CHUNK_AVG_SIZE * 4
+CHUNK_WORKERS = int(os.getenv("CHUNK_WORKERS", str(os.cpu_count() or 1)))
+
+# Content-defined boundaries without a per-byte Python loop: every byte maps to
+# a pseudo-random symbol (bytes.translate), and a chunk ends where the last five
+# symbols spell a fixed anchor (bytes.find). Both steps run in C, and a boundary
+# depends only on the bytes just before it, so an insertion moves the chunks
+# around it instead of changing every later one. The alphabet is sized so an
+# anchor turns up every CHUNK_AVG_SIZE - CHUNK_MIN_SIZE bytes on average. Fixed
+# seed so boundaries are stable between runs.
+_ANCHOR_LEN = 5
+_ALPHABET = min(256, max(2, round((CHUNK_AVG_SIZE - CHUNK_MIN_SIZE) ** (1 / _ANCHOR_LEN))))
+_rng = random.Random(0x6e6173)
+_SYMBOLS = bytes(i % _ALPHABET for i in _rng.sample(range(256), 256))  # every symbol equally common
+# Differs at its two ends, so a run of one byte value never matches it
+ANCHOR = bytes([0] + [_rng.randrange(_ALPHABET) for _ in range(_ANCHOR_LEN - 2)] + [_ALPHABET - 1])
+
+def _cut_point(symbols, start, end):
+    """Offset of the next content-defined boundary in symbols[start:end]"""
+    limit = min(end, start + CHUNK_MAX_SIZE)
+    i = start + CHUNK_MIN_SIZE
+    if i >= limit:
+        return limit
+    found = symbols.find(ANCHOR, i, limit)
+    return limit if found < 0 else found + len(ANCHOR)
+
+def iter_chunks(f):
+    """Split a binary stream into content-defined chunks"""
+    buf, symbols, pos = b"", b"", 0
+    eof = False
+    while True:
+        if not eof and len(buf) - pos < CHUNK_MAX_SIZE:
+            more = f.read(CHUNK_MAX_SIZE * 4)
+            eof = not more
+            buf = buf[pos:] + more
+            symbols = buf.translate(_SYMBOLS)
+            pos = 0
+        if pos == len(buf):
+            return
+        if eof or len(buf) - pos >= CHUNK_MAX_SIZE:
+            cut = _cut_point(symbols, pos, len(buf))
+            yield buf[pos:cut]
+            pos = cut
+
+def chunk_path(digest):
+    return REPO_ROOT / "chunks" / digest[:2] / digest
+
+def _store_chunk(data):
+    """Store a chunk once, keyed by its SHA-256; returns (digest, bytes written)"""
+    digest = hashlib.sha256(data).hexdigest()
+    p = chunk_path(digest)
+    if p.exists():
+        return digest, 0
+    p.parent.mkdir(parents=True, exist_ok=True)
+    packed = zlib.compress(data, 6)
+    tmp = p.with_name(f"{digest}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(packed)
+    os.replace(tmp, p)
+    return digest, len(packed)
+
+def read_chunk(digest):
+    with open(chunk_path(digest), "rb") as f:
+        return zlib.decompress(f.read())
+
+@contextmanager
+def repo_lock():
+    """Exclusive lock so garbage collection never races a snapshot"""
+    REPO_ROOT.mkdir(parents=True, exist_ok=True)
+    with open(REPO_ROOT / "lock", "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def _store_file(pool, full):
+    """Chunk a file and store its chunks on the pool, keeping memory bounded"""
+    digests, written = [], 0
+    pending = deque()
+    def collect():
+        nonlocal written
+        digest, n = pending.popleft().result()
+        digests.append(digest)
+        written += n
+    with open(full, "rb") as f:
+        for chunk in iter_chunks(f):
+            pending.append(pool.submit(_store_chunk, chunk))
+            if len(pending) > CHUNK_WORKERS * 2:
+                collect()
+    while pending:
+        collect()
+    return digests, written
+
+def snapshot_path(name):
+    return REPO_ROOT / "snapshots" / f"{name}.ndjson.gz"
+
+def snapshot_exists(name):
+    return snapshot_path(name).is_file()
+
+def snapshot_header(name):
+    """First line of a snapshot index: totals, without reading the entries"""
+    with gzip.open(snapshot_path(name), "rt", encoding="utf-8") as f:
+        return json.loads(f.readline())
+
+def iter_snapshot(name):
+    """Yield the file and directory entries of a snapshot index"""
+    with gzip.open(snapshot_path(name), "rt", encoding="utf-8") as f:
+        f.readline()
+        for line in f:
+            yield json.loads(line)
+
+def create_snapshot(name, data_root, previous=None, skip_dirs=(), progress=None):
+    """Store data_root as a deduplicated snapshot.
+
+    Files whose size, mtime and inode match the previous snapshot reuse its
+    chunk list without being read. Returns the snapshot header.
+    """
+    data_root = Path(data_root)
+    entries = []
+    totals = {'logical_bytes': 0, 'stored_bytes': 0, 'file_count': 0}
+    with repo_lock(), ThreadPoolExecutor(max_workers=max(1, CHUNK_WORKERS)) as pool:
+        prior = {}
+        if previous and snapshot_exists(previous):
+            prior = {e['path']: e for e in iter_snapshot(previous) if 'path' in e}
+
+        for root, dirnames, filenames in os.walk(data_root):
+            rel_root = os.path.relpath(root, data_root)
+            rel_root = "" if rel_root == "." else rel_root
+            if not rel_root:
+                dirnames[:] = [d for d in dirnames if d not in skip_dirs]
+            dirnames.sort()
+            for d in dirnames:
+                entries.append({'dir': os.path.join(rel_root, d)})
+            for fname in sorted(filenames):
+                rel = os.path.join(rel_root, fname)
+                full = os.path.join(root, fname)
+                try:
+                    st = os.lstat(full)
+                except FileNotFoundError:
+                    continue
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                entry = {'path': rel, 'size': st.st_size, 'mtime': st.st_mtime_ns, 'inode': st.st_ino}
+                old = prior.get(rel)
+                if old and (old['size'], old['mtime'], old['inode']) == (st.st_size, st.st_mtime_ns, st.st_ino):
+                    entry['chunks'] = old['chunks']
+                else:
+                    try:
+                        entry['chunks'], written = _store_file(pool, full)
+                    except FileNotFoundError:
+                        continue
+                    totals['stored_bytes'] += written
+                totals['logical_bytes'] += st.st_size
+                totals['file_count'] += 1
+                entries.append(entry)
+                if progress:
+                    progress.advance(st.st_size, 1)
+
+        header = dict({'version': 1, 'name': name, 'created': time.strftime("%Y%m%d_%H%M%S")}, **totals)
+        p = snapshot_path(name)
+        p.parent.mkdir(parents=True, exist_ok=True)
+        tmp = p.with_name(p.name + ".tmp")
+        with gzip.open(tmp, "wt", encoding="utf-8") as f:
+            f.write(json.dumps(header) + "\n")
+            for entry in entries:
+                f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        os.replace(tmp, p)
+    return header
+
+def restore_snapshot(name, data_root, progress=None):
+    """Write a snapshot's files back into data_root (temp file + atomic rename).
+
+    Files whose size and mtime already match the snapshot are left alone.
+    Returns (files restored, files skipped).
+    """
+    data_root = Path(data_root)
+    restored = skipped = 0
+    if progress:
+        header = snapshot_header(name)
+        progress.set_total(header['logical_bytes'], header['file_count'])
+    for entry in iter_snapshot(name):
+        if 'dir' in entry:
+            (data_root / entry['dir']).mkdir(parents=True, exist_ok=True)
+            continue
+        dest = data_root / entry['path']
+        mtime = entry['mtime']
+        try:
+            st = os.stat(dest)
+            if st.st_size == entry['size'] and st.st_mtime_ns == mtime:
+                skipped += 1
+                if progress:
+                    progress.advance(entry['size'], 1)
+                continue
+        except FileNotFoundError:
+            pass
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dest.with_name(f".{dest.name}.{os.getpid()}.restore")
+        try:
+            with open(tmp, "wb") as f:
+                for digest in entry['chunks']:
+                    f.write(read_chunk(digest))
+            os.utime(tmp, ns=(mtime, mtime))
+            os.replace(tmp, dest)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        restored += 1
+        if progress:
+            progress.advance(entry['size'], 1)
+    return restored, skipped
+
+def stream_snapshot_tar(name, arcroot="nas_data"):
+    """Generate an uncompressed tar of a snapshot, chunk by chunk, with no temp file"""
+    def members():
+        for entry in iter_snapshot(name):
+            if 'dir' in entry:
+                info = tarfile.TarInfo(f"{arcroot}/{entry['dir']}")
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                yield info, None
+            else:
+                info = tarfile.TarInfo(f"{arcroot}/{entry['path']}")
+                info.size = entry['size']
+                info.mtime = entry['mtime'] // 1_000_000_000
+                info.mode = 0o644
+                yield info, IterReader(read_chunk(d) for d in entry['chunks'])
+    return stream_tar(members())
+
+def delete_snapshot(name):
+    """Remove a snapshot and garbage-collect chunks no other snapshot uses.
+
+    Returns (chunks removed, bytes freed).
+    """
+    with repo_lock():
+        snapshot_path(name).unlink(missing_ok=True)
+        live = set()
+        for p in (REPO_ROOT / "snapshots").glob("*.ndjson.gz"):
+            for entry in iter_snapshot(p.name[:-len(".ndjson.gz")]):
+                live.update(entry.get('chunks', ()))
+        removed = freed = 0
+        for p in (REPO_ROOT / "chunks").glob("*/*"):
+            if p.name not in live:
+                freed += p.stat().st_size
+                p.unlink()
+                removed += 1
+        return removed, freed
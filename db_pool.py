@@ -0,0 +1,286 @@
+import os, threading, time
+from collections import deque
+from flask import g, has_app_context
+from nas.__init__ import files_bp, backup_bp
+from app import get_db as connect
+from nas.metrics import TimedCursor, Collected
+
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+POOL_MAX_OVERFLOW = int(os.getenv("DB_POOL_MAX_OVERFLOW", "10"))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+POOL_RECYCLE = float(os.getenv("DB_POOL_RECYCLE", "3600"))
+POOL_PING_INTERVAL = float(os.getenv("DB_POOL_PING_INTERVAL", "30"))
+STREAM_BATCH_SIZE = int(os.getenv("DB_STREAM_BATCH_SIZE", "1000"))
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available within the pool timeout"""
+
+class PooledConnection:
+    """Proxy around a raw connection; close() hands it back to the pool"""
+
+    def __init__(self, pool, raw, created_at):
+        self._pool = pool
+        self._raw = raw
+        self._created_at = created_at
+        self._checked_out_at = time.monotonic()
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def cursor(self, *args, **kwargs):
+        return TimedCursor(self._raw.cursor(*args, **kwargs))
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            self._pool.checkin(self)
+
+class RequestConnection:
+    """View of the per-request connection; close() is a no-op until teardown"""
+
+    def __init__(self, lease):
+        self._lease = lease
+
+    def __getattr__(self, name):
+        return getattr(self._lease, name)
+
+    def close(self):
+        pass
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of warm database connections"""
+
+    def __init__(self, connect, size=POOL_SIZE, max_overflow=POOL_MAX_OVERFLOW,
+                 timeout=POOL_TIMEOUT, recycle=POOL_RECYCLE,
+                 ping_interval=POOL_PING_INTERVAL):
+        self._connect = connect
+        self.size = size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_interval = ping_interval
+        self._idle = deque()  # (raw, created_at, last_used)
+        self._open = 0
+        self._cond = threading.Condition()
+        self._stats = {
+            'checkouts': 0,
+            'checkins': 0,
+            'created': 0,
+            'discarded': 0,
+            'timeouts': 0,
+            'waits': 0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0,
+            'held_seconds_total': 0.0,
+        }
+
+    def checkout(self):
+        """Borrow a healthy connection, waiting up to the pool timeout"""
+        start = time.monotonic()
+        deadline = start + self.timeout
+        waited = False
+        with self._cond:
+            while True:
+                if self._idle:
+                    raw, created_at, last_used = self._idle.pop()
+                    break
+                if self._open < self.size + self.max_overflow:
+                    self._open += 1
+                    raw = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout(
+                        f"No database connection available after {self.timeout}s")
+                waited = True
+                self._cond.wait(remaining)
+
+            wait = time.monotonic() - start
+            self._stats['checkouts'] += 1
+            if waited:
+                self._stats['waits'] += 1
+            self._stats['wait_seconds_total'] += wait
+            self._stats['wait_seconds_max'] = max(self._stats['wait_seconds_max'], wait)
+
+        try:
+            if raw is None:
+                raw, created_at = self._create()
+            else:
+                raw, created_at = self._revalidate(raw, created_at, last_used)
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+        return PooledConnection(self, raw, created_at)
+
+    def checkin(self, conn):
+        """Return a connection to the pool, discarding it if it is unusable"""
+        raw = conn._raw
+        held = time.monotonic() - conn._checked_out_at
+        healthy = True
+        try:
+            # End any transaction the borrower left open so the next one
+            # starts from a clean snapshot.
+            raw.rollback()
+        except Exception:
+            healthy = False
+
+        with self._cond:
+            self._stats['checkins'] += 1
+            self._stats['held_seconds_total'] += held
+            if healthy and len(self._idle) < self.size:
+                self._idle.append((raw, conn._created_at, time.monotonic()))
+                raw = None
+            else:
+                self._open -= 1
+                self._stats['discarded'] += 1
+            self._cond.notify()
+
+        if raw is not None:
+            self._close_raw(raw)
+
+    def stats(self):
+        """Snapshot of pool gauges and counters"""
+        with self._cond:
+            data = dict(self._stats)
+            data.update({
+                'size': self.size,
+                'max_overflow': self.max_overflow,
+                'limit': self.size + self.max_overflow,
+                'open': self._open,
+                'idle': len(self._idle),
+                'in_use': self._open - len(self._idle),
+            })
+        return data
+
+    def _create(self):
+        raw = self._connect()
+        with self._cond:
+            self._stats['created'] += 1
+        return raw, time.monotonic()
+
+    def _revalidate(self, raw, created_at, last_used):
+        now = time.monotonic()
+        if self.recycle and now - created_at > self.recycle:
+            self._discard(raw)
+            return self._create()
+        if now - last_used > self.ping_interval and not self._ping(raw):
+            self._discard(raw)
+            return self._create()
+        return raw, created_at
+
+    def _ping(self, raw):
+        try:
+            if hasattr(raw, "ping"):
+                raw.ping()
+            else:
+                cur = raw.cursor()
+                cur.execute("SELECT 1")
+                cur.fetchall()
+                cur.close()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, raw):
+        with self._cond:
+            self._stats['discarded'] += 1
+        self._close_raw(raw)
+
+    def _close_raw(self, raw):
+        try:
+            raw.close()
+        except Exception:
+            pass
+
+pool = ConnectionPool(connect)
+
+def _pool_metric(name, help, kind, key):
+    Collected(name, help, kind, lambda: {(): pool.stats()[key]})
+
+_pool_metric("nas_db_pool_connections_open", "Pooled connections open, idle or in use", "gauge", 'open')
+_pool_metric("nas_db_pool_connections_in_use", "Pooled connections checked out", "gauge", 'in_use')
+_pool_metric("nas_db_pool_connections_max", "Most connections the pool will open", "gauge", 'limit')
+_pool_metric("nas_db_pool_checkouts_total", "Connections handed out", "counter", 'checkouts')
+_pool_metric("nas_db_pool_waits_total", "Checkouts that had to wait for a free connection", "counter", 'waits')
+_pool_metric("nas_db_pool_timeouts_total", "Checkouts that gave up because the pool was exhausted",
+             "counter", 'timeouts')
+_pool_metric("nas_db_pool_wait_seconds_total", "Time spent waiting for a connection", "counter",
+             'wait_seconds_total')
+_pool_metric("nas_db_pool_wait_seconds_max", "Longest wait for a connection", "gauge", 'wait_seconds_max')
+_pool_metric("nas_db_pool_held_seconds_total", "Time connections spent checked out", "counter",
+             'held_seconds_total')
+_pool_metric("nas_db_pool_connections_created_total", "Connections opened", "counter", 'created')
+_pool_metric("nas_db_pool_connections_discarded_total", "Connections closed as stale or surplus",
+             "counter", 'discarded')
+
+def get_db():
+    """Get a pooled connection.
+
+    Inside an app/request context every caller shares one connection that is
+    returned to the pool at teardown; elsewhere close() returns it directly.
+    """
+    if not has_app_context():
+        return pool.checkout()
+    lease = g.get("_nas_db")
+    if lease is None:
+        lease = pool.checkout()
+        g._nas_db = lease
+    return RequestConnection(lease)
+
+def _server_side_cursor(raw):
+    """Cursor that reads rows from the server as they are fetched, not all at once"""
+    module = type(raw).__module__
+    if module.startswith("pymysql"):
+        import pymysql.cursors
+        return raw.cursor(pymysql.cursors.SSCursor)
+    if module.startswith("MySQLdb"):
+        import MySQLdb.cursors
+        return raw.cursor(MySQLdb.cursors.SSCursor)
+    if module.startswith("mysql.connector"):
+        return raw.cursor(buffered=False)
+    return raw.cursor()
+
+def iter_rows(sql, params=(), batch_size=None, stream=False):
+    """Yield the rows of a query from a server-side cursor.
+    
+    Memory use is one batch of rows however large the result. By default the
+    rows are read on get_db()'s connection, so inside a request they must be
+    consumed before it ends, with no other query on that connection until
+    they are. stream=True is for a response body that is still being
+    generated after teardown: it checks out a pooled connection of its own
+    and holds it until the body is finished, so every such stream in flight
+    costs one connection from the pool.
+    """
+    batch_size = batch_size or STREAM_BATCH_SIZE
+    conn = pool.checkout() if stream else get_db()
+    try:
+        cur = TimedCursor(_server_side_cursor(conn._raw))
+        try:
+            cur.execute(sql, params)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cur.close()
+    finally:
+        conn.close()
+
+def release_db(exc=None):
+    """Return the per-request connection to the pool"""
+    lease = g.pop("_nas_db", None)
+    if lease is not None:
+        lease.close()
+
+def _register_teardown(state):
+    if not state.app.extensions.get("nas_db_pool"):
+        state.app.extensions["nas_db_pool"] = pool
+        state.app.teardown_appcontext(release_db)
+
+files_bp.record_once(_register_teardown)
+backup_bp.record_once(_register_teardown)
@@ -0,0 +1,204 @@
+import os, time, threading
+from collections import OrderedDict
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+DIRCACHE_SIZE = int(os.getenv("DIRCACHE_SIZE", "256"))
+DIRCACHE_TTL = float(os.getenv("DIRCACHE_TTL", "30"))
+DIRCACHE_INOTIFY = os.getenv("DIRCACHE_INOTIFY", "1") == "1"
+
+def entry_stat(entry):
+    """(size, mtime) of a cached os.DirEntry; its stat() result is kept on the entry"""
+    try:
+        st = entry.stat()
+        return st.st_size, st.st_mtime
+    except OSError:
+        return 0, 0.0  # broken symlink or entry removed since the scan
+
+SORT_KEYS = {
+    'name': lambda e: e.name,
+    'size': lambda e: entry_stat(e)[0],
+    'mtime': lambda e: entry_stat(e)[1],
+}
+
+class Listing:
+    """One directory read: os.DirEntry objects plus memoized sorted views"""
+
+    __slots__ = ("entries", "dir_mtime", "loaded_at", "watched", "_views")
+
+    def __init__(self, entries, dir_mtime, watched):
+        self.entries = entries
+        self.dir_mtime = dir_mtime
+        self.loaded_at = time.monotonic()
+        self.watched = watched
+        self._views = {}
+
+    def sorted(self, sort="name", reverse=False):
+        """Entries with directories first, each group ordered by sort (name, size or mtime)"""
+        view = self._views.get((sort, reverse))
+        if view is None:
+            key = SORT_KEYS.get(sort, SORT_KEYS['name'])
+            dirs = sorted((e for e in self.entries if _is_dir(e)), key=key, reverse=reverse)
+            files = sorted((e for e in self.entries if not _is_dir(e)), key=key, reverse=reverse)
+            view = self._views[(sort, reverse)] = dirs + files
+        return view
+
+def _is_dir(entry):
+    try:
+        return entry.is_dir()
+    except OSError:
+        return False
+
+class _Watcher:
+    """inotify watches on cached directories; any change drops the cached listing"""
+
+    def __init__(self, on_change):
+        flags = inotify_simple.flags
+        self.mask = (flags.CREATE | flags.DELETE | flags.MODIFY | flags.ATTRIB | flags.CLOSE_WRITE |
+                     flags.MOVED_FROM | flags.MOVED_TO | flags.DELETE_SELF | flags.MOVE_SELF)
+        self._ignored = flags.IGNORED
+        self._inotify = inotify_simple.INotify()
+        self._on_change = on_change
+        self._lock = threading.Lock()
+        self._paths = {}  # wd -> path
+        self._wds = {}    # path -> wd
+        threading.Thread(target=self._run, name="dircache-inotify", daemon=True).start()
+
+    def watch(self, path):
+        """Start watching path; False if inotify refuses (e.g. out of watches)"""
+        with self._lock:
+            if path in self._wds:
+                return True
+            try:
+                wd = self._inotify.add_watch(path, self.mask)
+            except OSError:
+                return False
+            # A directory moved since it was watched keeps its wd under the old path
+            moved = self._paths.get(wd)
+            if moved is not None:
+                self._wds.pop(moved, None)
+            self._paths[wd] = path
+            self._wds[path] = wd
+            return True
+
+    def unwatch(self, path):
+        with self._lock:
+            wd = self._wds.pop(path, None)
+            if wd is None:
+                return
+            self._paths.pop(wd, None)
+        try:
+            self._inotify.rm_watch(wd)
+        except OSError:
+            pass
+
+    def _run(self):
+        while True:
+            for event in self._inotify.read():
+                with self._lock:
+                    path = self._paths.get(event.wd)
+                    if path is not None and event.mask & self._ignored:
+                        # The directory itself went away; its watch is gone
+                        del self._paths[event.wd]
+                        self._wds.pop(path, None)
+                if path is not None:
+                    self._on_change(path)
+
+class DirectoryCache:
+    """LRU of directory listings keyed by absolute path.
+
+    A listing is reused while the directory's own mtime is unchanged (one
+    stat instead of one per entry). Directories watched with inotify are
+    also dropped on any change inside them, including size and mtime
+    changes of existing files. Unwatched ones (no inotify_simple, or out of
+    watches) are re-read after DIRCACHE_TTL seconds.
+    """
+
+    def __init__(self, maxsize=DIRCACHE_SIZE, ttl=DIRCACHE_TTL, use_inotify=DIRCACHE_INOTIFY):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # path -> Listing
+        self._generation = 0        # bumped on every invalidation, to drop reads that raced one
+        self._lock = threading.Lock()
+        self._watcher = None
+        self._use_inotify = use_inotify and inotify_simple is not None
+        self.hits = 0
+        self.misses = 0
+
+    def _get_watcher(self):
+        if self._watcher is None and self._use_inotify:
+            with self._lock:
+                if self._watcher is None:
+                    try:
+                        self._watcher = _Watcher(self.invalidate)
+                    except OSError as e:
+                        print(f"Error starting inotify, falling back to mtime checks: {e}")
+                        self._use_inotify = False
+        return self._watcher
+
+    def listing(self, path):
+        """Current Listing for a directory, reading it only when it may have changed"""
+        path = os.fspath(path)
+        dir_mtime = os.stat(path).st_mtime_ns
+        now = time.monotonic()
+        with self._lock:
+            cached = self._data.get(path)
+            if (cached is not None and cached.dir_mtime == dir_mtime
+                    and (cached.watched or now - cached.loaded_at < self.ttl)):
+                self._data.move_to_end(path)
+                self.hits += 1
+                return cached
+            self.misses += 1
+            generation = self._generation
+
+        # Watch before reading so a change during the scan is not missed
+        watcher = self._get_watcher()
+        watched = watcher.watch(path) if watcher else False
+        with os.scandir(path) as it:
+            entries = list(it)
+        fresh = Listing(entries, dir_mtime, watched)
+
+        evicted = []
+        with self._lock:
+            if self._generation == generation:
+                self._data[path] = fresh
+                self._data.move_to_end(path)
+                while len(self._data) > self.maxsize:
+                    evicted.append(self._data.popitem(last=False)[0])
+        if watcher:
+            for old in evicted:
+                watcher.unwatch(old)
+        return fresh
+
+    def invalidate(self, path):
+        """Forget a directory's listing (called by inotify and after our own writes)"""
+        path = os.fspath(path)
+        with self._lock:
+            self._generation += 1
+            self._data.pop(path, None)
+
+    def invalidate_tree(self, path):
+        """Forget a directory and every cached directory below it, e.g. after a move"""
+        path = os.fspath(path)
+        prefix = os.path.join(path, "")
+        with self._lock:
+            self._generation += 1
+            gone = [p for p in self._data if p == path or p.startswith(prefix)]
+            for p in gone:
+                del self._data[p]
+        if self._watcher:
+            for p in gone:
+                self._watcher.unwatch(p)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._data),
+            'inotify': self._watcher is not None,
+        }
+
+dir_cache = DirectoryCache()
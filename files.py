@@ -1,13 +1,37 @@
-import os
+import os, re, json, uuid, fcntl, base64, shutil, hashlib, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from pathlib import Path
-from flask import render_template, request, redirect, url_for, flash, send_file, jsonify
+from flask import render_template, request, redirect, url_for, flash, jsonify, Response
 from flask_login import login_required, current_user
 from werkzeug.utils import secure_filename
 from nas.__init__ import files_bp
 from nas.permissions import perm_required
-from app import get_db
+from nas.db_pool import get_db, iter_rows
+from nas.acl_cache import acl_cache, MISS
+from nas.transfer import send_file_ranged, send_stream
+from nas.archive import stream_zip
+from nas.metrics import timed, count_bytes
+from nas.dircache import dir_cache, entry_stat
+from nas.search import (index_file, candidates_clause, rank, reindex_all,
+                        SEARCH_MIN_QUERY, SEARCH_PAGE_SIZE, SEARCH_MAX_CANDIDATES)
+from nas.quota import quota_status, fits, format_size, charge, release, set_quota, usage_report, reconcile_usage
+from nas import jobs, blobstore
 
 DATA_ROOT = Path(os.getenv("DATA_ROOT","/srv/nas_data")).resolve()
+SNAPSHOT_DIR = DATA_ROOT / ".snapshots"  # pre-restore snapshots, see nas/snapshot.py
+MY_FILES_PAGE_SIZE = int(os.getenv("MY_FILES_PAGE_SIZE", "100"))
+FOLDER_PAGE_SIZE = int(os.getenv("FOLDER_PAGE_SIZE", "200"))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", str(min(8, os.cpu_count() or 1))))
+
+# my_files sort orders: name -> (column, direction); ties are broken by f.id
+FILE_SORTS = {
+    'newest': ("f.created_at", "DESC"),
+    'oldest': ("f.created_at", "ASC"),
+    'path': ("f.path", "ASC"),
+    'path_desc': ("f.path", "DESC"),
+}
 
 def safe_join(rel=""):
     """Safely join paths to prevent directory traversal"""
@@ -18,6 +42,11 @@ def safe_join(rel=""):
 
 def get_file_metadata(rel_path):
     """Get file metadata from database including owner and permissions"""
+    cached = acl_cache.get_metadata(rel_path)
+    if cached is not MISS:
+        return cached
+    
+    generation = acl_cache.generation()
     try:
         conn = get_db()
         cur = conn.cursor()
@@ -28,13 +57,16 @@ def get_file_metadata(rel_path):
             WHERE f.path = %s
         """, (rel_path,))
         row = cur.fetchone()
+        metadata = None
         if row:
-            return {
+            metadata = {
                 'id': row[0],
                 'owner_id': row[1],
                 'owner_name': row[2],
                 'created_at': row[3]
             }
+        acl_cache.set_metadata(rel_path, metadata, generation)
+        return metadata
     except Exception as e:
         print(f"Error getting file metadata: {e}")
     finally:
@@ -45,106 +77,225 @@ def get_file_metadata(rel_path):
             pass
     return None
 
-def get_file_permissions(file_id, user_id):
-    """Check if user has permission to access a file"""
+def authorize_file(rel_path, user_id, is_admin_user=False):
+    """Resolve a file's metadata and the user's permissions in one query.
+    
+    Returns None if the path is not recorded in the files table.
+    """
+    auth = acl_cache.get_perms(user_id, rel_path)
+    if auth is MISS:
+        generation = acl_cache.generation()
+        try:
+            conn = get_db()
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT f.id, f.owner_id, u.username, f.created_at,
+                       COALESCE(fp.can_read, 0), COALESCE(fp.can_write, 0)
+                FROM files f
+                JOIN users u ON f.owner_id = u.id
+                LEFT JOIN file_permissions fp ON fp.file_id = f.id AND fp.user_id = %s
+                WHERE f.path = %s
+            """, (user_id, rel_path))
+            row = cur.fetchone()
+            auth = None
+            if row:
+                is_owner = row[1] == user_id
+                auth = {
+                    'id': row[0],
+                    'owner_id': row[1],
+                    'owner_name': row[2],
+                    'created_at': row[3],
+                    'can_read': is_owner or bool(row[4]),
+                    'can_write': is_owner or bool(row[5]),
+                    'can_delete': is_owner,
+                    'is_owner': is_owner
+                }
+            acl_cache.set_perms(user_id, rel_path, auth, generation)
+        except Exception as e:
+            print(f"Error authorizing file access: {e}")
+            return None
+        finally:
+            try:
+                cur.close()
+                conn.close()
+            except:
+                pass
+    
+    if auth and is_admin_user:
+        # Admin has full rights; applied here so role changes never go stale in the cache
+        auth = dict(auth, can_read=True, can_write=True, can_delete=True)
+    return auth
+
+def is_admin(user):
+    """Check if user has admin role"""
+    return hasattr(user, 'role') and user.role == 'admin'
+
+def dir_key(rel=""):
+    """Normalized directory key as stored in files.parent_dir ('' for the root)"""
+    key = str(Path(rel)) if rel else ""
+    return "" if key == "." else key
+
+def _accessible_files_query(user_id, is_admin_user, where="", params=(),
+                            order="f.created_at DESC", limit=None):
+    """Build the accessible-files SELECT, optionally narrowed by an extra WHERE clause"""
+    if limit is not None:
+        order += " LIMIT %d" % int(limit)
+    if is_admin_user:
+        # Admin can see all files
+        sql = """
+            SELECT f.id, f.path, f.owner_id, u.username, f.created_at
+            FROM files f
+            JOIN users u ON f.owner_id = u.id
+        """
+        if where:
+            sql += " WHERE " + where
+        return sql + " ORDER BY " + order, tuple(params)
+    
+    # Regular users see their own files + shared files
+    sql = """
+        SELECT DISTINCT f.id, f.path, f.owner_id, u.username, f.created_at,
+               CASE WHEN f.owner_id = %s THEN 1 ELSE 0 END as is_owner,
+               COALESCE(fp.can_read, 0) as can_read,
+               COALESCE(fp.can_write, 0) as can_write
+        FROM files f
+        JOIN users u ON f.owner_id = u.id
+        LEFT JOIN file_permissions fp ON f.id = fp.file_id AND fp.user_id = %s
+        WHERE (f.owner_id = %s OR fp.user_id = %s)
+    """
+    if where:
+        sql += " AND " + where
+    return (sql + " ORDER BY " + order,
+            (user_id, user_id, user_id, user_id) + tuple(params))
+
+class FileInfo:
+    """One accessible file as used by the templates.
+    
+    Slotted rather than a dict: an admin listing can hold millions of these.
+    """
+    
+    __slots__ = ("id", "path", "owner_id", "owner_name", "created_at",
+                 "can_read", "can_write", "can_delete", "is_owner")
+    
+    def __init__(self, id, path, owner_id, owner_name, created_at,
+                 can_read, can_write, can_delete, is_owner):
+        self.id = id
+        self.path = path
+        self.owner_id = owner_id
+        self.owner_name = owner_name
+        self.created_at = created_at
+        self.can_read = can_read
+        self.can_write = can_write
+        self.can_delete = can_delete
+        self.is_owner = is_owner
+    
+    def as_dict(self):
+        """JSON-ready dict, with created_at as an ISO string"""
+        info = {name: getattr(self, name) for name in self.__slots__}
+        if isinstance(self.created_at, datetime):
+            info['created_at'] = self.created_at.isoformat()
+        return info
+
+def _file_from_row(row, is_admin_user):
+    """Convert an accessible-files row into a FileInfo"""
+    if is_admin_user:
+        return FileInfo(row[0], row[1], row[2], row[3], row[4], True, True, True, False)
+    is_owner = bool(row[5])
+    return FileInfo(row[0], row[1], row[2], row[3], row[4],
+                    is_owner or bool(row[6]), is_owner or bool(row[7]), is_owner, is_owner)
+
+def _like_prefix(text):
+    """LIKE pattern matching strings that start with text"""
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+def _file_filters(owner="", path=""):
+    """WHERE clause and params for the owner / path-prefix filters"""
+    clauses, params = [], []
+    if owner:
+        clauses.append("u.username = %s")
+        params.append(owner)
+    if path:
+        clauses.append("f.path LIKE %s")
+        params.append(_like_prefix(path.strip("/")))
+    return clauses, params
+
+def encode_cursor(sort, file_info):
+    """Opaque keyset token for the row a page ended on"""
+    column = FILE_SORTS[sort][0]
+    value = file_info.created_at if column == "f.created_at" else file_info.path
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    token = json.dumps([sort, value, file_info.id]).encode("utf-8")
+    return base64.urlsafe_b64encode(token).decode("ascii")
+
+def decode_cursor(sort, token):
+    """(value, id) from a keyset token, or None if it is invalid or for another sort"""
+    try:
+        token_sort, value, file_id = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+        if token_sort != sort:
+            return None
+        if FILE_SORTS[sort][0] == "f.created_at" and value is not None:
+            value = datetime.fromisoformat(value)
+        return value, int(file_id)
+    except Exception:
+        return None
+
+def _file_listing_query(user_id, is_admin_user, sort="newest", owner="", path="", after=None, limit=None):
+    """Accessible-files query with filters, a (sort column, id) order and keyset cursor"""
+    column, direction = FILE_SORTS.get(sort, FILE_SORTS['newest'])
+    clauses, params = _file_filters(owner, path)
+    if after is not None:
+        # Rows strictly after the cursor in (column, id) order
+        op = "<" if direction == "DESC" else ">"
+        clauses.append(f"({column} {op} %s OR ({column} = %s AND f.id {op} %s))")
+        params.extend([after[0], after[0], after[1]])
+    order = f"{column} {direction}, f.id {direction}"
+    return _accessible_files_query(user_id, is_admin_user, " AND ".join(clauses), params,
+                                   order=order, limit=limit)
+
+def get_accessible_files_page(user_id, is_admin_user, sort="newest", owner="", path="",
+                              cursor=None, limit=None):
+    """One page of accessible files, keyset-paginated on (sort column, id).
+    
+    Returns (files, next_cursor); next_cursor is None on the last page.
+    """
+    if sort not in FILE_SORTS:
+        sort = "newest"
+    limit = limit or MY_FILES_PAGE_SIZE
+    after = decode_cursor(sort, cursor) if cursor else None
     try:
         conn = get_db()
         cur = conn.cursor()
-        
-        # Check if user is file owner
-        cur.execute("SELECT owner_id FROM files WHERE id = %s", (file_id,))
-        row = cur.fetchone()
-        if row and row[0] == user_id:
-            return {'can_read': True, 'can_write': True, 'can_delete': True, 'is_owner': True}
-        
-        # Check shared permissions
-        cur.execute("""
-            SELECT can_read, can_write
-            FROM file_permissions
-            WHERE file_id = %s AND user_id = %s
-        """, (file_id, user_id))
-        row = cur.fetchone()
-        if row:
-            return {
-                'can_read': bool(row[0]), 
-                'can_write': bool(row[1]), 
-                'can_delete': False,
-                'is_owner': False
-            }
+        cur.execute(*_file_listing_query(user_id, is_admin_user, sort, owner, path, after, limit + 1))
+        files = [_file_from_row(row, is_admin_user) for row in cur.fetchall()]
     except Exception as e:
-        print(f"Error checking file permissions: {e}")
+        print(f"Error getting accessible files: {e}")
+        return [], None
     finally:
         try:
             cur.close()
             conn.close()
         except:
             pass
-    return {'can_read': False, 'can_write': False, 'can_delete': False, 'is_owner': False}
+    if len(files) > limit:
+        files = files[:limit]
+        return files, encode_cursor(sort, files[-1])
+    return files, None
 
-def is_admin(user):
-    """Check if user has admin role"""
-    return hasattr(user, 'role') and user.role == 'admin'
-
-def get_user_accessible_files(user_id, is_admin_user):
-    """Get all files that a user can access (own or shared)"""
+def get_directory_files(user_id, is_admin_user, rel=""):
+    """Get the accessible files directly inside one directory, keyed by path"""
     try:
         conn = get_db()
         cur = conn.cursor()
-        
-        if is_admin_user:
-            # Admin can see all files
-            cur.execute("""
-                SELECT f.id, f.path, f.owner_id, u.username, f.created_at
-                FROM files f
-                JOIN users u ON f.owner_id = u.id
-                ORDER BY f.created_at DESC
-            """)
-        else:
-            # Regular users see their own files + shared files
-            cur.execute("""
-                SELECT DISTINCT f.id, f.path, f.owner_id, u.username, f.created_at,
-                       CASE WHEN f.owner_id = %s THEN 1 ELSE 0 END as is_owner,
-                       COALESCE(fp.can_read, 0) as can_read,
-                       COALESCE(fp.can_write, 0) as can_write
-                FROM files f
-                JOIN users u ON f.owner_id = u.id
-                LEFT JOIN file_permissions fp ON f.id = fp.file_id AND fp.user_id = %s
-                WHERE f.owner_id = %s OR fp.user_id = %s
-                ORDER BY f.created_at DESC
-            """, (user_id, user_id, user_id, user_id))
-        
-        files_list = []
-        for row in cur.fetchall():
-            if is_admin_user:
-                files_list.append({
-                    'id': row[0],
-                    'path': row[1],
-                    'owner_id': row[2],
-                    'owner_name': row[3],
-                    'created_at': row[4],
-                    'can_read': True,
-                    'can_write': True,
-                    'can_delete': True,
-                    'is_owner': False
-                })
-            else:
-                is_owner = bool(row[5])
-                files_list.append({
-                    'id': row[0],
-                    'path': row[1],
-                    'owner_id': row[2],
-                    'owner_name': row[3],
-                    'created_at': row[4],
-                    'can_read': is_owner or bool(row[6]),
-                    'can_write': is_owner or bool(row[7]),
-                    'can_delete': is_owner,
-                    'is_owner': is_owner
-                })
-        
-        return files_list
+        cur.execute(*_accessible_files_query(
+            user_id, is_admin_user, "f.parent_dir = %s", (dir_key(rel),)))
+        files_map = {}
+        for row in cur:
+            file_info = _file_from_row(row, is_admin_user)
+            files_map[file_info.path] = file_info
+        return files_map
     except Exception as e:
-        print(f"Error getting accessible files: {e}")
-        return []
+        print(f"Error getting directory files: {e}")
+        return {}
     finally:
         try:
             cur.close()
@@ -160,23 +311,39 @@ def index():
     base = safe_join(rel)
     base.mkdir(parents=True, exist_ok=True)
     
-    # Get all accessible files from database
-    accessible_files = get_user_accessible_files(
+    # Get accessible files in this directory only (indexed by files.parent_dir)
+    file_perms_map = get_directory_files(
         int(current_user.id), 
-        is_admin(current_user)
+        is_admin(current_user),
+        rel
     )
     
-    # Create a map of file paths to permissions
-    file_perms_map = {f['path']: f for f in accessible_files}
+    sort = request.args.get("sort", "name")
+    order = request.args.get("order", "asc")
+    page = max(1, request.args.get("page", 1, type=int))
     
-    items = []
+    # One cached scandir pass per folder; directories first, then files
+    visible = []
+    with timed("fs", "listdir"):
+        listing = dir_cache.listing(base).sorted(sort, reverse=order == "desc")
+    for entry in listing:
+        if base / entry.name in (UPLOAD_TMP, TRASH_DIR, SNAPSHOT_DIR, blobstore.BLOB_ROOT):
+            continue  # chunked-upload staging area, pending deletes, restore snapshots and shared file contents
+        rel_path = str((Path(rel)/entry.name) if rel else Path(entry.name))
+        # Always show directories; only show files the user has access to
+        if entry.is_dir() or rel_path in file_perms_map:
+            visible.append((entry, rel_path))
     
-    for name in sorted(os.listdir(base)):
-        fp = base / name
-        rel_path = str((Path(rel)/name) if rel else Path(name))
-        
-        # Always show directories
-        if fp.is_dir():
+    pages = max(1, -(-len(visible) // FOLDER_PAGE_SIZE))
+    page = min(page, pages)
+    start = (page - 1) * FOLDER_PAGE_SIZE
+    
+    items = []
+    with timed("fs", "stat"):
+        page_entries = [(entry, rel_path, entry_stat(entry)) for entry, rel_path in visible[start:start + FOLDER_PAGE_SIZE]]
+    for entry, rel_path, (size, mtime) in page_entries:
+        name = entry.name
+        if entry.is_dir():
             items.append({
                 "name": name, 
                 "is_dir": True,
@@ -184,44 +351,234 @@ def index():
                 "owner": None,
                 "can_write": True,  # Can navigate into directories
                 "can_delete": False,
-                "is_owner": False
+                "is_owner": False,
+                "mtime": datetime.fromtimestamp(mtime)
             })
         else:
-            # Only show files the user has access to
-            if rel_path in file_perms_map:
-                file_info = file_perms_map[rel_path]
-                items.append({
-                    "name": name,
-                    "is_dir": False,
-                    "rel": rel_path,
-                    "file_id": file_info['id'],
-                    "owner": file_info['owner_name'],
-                    "can_read": file_info['can_read'],
-                    "can_write": file_info['can_write'],
-                    "can_delete": file_info['can_delete'],
-                    "is_owner": file_info['is_owner']
-                })
+            file_info = file_perms_map[rel_path]
+            items.append({
+                "name": name,
+                "is_dir": False,
+                "rel": rel_path,
+                "file_id": file_info.id,
+                "owner": file_info.owner_name,
+                "can_read": file_info.can_read,
+                "can_write": file_info.can_write,
+                "can_delete": file_info.can_delete,
+                "is_owner": file_info.is_owner,
+                "size": size,
+                "mtime": datetime.fromtimestamp(mtime)
+            })
     
     up = str(Path(rel).parent) if rel else ""
     return render_template("files/index.html", 
                          rel=rel, 
                          items=items, 
                          up=up, 
-                         is_admin=is_admin(current_user))
+                         is_admin=is_admin(current_user),
+                         sort=sort, order=order,
+                         page=page, pages=pages, total=len(visible))
 
 @files_bp.route("/my-files")
 @login_required
 def my_files():
-    """View all files accessible to the current user (own + shared)"""
-    accessible_files = get_user_accessible_files(
+    """View the files accessible to the current user (own + shared), one page at a time"""
+    sort = request.args.get("sort", "newest")
+    if sort not in FILE_SORTS:
+        sort = "newest"
+    owner = request.args.get("owner", "").strip()
+    path = request.args.get("path", "").strip()
+    cursor = request.args.get("after") or None
+    
+    accessible_files, next_cursor = get_accessible_files_page(
         int(current_user.id), 
-        is_admin(current_user)
+        is_admin(current_user),
+        sort, owner, path, cursor
     )
     
     return render_template("files/my_files.html", 
                          files=accessible_files,
+                         is_admin=is_admin(current_user),
+                         sort=sort, owner=owner, path=path,
+                         paged=cursor is not None,
+                         next_cursor=next_cursor)
+
+@files_bp.route("/my-files.ndjson")
+@login_required
+def my_files_export():
+    """Stream every accessible file as newline-delimited JSON.
+    
+    Takes the same sort/owner/path filters as my_files. Rows come from a
+    server-side cursor and are written as they arrive, so memory stays flat
+    however many files match.
+    """
+    sort = request.args.get("sort", "newest")
+    if sort not in FILE_SORTS:
+        sort = "newest"
+    is_admin_user = is_admin(current_user)
+    query = _file_listing_query(int(current_user.id), is_admin_user, sort,
+                                request.args.get("owner", "").strip(),
+                                request.args.get("path", "").strip())
+    
+    def generate():
+        for row in iter_rows(*query, stream=True):
+            yield json.dumps(_file_from_row(row, is_admin_user).as_dict(), separators=(",", ":")) + "\n"
+    
+    return Response(generate(), mimetype="application/x-ndjson")
+
+def search_files(user_id, is_admin_user, query, path="", page=1):
+    """Accessible files whose names contain query, ranked, one page at a time.
+    
+    Candidates come from the trigram index and the same ACL query as
+    my_files; at most SEARCH_MAX_CANDIDATES are ranked.
+    Returns (files, total, truncated).
+    """
+    where, params = candidates_clause(query)
+    clauses, extra = _file_filters(path=path)
+    where = " AND ".join([where] + clauses)
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute(*_accessible_files_query(user_id, is_admin_user, where, params + extra,
+                                             order="f.id", limit=SEARCH_MAX_CANDIDATES + 1))
+        rows = cur.fetchall()
+    except Exception as e:
+        print(f"Error searching files: {e}")
+        return [], 0, False
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+    truncated = len(rows) > SEARCH_MAX_CANDIDATES
+    # Trigrams can all match without the query being a substring; rank() drops those
+    ranked = sorted((key, row) for key, row in ((rank(row[1], query), row) for row in rows[:SEARCH_MAX_CANDIDATES])
+                    if key is not None)
+    start = (page - 1) * SEARCH_PAGE_SIZE
+    files = [_file_from_row(row, is_admin_user) for _, row in ranked[start:start + SEARCH_PAGE_SIZE]]
+    return files, len(ranked), truncated
+
+def _search_args():
+    query = request.args.get("q", "").strip()
+    path = request.args.get("path", "").strip()
+    page = max(1, request.args.get("page", 1, type=int))
+    return query, path, page
+
+@files_bp.route("/search")
+@login_required
+def search():
+    """Find accessible files by name"""
+    query, path, page = _search_args()
+    files, total, truncated = [], 0, False
+    if len(query) >= SEARCH_MIN_QUERY:
+        files, total, truncated = search_files(int(current_user.id), is_admin(current_user),
+                                               query, path, page)
+    elif query:
+        flash(f"Enter at least {SEARCH_MIN_QUERY} characters to search.", "info")
+    
+    return render_template("files/search.html",
+                         files=files,
+                         q=query, path=path,
+                         page=page, pages=max(1, -(-total // SEARCH_PAGE_SIZE)),
+                         total=total, truncated=truncated,
                          is_admin=is_admin(current_user))
 
+@files_bp.route("/search.json")
+@login_required
+def search_json():
+    """Search results as JSON, for the file manager's search box"""
+    query, path, page = _search_args()
+    if len(query) < SEARCH_MIN_QUERY:
+        return jsonify({'error': f"Enter at least {SEARCH_MIN_QUERY} characters"}), 400
+    files, total, truncated = search_files(int(current_user.id), is_admin(current_user),
+                                           query, path, page)
+    return jsonify({'files': [file_info.as_dict() for file_info in files],
+                    'total': total, 'page': page, 'truncated': truncated})
+
+@files_bp.route("/search/reindex", methods=["POST"])
+@login_required
+def search_reindex():
+    """Rebuild the search index in the background (admin only)"""
+    if not is_admin(current_user):
+        return jsonify({'error': "Admin only"}), 403
+    job_id, created = jobs.submit("search_reindex", dedupe_key="all", user_id=int(current_user.id))
+    return jsonify({'job_id': job_id, 'created': created}), 202 if created else 200
+
+jobs.register("search_reindex", lambda job: reindex_all(progress=job))
+
+@files_bp.route("/usage")
+@login_required
+def usage():
+    """Storage used by every user, from the usage counters (admin only)"""
+    if not is_admin(current_user):
+        return jsonify({'error': "Admin only"}), 403
+    report = usage_report()
+    for row in report:
+        if isinstance(row['reconciled_at'], datetime):
+            row['reconciled_at'] = row['reconciled_at'].isoformat()
+    return jsonify({'users': report,
+                    'bytes_used': sum(row['bytes_used'] for row in report),
+                    'file_count': sum(row['file_count'] for row in report)})
+
+@files_bp.route("/usage/<int:user_id>/quota", methods=["POST"])
+@login_required
+def usage_quota(user_id):
+    """Set a user's quota in bytes; 0 is unlimited and empty restores the default (admin only)"""
+    if not is_admin(current_user):
+        return jsonify({'error': "Admin only"}), 403
+    data = request.get_json(silent=True) or request.form
+    value = data.get("quota_bytes")
+    try:
+        quota_bytes = None if value in (None, "") else int(value)
+    except (TypeError, ValueError):
+        quota_bytes = -1
+    if quota_bytes is not None and quota_bytes < 0:
+        return jsonify({'error': "quota_bytes must be a whole number of bytes"}), 400
+    try:
+        set_quota(user_id, quota_bytes)
+    except Exception as e:
+        return jsonify({'error': f"Database error: {e}"}), 500
+    return jsonify({'user_id': user_id, 'quota_bytes': quota_bytes})
+
+@files_bp.route("/usage/reconcile", methods=["POST"])
+@login_required
+def usage_reconcile():
+    """Recount every user's usage from disk in the background (admin only)"""
+    if not is_admin(current_user):
+        return jsonify({'error': "Admin only"}), 403
+    job_id, created = jobs.submit("usage_reconcile", dedupe_key="all", user_id=int(current_user.id))
+    return jsonify({'job_id': job_id, 'created': created}), 202 if created else 200
+
+jobs.register("usage_reconcile", lambda job: reconcile_usage(progress=job))
+
+@files_bp.route("/blobs/reconcile", methods=["POST"])
+@login_required
+def blobs_reconcile():
+    """Re-link duplicate files and fix blob reference counts in the background (admin only)"""
+    if not is_admin(current_user):
+        return jsonify({'error': "Admin only"}), 403
+    job_id, created = jobs.submit("blob_reconcile", dedupe_key="all", user_id=int(current_user.id))
+    return jsonify({'job_id': job_id, 'created': created}), 202 if created else 200
+
+jobs.register("blob_reconcile", lambda job: blobstore.reconcile_blobs(progress=job), exclusive="data_root")
+
+def _refund(user_id, size):
+    """Give back the quota charged for an upload that was not recorded"""
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        release(cur, [(user_id, size)])
+        conn.commit()
+    except Exception as e:
+        print(f"Error refunding upload quota: {e}")
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+
 @files_bp.route("/upload", methods=["POST"])
 @perm_required("can_write")
 def upload():
@@ -240,21 +597,60 @@ def upload():
         flash(f"File '{filename}' already exists. Please rename or delete the existing file first.", "danger")
         return redirect(url_for("files.index", p=rel))
     
-    f.save(dest)
+    # Size of the request's spooled copy, so the quota is checked before DATA_ROOT is touched
+    f.stream.seek(0, os.SEEK_END)
+    size = f.stream.tell()
+    f.stream.seek(0)
     
-    # Record in database
+    # Charged up front in a transaction of its own, so the usage row isn't
+    # locked while the file is copied; refunded below if the upload fails
     rel_path = str((Path(rel)/filename) if rel else Path(filename))
+    tmp = None
+    charged = False
+    written = False
     try:
         conn = get_db()
         cur = conn.cursor()
+        if not charge(cur, int(current_user.id), size):
+            conn.rollback()
+            used, quota = quota_status(cur, int(current_user.id))
+            flash(f"Uploading '{filename}' ({format_size(size)}) would exceed your storage quota "
+                  f"({format_size(used)} of {format_size(quota)} used).", "danger")
+            return redirect(url_for("files.index", p=rel))
+        conn.commit()
+        charged = True
+        # Staged privately, then linked into place; identical content is stored once
+        UPLOAD_TMP.mkdir(parents=True, exist_ok=True)
+        tmp = UPLOAD_TMP / f"{uuid.uuid4().hex}.upload"
+        with timed("fs", "write"):
+            f.save(tmp)
+            sha256 = blobstore.store(cur, tmp, dest, size)
+        written = True
+        count_bytes("upload", size)
         cur.execute("""
-            INSERT INTO files (path, owner_id) VALUES (%s, %s)
-        """, (rel_path, current_user.id))
+            INSERT INTO files (path, parent_dir, owner_id, size, sha256) VALUES (%s, %s, %s, %s, %s)
+        """, (rel_path, dir_key(rel), current_user.id, size, sha256))
+        index_file(cur, cur.lastrowid, rel_path)
         conn.commit()
+        acl_cache.invalidate_path(rel_path)
         flash(f"Uploaded '{filename}' successfully.", "success")
     except Exception as e:
-        flash(f"File uploaded but database error: {e}", "danger")
+        try:
+            conn.rollback()
+        except:
+            pass
+        if written:
+            dest.unlink(missing_ok=True)
+        if charged:
+            _refund(int(current_user.id), size)
+        if isinstance(e, FileExistsError):
+            flash(f"File '{filename}' already exists. Please rename or delete the existing file first.", "danger")
+        else:
+            flash(f"Upload failed: {e}", "danger")
     finally:
+        if tmp is not None:
+            tmp.unlink(missing_ok=True)
+        dir_cache.invalidate(dest.parent)
         try:
             cur.close()
             conn.close()
@@ -263,6 +659,445 @@ def upload():
     
     return redirect(url_for("files.index", p=rel))
 
+# ---------------------------------------------------------------------------
+# Chunked, resumable uploads
+#
+#   POST   /upload/init                  {rel, filename, size}  -> {upload_id}
+#   PUT    /upload/<id>?offset=N         raw chunk bytes (X-Chunk-SHA256 optional)
+#   GET    /upload/<id>                  received byte spans, for resuming
+#   POST   /upload/<id>/finalize         {sha256 optional} -> atomic rename + INSERT
+#   DELETE /upload/<id>                  abort
+#
+# Chunks are written with pwrite straight into DATA_ROOT/.uploads/<id>.part,
+# so they may arrive in any order and in parallel. Received spans live in the
+# upload_sessions table, shared by every worker process.
+# ---------------------------------------------------------------------------
+
+UPLOAD_TMP = DATA_ROOT / ".uploads"
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(8 * 1024 * 1024)))
+UPLOAD_BLOCK_SIZE = 1024 * 1024
+UPLOAD_SESSION_TTL = float(os.getenv("UPLOAD_SESSION_TTL", str(24 * 3600)))  # idle seconds before an upload is discarded
+UPLOAD_SWEEP_INTERVAL = 3600
+
+# Running SHA-256 of the contiguous prefix received by this process, so an
+# in-order upload never has to be re-read at finalize: upload_id -> (offset, hasher)
+_upload_hashers = {}
+_upload_hashers_lock = threading.Lock()
+
+def _upload_part(upload_id):
+    """Temp file for an upload session (validates the id to prevent traversal)"""
+    if not re.fullmatch(r"[0-9a-f]{32}", upload_id):
+        raise ValueError("Invalid upload id")
+    return UPLOAD_TMP / f"{upload_id}.part"
+
+def _seal_part(upload_id, part):
+    """Move a complete upload out of reach of chunk writers; returns its new path.
+    
+    The exclusive lock waits for chunk writes already in flight, which hold a
+    shared one; writers that lock later find the .part gone and give up. What
+    finalize hashes and links is then exactly what stays on disk.
+    """
+    sealed = UPLOAD_TMP / f"{upload_id}.sealed"
+    with open(part, "rb") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        os.rename(part, sealed)
+    return sealed
+
+_last_upload_sweep = 0.0
+
+def expire_uploads():
+    """Discard uploads with no chunk for UPLOAD_SESSION_TTL: the row, its .part file and running hash.
+    
+    Staging files with no session row (a crash mid-upload, or an interrupted
+    form upload) are removed once they are as old.
+    """
+    cutoff = datetime.now() - timedelta(seconds=UPLOAD_SESSION_TTL)
+    expired = 0
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM upload_sessions WHERE updated_at < %s", (cutoff,))
+        for (upload_id,) in cur.fetchall():
+            # Re-checked in the DELETE, in case a chunk arrived since
+            cur.execute("DELETE FROM upload_sessions WHERE id = %s AND updated_at < %s", (upload_id, cutoff))
+            conn.commit()
+            if cur.rowcount:
+                _upload_part(upload_id).unlink(missing_ok=True)
+                (UPLOAD_TMP / f"{upload_id}.sealed").unlink(missing_ok=True)
+                with _upload_hashers_lock:
+                    _upload_hashers.pop(upload_id, None)
+                expired += 1
+        
+        try:
+            names = os.listdir(UPLOAD_TMP)
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            path = UPLOAD_TMP / name
+            try:
+                if path.stat().st_mtime >= cutoff.timestamp():
+                    continue
+            except FileNotFoundError:
+                continue
+            upload_id = name.split(".")[0]
+            cur.execute("SELECT 1 FROM upload_sessions WHERE id = %s", (upload_id,))
+            if cur.fetchone() is None:
+                path.unlink(missing_ok=True)
+                expired += 1
+        conn.commit()
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+    return expired
+
+def _maybe_expire_uploads():
+    """Sweep abandoned uploads if this process has not done so recently"""
+    global _last_upload_sweep
+    if time.monotonic() - _last_upload_sweep < UPLOAD_SWEEP_INTERVAL:
+        return
+    _last_upload_sweep = time.monotonic()
+    try:
+        expire_uploads()
+    except Exception as e:
+        print(f"Error expiring uploads: {e}")
+
+def _merge_span(spans, start, stop):
+    """Add [start, stop) to a sorted list of disjoint spans"""
+    merged = []
+    for s, e in sorted(spans + [[start, stop]]):
+        if merged and s <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], e)
+        else:
+            merged.append([s, e])
+    return merged
+
+def _get_upload_session(cur, upload_id, for_update=False):
+    cur.execute("""
+        SELECT owner_id, rel_dir, filename, size, received
+        FROM upload_sessions WHERE id = %s
+    """ + (" FOR UPDATE" if for_update else ""), (upload_id,))
+    row = cur.fetchone()
+    if not row or row[0] != int(current_user.id):
+        return None
+    return {
+        'rel_dir': row[1],
+        'filename': row[2],
+        'size': row[3],
+        'received': json.loads(row[4])
+    }
+
+def _upload_complete(session):
+    return session['size'] == 0 or session['received'] == [[0, session['size']]]
+
+def _upload_sha256(upload_id, part, size):
+    """SHA-256 of the assembled file, reusing the in-order running hash if any"""
+    with _upload_hashers_lock:
+        offset, hasher = _upload_hashers.pop(upload_id, (0, None))
+    if hasher is None:
+        offset, hasher = 0, hashlib.sha256()
+    if offset < size:
+        with open(part, "rb") as f:
+            f.seek(offset)
+            for block in iter(lambda: f.read(UPLOAD_BLOCK_SIZE), b""):
+                hasher.update(block)
+    return hasher.hexdigest()
+
+@files_bp.route("/upload/init", methods=["POST"])
+@perm_required("can_write")
+def upload_init():
+    """Start a chunked upload session"""
+    data = request.get_json(silent=True) or request.form
+    rel = data.get("rel", "")
+    filename = secure_filename(data.get("filename", ""))
+    try:
+        size = int(data.get("size", -1))
+    except (TypeError, ValueError):
+        size = -1
+    if not filename or size < 0:
+        return jsonify({'error': "filename and size are required"}), 400
+    
+    dest = safe_join(rel) / filename
+    if dest.exists():
+        return jsonify({'error': f"File '{filename}' already exists."}), 409
+    _maybe_expire_uploads()
+    
+    # Refuse early; the quota is charged at finalize
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        used, quota = quota_status(cur, int(current_user.id))
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+    if not fits(used, quota, size):
+        return jsonify({'error': "Upload would exceed your storage quota.",
+                        'bytes_used': used, 'quota_bytes': quota}), 413
+    
+    upload_id = uuid.uuid4().hex
+    part = _upload_part(upload_id)
+    UPLOAD_TMP.mkdir(parents=True, exist_ok=True)
+    fd = os.open(part, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o640)
+    try:
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+    
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO upload_sessions (id, owner_id, rel_dir, filename, size, received)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        """, (upload_id, current_user.id, dir_key(rel), filename, size, "[]"))
+        conn.commit()
+    except Exception as e:
+        part.unlink()
+        return jsonify({'error': f"Database error: {e}"}), 500
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+    
+    with _upload_hashers_lock:
+        _upload_hashers[upload_id] = (0, hashlib.sha256())
+    
+    return jsonify({
+        'upload_id': upload_id,
+        'size': size,
+        'chunk_size': UPLOAD_CHUNK_SIZE,
+        'received': []
+    }), 201
+
+@files_bp.route("/upload/<upload_id>", methods=["GET"])
+@perm_required("can_write")
+def upload_status(upload_id):
+    """Report which byte spans of an upload have been received"""
+    try:
+        _upload_part(upload_id)
+        conn = get_db()
+        cur = conn.cursor()
+        session = _get_upload_session(cur, upload_id)
+        if not session:
+            return jsonify({'error': "Upload not found."}), 404
+        return jsonify({
+            'upload_id': upload_id,
+            'size': session['size'],
+            'received': session['received'],
+            'complete': _upload_complete(session)
+        })
+    except ValueError:
+        return jsonify({'error': "Upload not found."}), 404
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+
+@files_bp.route("/upload/<upload_id>", methods=["PUT"])
+@perm_required("can_write")
+def upload_chunk(upload_id):
+    """Write one chunk at ?offset= directly into the upload's temp file"""
+    offset = request.args.get("offset", type=int)
+    length = request.content_length
+    expected_digest = request.headers.get("X-Chunk-SHA256", "").lower()
+    if offset is None or offset < 0 or length is None:
+        return jsonify({'error': "offset and Content-Length are required"}), 400
+    
+    try:
+        part = _upload_part(upload_id)
+        conn = get_db()
+        cur = conn.cursor()
+        session = _get_upload_session(cur, upload_id)
+        conn.commit()
+        if not session:
+            return jsonify({'error': "Upload not found."}), 404
+        if offset + length > session['size']:
+            return jsonify({'error': "Chunk extends past the declared size."}), 416
+        
+        # Continue this process's running hash if the chunk is the next in order;
+        # any other chunk (a resend, or out of order) drops it and finalize re-reads the file
+        with _upload_hashers_lock:
+            state = _upload_hashers.pop(upload_id, None)
+            running = state[1] if state and state[0] == offset else None
+        chunk_hasher = hashlib.sha256() if expected_digest else None
+        
+        written = 0
+        try:
+            fd = os.open(part, os.O_WRONLY)
+        except FileNotFoundError:
+            return jsonify({'error': "Upload is being finalized."}), 409
+        try:
+            # Shared with other chunks; finalize takes it exclusively before sealing the file
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            if not os.path.exists(part) or not os.path.samestat(os.fstat(fd), os.stat(part)):
+                return jsonify({'error': "Upload is being finalized."}), 409
+            while written < length:
+                block = request.stream.read(min(UPLOAD_BLOCK_SIZE, length - written))
+                if not block:
+                    break
+                os.pwrite(fd, block, offset + written)
+                written += len(block)
+                if running is not None:
+                    running.update(block)
+                if chunk_hasher is not None:
+                    chunk_hasher.update(block)
+        finally:
+            os.close(fd)
+            count_bytes("upload", written)
+        
+        if written != length:
+            return jsonify({'error': "Chunk truncated; resend it."}), 400
+        if chunk_hasher is not None and chunk_hasher.hexdigest() != expected_digest:
+            return jsonify({'error': "Chunk checksum mismatch; resend it."}), 400
+        if running is not None:
+            with _upload_hashers_lock:
+                _upload_hashers[upload_id] = (offset + length, running)
+        
+        # Record the span; FOR UPDATE serializes parallel chunks of one upload
+        session = _get_upload_session(cur, upload_id, for_update=True)
+        if not session:
+            conn.rollback()
+            return jsonify({'error': "Upload not found."}), 404
+        if length:
+            session['received'] = _merge_span(session['received'], offset, offset + length)
+        cur.execute("UPDATE upload_sessions SET received = %s, updated_at = %s WHERE id = %s",
+                   (json.dumps(session['received']), datetime.now(), upload_id))
+        conn.commit()
+        
+        return jsonify({
+            'upload_id': upload_id,
+            'received': session['received'],
+            'complete': _upload_complete(session)
+        })
+    except ValueError:
+        return jsonify({'error': "Upload not found."}), 404
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+
+@files_bp.route("/upload/<upload_id>/finalize", methods=["POST"])
+@perm_required("can_write")
+def upload_finalize(upload_id):
+    """Atomically move a complete upload into place and record it"""
+    data = request.get_json(silent=True) or request.form
+    expected_sha256 = (data.get("sha256") or "").lower()
+    sealed = None
+    charged = False
+    try:
+        part = _upload_part(upload_id)
+        conn = get_db()
+        cur = conn.cursor()
+        session = _get_upload_session(cur, upload_id, for_update=True)
+        if not session:
+            conn.rollback()
+            return jsonify({'error': "Upload not found."}), 404
+        if not _upload_complete(session):
+            conn.rollback()
+            return jsonify({'error': "Upload is incomplete.", 'received': session['received']}), 409
+        
+        try:
+            sealed = _seal_part(upload_id, part)
+        except FileNotFoundError:
+            conn.rollback()
+            return jsonify({'error': "Upload is already being finalized."}), 409
+        sha256 = _upload_sha256(upload_id, sealed, session['size'])
+        if expected_sha256 and sha256 != expected_sha256:
+            conn.rollback()
+            return jsonify({'error': "Checksum mismatch.", 'sha256': sha256}), 400
+        
+        rel = session['rel_dir']
+        filename = session['filename']
+        dest = safe_join(rel) / filename
+        rel_path = str((Path(rel)/filename) if rel else Path(filename))
+        
+        if not charge(cur, int(current_user.id), session['size']):
+            conn.rollback()
+            used, quota = quota_status(cur, int(current_user.id))
+            return jsonify({'error': "Upload would exceed your storage quota.",
+                            'bytes_used': used, 'quota_bytes': quota}), 413
+        # Committed before the file is hashed and linked, so neither the usage
+        # row nor the session is locked meanwhile; the sealed file keeps chunk
+        # writes and a second finalize out
+        conn.commit()
+        charged = True
+        
+        # Linked into place, never overwriting; shares storage with identical content
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            stored_sha256 = blobstore.store(cur, sealed, dest, session['size'])
+        except FileExistsError:
+            conn.rollback()
+            _refund(int(current_user.id), session['size'])
+            return jsonify({'error': f"File '{filename}' already exists."}), 409
+        dir_cache.invalidate(dest.parent)
+        
+        cur.execute("""
+            INSERT INTO files (path, parent_dir, owner_id, size, sha256) VALUES (%s, %s, %s, %s, %s)
+        """, (rel_path, dir_key(rel), current_user.id, session['size'], stored_sha256))
+        index_file(cur, cur.lastrowid, rel_path)
+        cur.execute("DELETE FROM upload_sessions WHERE id = %s", (upload_id,))
+        conn.commit()
+        acl_cache.invalidate_path(rel_path)
+        
+        return jsonify({'path': rel_path, 'size': session['size'], 'sha256': sha256})
+    except ValueError:
+        return jsonify({'error': "Upload not found."}), 404
+    except Exception as e:
+        if charged:
+            try:
+                conn.rollback()
+            except:
+                pass
+            _refund(int(current_user.id), session['size'])
+        return jsonify({'error': f"Finalize failed: {e}"}), 500
+    finally:
+        # Not consumed: hand the file back so the upload can be resumed or finalized again
+        if sealed is not None and sealed.exists():
+            os.replace(sealed, part)
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+
+@files_bp.route("/upload/<upload_id>", methods=["DELETE"])
+@perm_required("can_write")
+def upload_abort(upload_id):
+    """Abort a chunked upload and discard its temp file"""
+    try:
+        part = _upload_part(upload_id)
+        conn = get_db()
+        cur = conn.cursor()
+        if not _get_upload_session(cur, upload_id):
+            return jsonify({'error': "Upload not found."}), 404
+        cur.execute("DELETE FROM upload_sessions WHERE id = %s", (upload_id,))
+        conn.commit()
+        if part.exists():
+            part.unlink()
+        with _upload_hashers_lock:
+            _upload_hashers.pop(upload_id, None)
+        return jsonify({'upload_id': upload_id, 'aborted': True})
+    except ValueError:
+        return jsonify({'error': "Upload not found."}), 404
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+
 @files_bp.route("/download")
 @login_required
 def download():
@@ -270,23 +1105,68 @@ def download():
     rel = request.args.get("rel","")
     filepath = safe_join(rel)
     
+    # Check existence, ownership and shared permissions in one round trip
+    auth = authorize_file(rel, int(current_user.id), is_admin(current_user))
+    if not auth:
+        if filepath.is_file():
+            flash("File not found in database.", "danger")
+        else:
+            flash("File not found.", "danger")
+        return redirect(url_for("files.index"))
+    
+    if not auth['can_read']:
+        flash("You don't have permission to download this file.", "danger")
+        return redirect(url_for("files.index"))
+    
     if not filepath.is_file():
         flash("File not found.", "danger")
         return redirect(url_for("files.index"))
     
-    # Check permissions
-    metadata = get_file_metadata(rel)
-    if metadata:
-        if not is_admin(current_user):
-            perms = get_file_permissions(metadata['id'], int(current_user.id))
-            if not perms['can_read']:
-                flash("You don't have permission to download this file.", "danger")
-                return redirect(url_for("files.index"))
-    else:
-        flash("File not found in database.", "danger")
+    return send_file_ranged(filepath, as_attachment=True)
+
+def iter_readable_files(user_id, is_admin_user, targets):
+    """(path, archive name) of every readable file under the targets, streamed from the DB.
+    
+    Archive names are relative to each target's parent folder, so a folder
+    keeps its own name at the top of the archive. Meant for a streamed
+    response, so the rows are read on a pooled connection of their own.
+    """
+    where, params = _subtree_clause(targets)
+    query = _accessible_files_query(user_id, is_admin_user, where, params, order="f.path")
+    for row in iter_rows(*query, stream=True):
+        file_info = _file_from_row(row, is_admin_user)
+        if not file_info.can_read:
+            continue
+        path = file_info.path
+        target = path
+        while target and target not in targets:
+            target = dir_key(str(Path(target).parent))
+        parent = dir_key(str(Path(target).parent))
+        yield path, path[len(parent) + 1:] if parent else path
+
+@files_bp.route("/download-zip", methods=["GET", "POST"])
+@login_required
+def download_zip():
+    """Download a folder, or several selected files and folders, as one ZIP.
+    
+    Takes one or more `paths` (relative to DATA_ROOT). The archive is built
+    while it is sent and only holds files the user can read.
+    """
+    targets = _batch_targets(request.values.getlist("paths"))
+    if not targets:
+        flash("Nothing selected to download.", "danger")
+        return redirect(url_for("files.index"))
+    try:
+        for target in targets:
+            safe_join(target)
+    except ValueError:
+        flash("Invalid path.", "danger")
         return redirect(url_for("files.index"))
     
-    return send_file(filepath, as_attachment=True)
+    user_id, is_admin_user = int(current_user.id), is_admin(current_user)
+    files = ((name, safe_join(path)) for path, name in iter_readable_files(user_id, is_admin_user, targets))
+    download_name = (Path(targets[0]).name if len(targets) == 1 else "download") + ".zip"
+    return send_stream(stream_zip(files), download_name, mimetype="application/zip")
 
 @files_bp.route("/mkdir", methods=["POST"])
 @perm_required("can_write")
@@ -298,115 +1178,156 @@ def mkdir():
         flash("Folder name required.", "danger")
         return redirect(url_for("files.index", p=rel))
     (safe_join(rel) / name).mkdir(parents=True, exist_ok=True)
+    dir_cache.invalidate(safe_join(rel))
     flash(f"Folder '{name}' created.", "success")
     return redirect(url_for("files.index", p=rel))
 
+def move_rows(cur, old_rel, new_rel):
+    """Point the files rows for old_rel (a file, or a folder and everything under it) at new_rel.
+    
+    A folder is rewritten with one set-based UPDATE over the path-prefix index,
+    however many files it holds; the search index only covers file names, so
+    only a renamed file needs re-indexing. The caller commits.
+    """
+    cur.execute("""
+        UPDATE files SET path = %s, parent_dir = %s WHERE path = %s
+    """, (new_rel, dir_key(str(Path(new_rel).parent)), old_rel))
+    if cur.rowcount and Path(new_rel).name != Path(old_rel).name:
+        cur.execute("SELECT id FROM files WHERE path = %s", (new_rel,))
+        for (file_id,) in cur.fetchall():
+            index_file(cur, file_id, new_rel)
+    # Both columns keep their suffix after the old prefix; a direct child's
+    # parent_dir equals old_rel, whose suffix is ''
+    tail = len(old_rel) + 1
+    cur.execute("""
+        UPDATE files
+        SET path = CONCAT(%s, SUBSTRING(path, %s)),
+            parent_dir = CONCAT(%s, SUBSTRING(parent_dir, %s))
+        WHERE path LIKE %s
+    """, (new_rel, tail, new_rel, tail, _like_prefix(old_rel + "/")))
+    moved = cur.rowcount
+    cur.execute("""
+        UPDATE upload_sessions
+        SET rel_dir = CONCAT(%s, SUBSTRING(rel_dir, %s))
+        WHERE rel_dir = %s OR rel_dir LIKE %s
+    """, (new_rel, tail, old_rel, _like_prefix(old_rel + "/")))
+    return moved
+
+def _foreign_files_under(cur, rel_dir, user_id):
+    """Number of recorded files below a folder that the user does not own"""
+    cur.execute("""
+        SELECT COUNT(*) FROM files WHERE path LIKE %s AND owner_id != %s
+    """, (_like_prefix(rel_dir + "/"), user_id))
+    return cur.fetchone()[0]
+
 @files_bp.route("/rename", methods=["POST"])
 @perm_required("can_edit")
 def rename():
-    """Rename a file or folder (requires ownership)"""
+    """Rename or move a file or folder (requires ownership).
+    
+    Optional form field `dest` moves the item into another folder; `new`
+    defaults to the current name when moving.
+    """
     rel = request.form.get("rel","")
     old = request.form.get("old","")
-    new = secure_filename(request.form.get("new",""))
+    dest = request.form.get("dest", rel).strip("/")
+    new = secure_filename(request.form.get("new","") or (old if dest != rel else ""))
     
     if not new:
         flash("New name is required.", "danger")
         return redirect(url_for("files.index", p=rel))
     
     old_path = safe_join(rel) / old
-    new_path = safe_join(rel) / new
+    new_path = safe_join(dest) / new
+    old_rel = str((Path(rel)/old) if rel else Path(old))
+    new_rel = str((Path(dest)/new) if dest else Path(new))
+    
+    if _reserved(old_rel) or _reserved(new_rel):
+        flash("This folder cannot be changed.", "danger")
+        return redirect(url_for("files.index", p=rel))
     
     if not old_path.exists():
         flash(f"'{old}' does not exist.", "danger")
         return redirect(url_for("files.index", p=rel))
     
+    if not new_path.parent.is_dir():
+        flash(f"Folder '{dest}' does not exist.", "danger")
+        return redirect(url_for("files.index", p=rel))
+    
     if new_path.exists():
         flash(f"'{new}' already exists.", "danger")
         return redirect(url_for("files.index", p=rel))
     
+    is_dir = old_path.is_dir()
+    if is_dir and old_path in new_path.parents:
+        flash("A folder cannot be moved into itself.", "danger")
+        return redirect(url_for("files.index", p=rel))
+    
+    user_id = int(current_user.id)
+    
     # Check permissions for files
-    if old_path.is_file():
-        old_rel = str((Path(rel)/old) if rel else Path(old))
-        metadata = get_file_metadata(old_rel)
-        if metadata and not is_admin(current_user):
-            if metadata['owner_id'] != int(current_user.id):
-                flash("You can only rename your own files.", "danger")
-                return redirect(url_for("files.index", p=rel))
-    
-    old_path.rename(new_path)
-    
-    # Update database if it's a file
-    if new_path.is_file():
+    if not is_dir:
+        auth = authorize_file(old_rel, user_id, is_admin(current_user))
+        if auth and not auth['is_owner'] and not is_admin(current_user):
+            flash("You can only rename your own files.", "danger")
+            return redirect(url_for("files.index", p=rel))
+    
+    # Rows are rewritten first and committed only once the filesystem rename
+    # has succeeded, so the table and the disk never disagree
+    renamed = False
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        if is_dir and not is_admin(current_user) and _foreign_files_under(cur, old_rel, user_id):
+            conn.rollback()
+            flash("You can only move folders that contain only your own files.", "danger")
+            return redirect(url_for("files.index", p=rel))
+        move_rows(cur, old_rel, new_rel)
+        old_path.rename(new_path)
+        renamed = True
+        conn.commit()
+    except Exception as e:
         try:
-            conn = get_db()
-            cur = conn.cursor()
-            old_rel = str((Path(rel)/old) if rel else Path(old))
-            new_rel = str((Path(rel)/new) if rel else Path(new))
-            cur.execute("UPDATE files SET path = %s WHERE path = %s", (new_rel, old_rel))
-            conn.commit()
-        except Exception as e:
-            print(f"Error updating file path: {e}")
-        finally:
-            try:
-                cur.close()
-                conn.close()
-            except:
-                pass
+            conn.rollback()
+        except:
+            pass
+        if renamed:
+            new_path.rename(old_path)
+        flash(f"Rename failed: {e}", "danger")
+        return redirect(url_for("files.index", p=rel))
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+        if is_dir:
+            acl_cache.invalidate_tree(old_rel)
+            dir_cache.invalidate_tree(old_path)
+        acl_cache.invalidate_path(old_rel)
+        acl_cache.invalidate_path(new_rel)
+        dir_cache.invalidate(old_path.parent)
+        dir_cache.invalidate(new_path.parent)
     
-    flash(f"Renamed '{old}' to '{new}'.", "success")
+    if dest != rel:
+        flash(f"Moved '{old}' to '{new_rel}'.", "success")
+    else:
+        flash(f"Renamed '{old}' to '{new}'.", "success")
     return redirect(url_for("files.index", p=rel))
 
 @files_bp.route("/delete", methods=["POST"])
 @perm_required("can_edit")
 def delete():
-    """Delete a file or folder (requires ownership or admin)"""
+    """Delete a file or folder with everything in it (requires ownership or admin)"""
     rel = request.form.get("rel","")
     target = request.form.get("target","")
-    p = safe_join(rel) / target
+    target_rel = str((Path(rel)/target) if rel else Path(target))
     
-    if not p.exists():
-        flash(f"'{target}' does not exist.", "danger")
-        return redirect(url_for("files.index", p=rel))
-    
-    # Check permissions for files
-    if p.is_file():
-        target_rel = str((Path(rel)/target) if rel else Path(target))
-        metadata = get_file_metadata(target_rel)
-        if metadata:
-            if not is_admin(current_user):
-                perms = get_file_permissions(metadata['id'], int(current_user.id))
-                if not perms['can_delete']:
-                    flash("You don't have permission to delete this file.", "danger")
-                    return redirect(url_for("files.index", p=rel))
-            
-            # Delete from database (this will cascade to file_permissions)
-            try:
-                conn = get_db()
-                cur = conn.cursor()
-                cur.execute("DELETE FROM files WHERE id = %s", (metadata['id'],))
-                conn.commit()
-            except Exception as e:
-                flash(f"Database error: {e}", "danger")
-                return redirect(url_for("files.index", p=rel))
-            finally:
-                try:
-                    cur.close()
-                    conn.close()
-                except:
-                    pass
-    
-    # Delete from filesystem
-    if p.is_dir():
-        try:
-            p.rmdir()
-        except OSError:
-            flash("Folder not empty. Please delete all contents first.", "danger")
-            return redirect(url_for("files.index", p=rel))
+    result = batch_delete([target_rel], int(current_user.id), is_admin(current_user))[0]
+    if result['ok']:
+        flash(f"Deleted '{target}'.", "info")
     else:
-        if p.exists():
-            p.unlink()
-    
-    flash(f"Deleted '{target}'.", "info")
+        flash(result['error'], "danger")
     return redirect(url_for("files.index", p=rel))
 
 @files_bp.route("/share/<int:file_id>", methods=["GET", "POST"])
@@ -449,6 +1370,7 @@ def share(file_id):
                 ON DUPLICATE KEY UPDATE can_read = %s, can_write = %s
             """, (file_id, user_id, can_read, can_write, can_read, can_write))
             conn.commit()
+            acl_cache.invalidate_user(row[1], int(user_id))
             
             flash("Permissions updated successfully.", "success")
             return redirect(url_for("files.share", file_id=file_id))
@@ -495,7 +1417,7 @@ def revoke_permission(file_id, user_id):
         cur = conn.cursor()
         
         # Check ownership
-        cur.execute("SELECT owner_id FROM files WHERE id = %s", (file_id,))
+        cur.execute("SELECT owner_id, path FROM files WHERE id = %s", (file_id,))
         row = cur.fetchone()
         if not row or (row[0] != int(current_user.id) and not is_admin(current_user)):
             flash("Permission denied.", "danger")
@@ -504,6 +1426,7 @@ def revoke_permission(file_id, user_id):
         cur.execute("DELETE FROM file_permissions WHERE file_id = %s AND user_id = %s", 
                    (file_id, user_id))
         conn.commit()
+        acl_cache.invalidate_user(row[1], user_id)
         flash("Permission revoked successfully.", "info")
     except Exception as e:
         flash(f"Error: {e}", "danger")
@@ -515,3 +1438,298 @@ def revoke_permission(file_id, user_id):
             pass
     
     return redirect(url_for("files.share", file_id=file_id))
+
+# ---------------------------------------------------------------------------
+# Batch operations
+#
+#   POST /batch   {action: delete|move|share, paths: [...], dest, user_id,
+#                  can_read, can_write}  -> per-path results
+#
+# Each path may be a file or a whole folder. Permissions for every target are
+# resolved with one query and the database changes are applied in one
+# transaction. Deleted items are first renamed into DATA_ROOT/.trash, which is
+# instant and keeps disk and table in step; the actual removal runs on a
+# worker pool after the response.
+# ---------------------------------------------------------------------------
+
+TRASH_DIR = DATA_ROOT / ".trash"
+
+def _reserved(rel):
+    """True for DATA_ROOT itself and for anything in the folders the app keeps there.
+    
+    Those hold upload staging, pending deletes, restore snapshots and shared
+    file contents; their sweeps delete what they find, so nothing may be moved
+    in or out of them through the file routes.
+    """
+    parts = Path(os.path.normpath("/" + rel)).parts[1:]
+    return not parts or parts[0] in (UPLOAD_TMP.name, TRASH_DIR.name,
+                                     SNAPSHOT_DIR.name, blobstore.BLOB_ROOT.name)
+
+_trash_pool = ThreadPoolExecutor(max_workers=max(1, BATCH_WORKERS), thread_name_prefix="trash")
+_purging = set()
+_purging_lock = threading.Lock()
+
+def _purge(path):
+    try:
+        if path.is_dir() and not path.is_symlink():
+            shutil.rmtree(path)
+        else:
+            path.unlink()
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"Error removing {path}: {e}")
+    finally:
+        with _purging_lock:
+            _purging.discard(path.name)
+
+def empty_trash():
+    """Queue removal of everything in the trash, including leftovers from a restart"""
+    try:
+        names = os.listdir(TRASH_DIR)
+    except FileNotFoundError:
+        return
+    with _purging_lock:
+        names = [n for n in names if n not in _purging]
+        _purging.update(names)
+    for name in names:
+        _trash_pool.submit(_purge, TRASH_DIR / name)
+
+def _batch_targets(paths):
+    """Normalized, de-duplicated targets; paths inside another target are covered by it"""
+    targets = sorted({dir_key(p.strip("/")) for p in paths if p and p.strip("/")})
+    kept = []
+    for t in targets:
+        if not kept or not t.startswith(kept[-1] + "/"):
+            kept.append(t)
+    return kept
+
+def _subtree_clause(targets, column="f.path"):
+    """WHERE clause matching each target path and everything below it"""
+    sql = f"{column} IN ({', '.join(['%s'] * len(targets))})"
+    sql += "".join(f" OR {column} LIKE %s" for _ in targets)
+    return "(" + sql + ")", tuple(targets) + tuple(_like_prefix(t + "/") for t in targets)
+
+def _resolve_batch(cur, targets):
+    """Recorded files under every target in one query: target -> [(id, path, owner_id, size, sha256)]"""
+    where, params = _subtree_clause(targets)
+    cur.execute(f"SELECT f.id, f.path, f.owner_id, f.size, f.sha256 FROM files f WHERE {where}", params)
+    found = {t: [] for t in targets}
+    for row in cur.fetchall():
+        # The target is the path itself or its nearest listed ancestor
+        key = row[1]
+        while key and key not in found:
+            key = dir_key(str(Path(key).parent))
+        if key in found:
+            found[key].append(row)
+    return found
+
+def _result(path, error=None, files=0, **extra):
+    return dict({'path': path, 'ok': error is None, 'error': error, 'files': files}, **extra)
+
+def _authorize_batch(cur, paths, user_id, is_admin_user):
+    """Split targets into (allowed {target: rows}, per-path failures)"""
+    targets = _batch_targets(paths)
+    failures = []
+    if not targets:
+        return {}, failures
+    allowed = {}
+    for target, rows in _resolve_batch(cur, targets).items():
+        full = safe_join(target)
+        if not full.exists() and not full.is_symlink():
+            failures.append(_result(target, f"'{target}' does not exist."))
+        elif _reserved(target):
+            failures.append(_result(target, "This folder cannot be changed."))
+        elif not is_admin_user and any(row[2] != user_id for row in rows):
+            failures.append(_result(target, f"You don't own everything in '{target}'."))
+        else:
+            allowed[target] = rows
+    return allowed, failures
+
+def batch_delete(paths, user_id, is_admin_user):
+    """Delete files and folders (recursively); returns one result per target"""
+    results = []
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        allowed, results = _authorize_batch(cur, paths, user_id, is_admin_user)
+        
+        # Move each target out of the tree; undone if the transaction fails
+        TRASH_DIR.mkdir(parents=True, exist_ok=True)
+        trashed = []
+        for target, rows in allowed.items():
+            try:
+                trash = TRASH_DIR / uuid.uuid4().hex
+                os.rename(safe_join(target), trash)
+                trashed.append((target, trash, len(rows)))
+            except OSError as e:
+                results.append(_result(target, f"Could not delete '{target}': {e.strerror}"))
+        
+        if trashed:
+            # file_permissions rows go with them (ON DELETE CASCADE)
+            where, params = _subtree_clause([t for t, _, _ in trashed], column="path")
+            try:
+                cur.execute(f"DELETE FROM files WHERE {where}", params)
+                release(cur, [(row[2], row[3]) for t, _, _ in trashed for row in allowed[t]])
+                blobstore.release(cur, [row[4] for t, _, _ in trashed for row in allowed[t]])
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                for target, trash, _ in trashed:
+                    os.rename(trash, safe_join(target))
+                return results + [_result(t, f"Database error: {e}") for t, _, _ in trashed]
+        results += [_result(t, files=n) for t, _, n in trashed]
+    except Exception as e:
+        print(f"Error in batch delete: {e}")
+        return results + [_result(p, f"Error: {e}") for p in _batch_targets(paths)
+                          if not any(r['path'] == p for r in results)]
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+    
+    for result in results:
+        if result['ok']:
+            acl_cache.invalidate_tree(result['path'])
+            dir_cache.invalidate_tree(safe_join(result['path']))
+            dir_cache.invalidate(safe_join(result['path']).parent)
+    empty_trash()
+    return sorted(results, key=lambda r: r['path'])
+
+def batch_move(paths, dest, user_id, is_admin_user):
+    """Move files and folders into dest; returns one result per target"""
+    dest = dir_key(dest.strip("/"))
+    if dest and _reserved(dest):
+        return [_result(p, "This folder cannot be changed.") for p in _batch_targets(paths)]
+    if not safe_join(dest).is_dir():
+        return [_result(p, f"Folder '{dest}' does not exist.") for p in _batch_targets(paths)]
+    results = []
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        allowed, results = _authorize_batch(cur, paths, user_id, is_admin_user)
+        
+        moved = []
+        try:
+            for target, rows in allowed.items():
+                name = Path(target).name
+                new_rel = str(Path(dest)/name) if dest else name
+                old_path, new_path = safe_join(target), safe_join(dest) / name
+                if new_rel == target:
+                    results.append(_result(target, files=len(rows), dest=new_rel))
+                    continue
+                if dest == target or dest.startswith(target + "/"):
+                    results.append(_result(target, "A folder cannot be moved into itself."))
+                    continue
+                if new_path.exists() or new_path.is_symlink():
+                    results.append(_result(target, f"'{new_rel}' already exists."))
+                    continue
+                try:
+                    os.rename(old_path, new_path)
+                except OSError as e:
+                    results.append(_result(target, f"Could not move '{target}': {e.strerror}"))
+                    continue
+                moved.append((target, new_rel, len(rows)))
+                move_rows(cur, target, new_rel)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            for target, new_rel, _ in reversed(moved):
+                os.rename(safe_join(new_rel), safe_join(target))
+            return results + [_result(t, f"Database error: {e}") for t, _, _ in moved]
+        results += [_result(t, files=n, dest=new_rel) for t, new_rel, n in moved]
+    except Exception as e:
+        print(f"Error in batch move: {e}")
+        return results + [_result(p, f"Error: {e}") for p in _batch_targets(paths)
+                          if not any(r['path'] == p for r in results)]
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+    
+    for target, new_rel, _ in moved:
+        acl_cache.invalidate_tree(target)
+        acl_cache.invalidate_tree(new_rel)
+        dir_cache.invalidate_tree(safe_join(target))
+        dir_cache.invalidate(safe_join(target).parent)
+    dir_cache.invalidate(safe_join(dest))
+    return sorted(results, key=lambda r: r['path'])
+
+def batch_share(paths, share_user_id, can_read, can_write, user_id, is_admin_user):
+    """Grant a user access to every recorded file under the targets; one result per target"""
+    if share_user_id == user_id:
+        return [_result(p, "You cannot share a file with yourself.") for p in _batch_targets(paths)]
+    results = []
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        allowed, results = _authorize_batch(cur, paths, user_id, is_admin_user)
+        grants = [(row[0], share_user_id, can_read, can_write, can_read, can_write)
+                  for rows in allowed.values() for row in rows]
+        try:
+            if grants:
+                cur.executemany("""
+                    INSERT INTO file_permissions (file_id, user_id, can_read, can_write)
+                    VALUES (%s, %s, %s, %s)
+                    ON DUPLICATE KEY UPDATE can_read = %s, can_write = %s
+                """, grants)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            return results + [_result(t, f"Database error: {e}") for t in allowed]
+        results += [_result(t, files=len(rows)) for t, rows in allowed.items()]
+    except Exception as e:
+        print(f"Error in batch share: {e}")
+        return results + [_result(p, f"Error: {e}") for p in _batch_targets(paths)
+                          if not any(r['path'] == p for r in results)]
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+    
+    for target in allowed:
+        acl_cache.invalidate_tree(target)
+    return sorted(results, key=lambda r: r['path'])
+
+@files_bp.route("/batch", methods=["POST"])
+@perm_required("can_edit")
+def batch():
+    """Delete, move or share many files and folders in one request"""
+    data = request.get_json(silent=True) or {}
+    action = data.get("action")
+    paths = data.get("paths") or []
+    if not isinstance(paths, list) or not all(isinstance(p, str) for p in paths):
+        return jsonify({'error': "paths must be a list of strings"}), 400
+    if len(paths) > BATCH_MAX_ITEMS:
+        return jsonify({'error': f"At most {BATCH_MAX_ITEMS} paths per request"}), 400
+    
+    user_id = int(current_user.id)
+    is_admin_user = is_admin(current_user)
+    try:
+        if action == "delete":
+            results = batch_delete(paths, user_id, is_admin_user)
+        elif action == "move":
+            results = batch_move(paths, data.get("dest", ""), user_id, is_admin_user)
+        elif action == "share":
+            share_user_id = int(data.get("user_id", 0))
+            if not share_user_id:
+                return jsonify({'error': "user_id is required"}), 400
+            results = batch_share(paths, share_user_id, bool(data.get("can_read", True)),
+                                  bool(data.get("can_write", False)), user_id, is_admin_user)
+        else:
+            return jsonify({'error': "action must be delete, move or share"}), 400
+    except ValueError:
+        return jsonify({'error': "Invalid path"}), 400
+    
+    return jsonify({
+        'action': action,
+        'succeeded': sum(1 for r in results if r['ok']),
+        'failed': sum(1 for r in results if not r['ok']),
+        'results': results
+    })
@@ -0,0 +1,317 @@
+import os, json, time, socket, threading
+from datetime import datetime, timedelta
+from nas.db_pool import get_db
+from nas.metrics import record_job
+
+JOB_PROGRESS_INTERVAL = float(os.getenv("JOB_PROGRESS_INTERVAL", "2"))
+JOB_STALE_AFTER = float(os.getenv("JOB_STALE_AFTER", "300"))
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+class JobCancelled(Exception):
+    """Raised inside a job once cancellation has been requested"""
+
+class Job:
+    """Handle given to a running job for progress reporting and cancellation.
+
+    Progress is kept in memory and written to the jobs row at most every
+    JOB_PROGRESS_INTERVAL seconds; each write also refreshes the heartbeat and
+    picks up a cancellation requested from another process.
+    """
+
+    def __init__(self, job_id, kind):
+        self.id = job_id
+        self.kind = kind
+        self.bytes_done = self.files_done = 0
+        self.bytes_total = self.files_total = 0
+        self.message = None
+        self.cancelled = threading.Event()
+        self.followups = []
+        self._flushed_at = 0.0
+
+    def set_total(self, bytes_total, files_total):
+        self.bytes_total = bytes_total
+        self.files_total = files_total
+        self.flush()
+
+    def set_message(self, message):
+        self.message = message
+        self.flush()
+
+    def advance(self, nbytes=0, files=0):
+        """Record work done; raises JobCancelled if the job has been cancelled"""
+        self.bytes_done += nbytes
+        self.files_done += files
+        if time.monotonic() - self._flushed_at >= JOB_PROGRESS_INTERVAL:
+            self.flush()
+        self.check()
+
+    def then(self, kind, params=None, dedupe_key=None):
+        """Submit another job once this one has finished and released its active_key"""
+        self.followups.append((kind, params, dedupe_key))
+
+    def check(self):
+        if self.cancelled.is_set():
+            raise JobCancelled(f"Job {self.id} was cancelled")
+
+    def flush(self):
+        self._flushed_at = time.monotonic()
+        try:
+            conn = get_db()
+            cur = conn.cursor()
+            cur.execute("""
+                UPDATE jobs
+                SET bytes_done = %s, bytes_total = %s, files_done = %s, files_total = %s,
+                    message = %s, heartbeat_at = %s
+                WHERE id = %s
+            """, (self.bytes_done, self.bytes_total, self.files_done, self.files_total,
+                  self.message, datetime.now(), self.id))
+            cur.execute("SELECT cancel_requested FROM jobs WHERE id = %s", (self.id,))
+            row = cur.fetchone()
+            conn.commit()
+            if row and row[0]:
+                self.cancelled.set()
+        except Exception as e:
+            print(f"Error saving job progress: {e}")
+        finally:
+            try:
+                cur.close()
+                conn.close()
+            except:
+                pass
+
+_handlers = {}  # kind -> (function, BoundedSemaphore)
+_exclusive = {}  # kind -> name of the resource it holds exclusively, used as its active_key
+_running = {}   # job id -> Job, for jobs started by this process
+_heartbeat_lock = threading.Lock()
+_heartbeat_thread = None
+
+def _heartbeat():
+    """Keep this process's jobs from looking stale, even mid-way through one large file"""
+    while True:
+        time.sleep(JOB_STALE_AFTER / 5)
+        ids = list(_running)
+        if not ids:
+            continue
+        try:
+            conn = get_db()
+            cur = conn.cursor()
+            cur.execute("UPDATE jobs SET heartbeat_at = %s WHERE id IN (%s)" % ("%s", ", ".join(["%s"] * len(ids))),
+                        (datetime.now(), *ids))
+            conn.commit()
+        except Exception as e:
+            print(f"Error updating job heartbeat: {e}")
+        finally:
+            try:
+                cur.close()
+                conn.close()
+            except:
+                pass
+
+def _start_heartbeat():
+    global _heartbeat_thread
+    with _heartbeat_lock:
+        if _heartbeat_thread is None:
+            _heartbeat_thread = threading.Thread(target=_heartbeat, name="job-heartbeat", daemon=True)
+            _heartbeat_thread.start()
+
+def register(kind, fn, limit=None, exclusive=None):
+    """Register a job type; at most `limit` of them run at once in this process.
+    
+    Job types registered with the same `exclusive` name share one active_key,
+    so only one of them is queued or running at a time across every worker.
+    """
+    if limit is None:
+        limit = int(os.getenv(f"JOB_LIMIT_{kind.upper()}", "1"))
+    _handlers[kind] = (fn, threading.BoundedSemaphore(max(1, limit)))
+    _exclusive[kind] = exclusive
+
+def _find_active(cur, active_key):
+    cur.execute("SELECT id FROM jobs WHERE active_key = %s", (active_key,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def _reap_stale(cur):
+    """Fail jobs whose worker stopped heartbeating, freeing their de-duplication key"""
+    cutoff = datetime.now() - timedelta(seconds=JOB_STALE_AFTER)
+    cur.execute("""
+        UPDATE jobs
+        SET status = 'failed', message = 'Worker stopped responding', active_key = NULL,
+            finished_at = %s
+        WHERE status IN ('queued', 'running') AND heartbeat_at < %s
+    """, (datetime.now(), cutoff))
+
+def submit(kind, params=None, dedupe_key=None, user_id=None):
+    """Queue a job and start it on a background thread.
+
+    Jobs with the same kind and dedupe_key never run twice at once: while one
+    is queued or running, submitting another returns the existing job. For a
+    kind registered as exclusive, any queued or running job holding the same
+    resource is returned instead, whatever its kind or dedupe_key.
+    Returns (job_id, created).
+    """
+    if kind not in _handlers:
+        raise ValueError(f"Unknown job type '{kind}'")
+    params = params or {}
+    if _exclusive.get(kind):
+        active_key = _exclusive[kind]
+    else:
+        active_key = f"{kind}:{dedupe_key}" if dedupe_key is not None else None
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        _reap_stale(cur)
+        conn.commit()
+        try:
+            cur.execute("""
+                INSERT INTO jobs (kind, params, status, active_key, created_by, worker, heartbeat_at)
+                VALUES (%s, %s, 'queued', %s, %s, %s, %s)
+            """, (kind, json.dumps(params), active_key, user_id, WORKER_ID, datetime.now()))
+            job_id = cur.lastrowid
+            conn.commit()
+        except Exception:
+            # Unique active_key: an identical job is already queued or running
+            conn.rollback()
+            existing = _find_active(cur, active_key) if active_key else None
+            if existing is None:
+                raise
+            return existing, False
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+
+    _start_heartbeat()
+    thread = threading.Thread(target=_run, args=(job_id, kind, params),
+                              name=f"job-{job_id}", daemon=True)
+    thread.start()
+    return job_id, True
+
+def _update(job_id, sql, params):
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute(f"UPDATE jobs SET {sql} WHERE id = %s", params + (job_id,))
+        conn.commit()
+    except Exception as e:
+        print(f"Error updating job {job_id}: {e}")
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+
+def _run(job_id, kind, params):
+    fn, slots = _handlers[kind]
+    job = Job(job_id, kind)
+    _running[job_id] = job
+    status, result = "failed", None
+    started = None
+    try:
+        # Wait for a free slot for this job type, heartbeating while queued
+        while not slots.acquire(timeout=JOB_PROGRESS_INTERVAL):
+            job.flush()
+            job.check()
+        try:
+            job.check()
+            _update(job_id, "status = 'running', started_at = %s", (datetime.now(),))
+            started = time.monotonic()
+            result = fn(job, **params)
+            status = "done"
+        finally:
+            slots.release()
+    except JobCancelled:
+        status, job.message = "cancelled", "Cancelled"
+    except Exception as e:
+        print(f"Error in {kind} job {job_id}: {e}")
+        job.message = str(e)[:255]
+    finally:
+        _running.pop(job_id, None)
+        if started is not None:
+            record_job(kind, job.bytes_done, time.monotonic() - started)
+        _update(job_id, """
+            status = %s, active_key = NULL, result = %s, message = %s, finished_at = %s,
+            bytes_done = %s, bytes_total = %s, files_done = %s, files_total = %s
+        """, (status, None if result is None else str(result)[:255], job.message, datetime.now(),
+              job.bytes_done, job.bytes_total, job.files_done, job.files_total))
+        for next_kind, next_params, next_key in job.followups:
+            try:
+                submit(next_kind, next_params, dedupe_key=next_key)
+            except Exception as e:
+                print(f"Error queueing {next_kind} after job {job_id}: {e}")
+
+def cancel(job_id):
+    """Request cancellation; the job stops at its next progress report"""
+    _update(job_id, "cancel_requested = 1", ())
+    job = _running.get(job_id)
+    if job is not None:
+        job.cancelled.set()
+
+JOB_COLUMNS = """id, kind, status, message, result, bytes_done, bytes_total, files_done,
+                 files_total, created_at, started_at, finished_at, cancel_requested"""
+
+def _as_datetime(value):
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+def _job_from_row(row):
+    (job_id, kind, status, message, result, bytes_done, bytes_total, files_done,
+     files_total, created_at, started_at, finished_at, cancel_requested) = row
+    started_at, finished_at = _as_datetime(started_at), _as_datetime(finished_at)
+    elapsed = ((finished_at or datetime.now()) - started_at).total_seconds() if started_at else 0
+    throughput = bytes_done / elapsed if elapsed > 0 else 0
+    eta = None
+    if status == "running" and throughput and bytes_total > bytes_done:
+        eta = round((bytes_total - bytes_done) / throughput)
+    return {
+        'id': job_id,
+        'kind': kind,
+        'status': status,
+        'message': message,
+        'result': result,
+        'bytes_done': bytes_done,
+        'bytes_total': bytes_total,
+        'files_done': files_done,
+        'files_total': files_total,
+        'percent': round(100 * bytes_done / bytes_total, 1) if bytes_total else None,
+        'elapsed': round(elapsed),
+        'throughput': round(throughput),
+        'eta': eta,
+        'cancel_requested': bool(cancel_requested),
+        'created_at': str(created_at),
+    }
+
+def get_job(job_id):
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute(f"SELECT {JOB_COLUMNS} FROM jobs WHERE id = %s", (job_id,))
+        row = cur.fetchone()
+        return _job_from_row(row) if row else None
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+
+def list_jobs(limit=10):
+    """Most recent jobs first, with derived throughput and ETA"""
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute(f"SELECT {JOB_COLUMNS} FROM jobs ORDER BY id DESC LIMIT %s", (limit,))
+        return [_job_from_row(row) for row in cur.fetchall()]
+    except Exception as e:
+        print(f"Error getting jobs: {e}")
+        return []
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
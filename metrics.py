@@ -0,0 +1,256 @@
+import os, time, threading
+from contextlib import contextmanager
+from flask import request, Response, before_render_template, template_rendered
+from nas.__init__ import files_bp, backup_bp
+
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "0"))  # 0 disables the slow-request log
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)
+
+_lock = threading.Lock()
+_registry = []
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join('%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                     for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+class Counter:
+    """Monotonic total per label set"""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, amount=1, *labels):
+        with _lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in sorted(self._values.items()):
+            yield self.name + _labels(self.labelnames, labels), value
+
+class Gauge(Counter):
+    """Last value set per label set"""
+
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        with _lock:
+            self._values[labels] = value
+
+class Histogram:
+    """Cumulative bucket counts, sum and count per label set"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [bucket counts..., sum, count]
+        _registry.append(self)
+
+    def observe(self, value, *labels):
+        with _lock:
+            v = self._values.get(labels)
+            if v is None:
+                v = self._values[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    v[i] += 1
+            v[-2] += value
+            v[-1] += 1
+
+    def samples(self):
+        names = self.labelnames + ("le",)
+        for labels, v in sorted(self._values.items()):
+            for bound, n in zip(self.buckets, v):
+                yield self.name + "_bucket" + _labels(names, labels + (bound,)), n
+            yield self.name + "_bucket" + _labels(names, labels + ("+Inf",)), v[-1]
+            yield self.name + "_sum" + _labels(self.labelnames, labels), v[-2]
+            yield self.name + "_count" + _labels(self.labelnames, labels), v[-1]
+
+class Collected:
+    """Values read from their owner when /metrics is scraped.
+
+    read returns {label values: value}; use it for state another module
+    already keeps, such as pool or cache counters, instead of copying it.
+    """
+
+    def __init__(self, name, help, kind, read, labelnames=()):
+        self.name, self.help, self.kind, self.labelnames = name, help, kind, tuple(labelnames)
+        self._read = read
+        _registry.append(self)
+
+    def samples(self):
+        for labels, value in sorted(self._read().items()):
+            yield self.name + _labels(self.labelnames, labels), value
+
+REQUEST_SECONDS = Histogram("nas_request_duration_seconds", "Time to produce a response, by route",
+                            ("method", "route"))
+REQUESTS = Counter("nas_requests_total", "Requests by route and status", ("method", "route", "status"))
+REQUEST_QUERIES = Histogram("nas_request_db_queries", "Database queries per request",
+                            ("route",), QUERY_COUNT_BUCKETS)
+PHASE_SECONDS = Counter("nas_request_phase_seconds_total",
+                        "Request time spent in the database, filesystem and templates", ("route", "phase"))
+DB_QUERIES = Counter("nas_db_queries_total", "Database statements executed")
+DB_SECONDS = Counter("nas_db_seconds_total", "Time spent in database calls")
+FS_SECONDS = Counter("nas_fs_seconds_total", "Time spent in filesystem calls", ("op",))
+TRANSFER_BYTES = Counter("nas_transfer_bytes_total", "File bytes sent and received", ("direction",))
+JOB_BYTES = Counter("nas_job_bytes_total", "Bytes processed by background jobs", ("kind",))
+JOB_SECONDS = Counter("nas_job_seconds_total", "Run time of background jobs", ("kind",))
+JOB_THROUGHPUT = Gauge("nas_job_last_throughput_bytes_per_second",
+                       "Throughput of the last finished job of each kind", ("kind",))
+
+# Per-request accumulators; absent outside a request (jobs, streamed bodies)
+_local = threading.local()
+
+def _current():
+    return getattr(_local, "request", None)
+
+def record(phase, seconds, op=None):
+    """Charge time to a phase of the current request and to the global totals"""
+    if phase == "db":
+        DB_SECONDS.inc(seconds)
+    elif phase == "fs":
+        FS_SECONDS.inc(seconds, op or "other")
+    state = _current()
+    if state is not None:
+        state['phases'][phase] = state['phases'].get(phase, 0) + seconds
+
+@contextmanager
+def timed(phase, op=None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phase, time.perf_counter() - start, op)
+
+def count_query():
+    DB_QUERIES.inc()
+    state = _current()
+    if state is not None:
+        state['queries'] += 1
+
+def count_bytes(direction, nbytes):
+    TRANSFER_BYTES.inc(nbytes, direction)
+
+def record_job(kind, nbytes, seconds):
+    JOB_BYTES.inc(nbytes, kind)
+    JOB_SECONDS.inc(seconds, kind)
+    if seconds > 0:
+        JOB_THROUGHPUT.set(nbytes / seconds, kind)
+
+class TimedCursor:
+    """Cursor proxy that counts statements and times database calls"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def _call(self, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            record("db", time.perf_counter() - start)
+
+    def execute(self, *args):
+        count_query()
+        return self._call(self._cursor.execute, *args)
+
+    def executemany(self, *args):
+        count_query()
+        return self._call(self._cursor.executemany, *args)
+
+    def fetchone(self):
+        return self._call(self._cursor.fetchone)
+
+    def fetchmany(self, size=None):
+        return self._call(self._cursor.fetchmany, *(() if size is None else (size,)))
+
+    def fetchall(self):
+        return self._call(self._cursor.fetchall)
+
+def _before_request():
+    _local.request = {'start': time.perf_counter(), 'queries': 0, 'phases': {}}
+
+def _after_request(response):
+    state = _current()
+    if state is not None:
+        state['status'] = response.status_code
+    return response
+
+def _teardown_request(exc=None):
+    state = _current()
+    _local.request = None
+    if state is None:
+        return
+    elapsed = time.perf_counter() - state['start']
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    status = state.get('status', 500)
+    REQUEST_SECONDS.observe(elapsed, request.method, route)
+    REQUESTS.inc(1, request.method, route, status)
+    REQUEST_QUERIES.observe(state['queries'], route)
+    for phase, seconds in state['phases'].items():
+        PHASE_SECONDS.inc(seconds, route, phase)
+    if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+        phases = state['phases']
+        other = elapsed - sum(phases.values())
+        breakdown = ", ".join(f"{p} {s * 1000:.0f} ms" for p, s in sorted(phases.items()))
+        print(f"Slow request: {request.method} {request.full_path.rstrip('?')} -> {status} "
+              f"in {elapsed * 1000:.0f} ms ({state['queries']} queries; {breakdown or 'no phases'}; "
+              f"other {other * 1000:.0f} ms)")
+
+def _before_render(sender, template, context, **extra):
+    state = _current()
+    if state is not None:
+        state['render_start'] = time.perf_counter()
+
+def _rendered(sender, template, context, **extra):
+    state = _current()
+    if state is not None and 'render_start' in state:
+        record("render", time.perf_counter() - state.pop('render_start'))
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    with _lock:
+        for metric in _registry:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, value in metric.samples():
+                lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+def metrics_view():
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return Response("Unauthorized\n", status=401, mimetype="text/plain")
+    return Response(render(), mimetype="text/plain; version=0.0.4")
+
+def _install(state):
+    app = state.app
+    if app.extensions.get("nas_metrics"):
+        return
+    app.extensions["nas_metrics"] = True
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_rendered, app)
+    app.add_url_rule("/metrics", "metrics", metrics_view)
+
+files_bp.record_once(_install)
+backup_bp.record_once(_install)
@@ -0,0 +1,186 @@
+import os
+from pathlib import Path
+from nas.db_pool import get_db, iter_rows
+
+DATA_ROOT = Path(os.getenv("DATA_ROOT","/srv/nas_data")).resolve()
+USER_QUOTA_BYTES = int(os.getenv("USER_QUOTA_BYTES", "0"))  # default per-user quota; 0 = unlimited
+USAGE_RECONCILE_BATCH = int(os.getenv("USAGE_RECONCILE_BATCH", "1000"))
+
+def quota_status(cur, user_id):
+    """(bytes used, quota in bytes) for a user; a quota of 0 means unlimited"""
+    cur.execute("SELECT bytes_used, quota_bytes FROM user_usage WHERE user_id = %s", (user_id,))
+    row = cur.fetchone()
+    if not row:
+        return 0, USER_QUOTA_BYTES
+    return row[0], USER_QUOTA_BYTES if row[1] is None else row[1]
+
+def format_size(nbytes):
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(nbytes) < 1024:
+            return f"{nbytes:.0f} {unit}" if unit == "B" else f"{nbytes:.1f} {unit}"
+        nbytes /= 1024
+    return f"{nbytes:.1f} TB"
+
+def fits(used, quota, nbytes):
+    return quota == 0 or used + nbytes <= quota
+
+def charge(cur, user_id, nbytes, files=1):
+    """Add to a user's usage if it stays within their quota; the caller commits.
+
+    The check and the increment are one UPDATE, so concurrent uploads cannot
+    both squeeze under the limit. Returns False, changing nothing, if the
+    upload would go over.
+    """
+    cur.execute("INSERT IGNORE INTO user_usage (user_id) VALUES (%s)", (user_id,))
+    cur.execute("""
+        UPDATE user_usage
+        SET bytes_used = bytes_used + %s, file_count = file_count + %s
+        WHERE user_id = %s
+          AND (COALESCE(quota_bytes, %s) = 0 OR bytes_used + %s <= COALESCE(quota_bytes, %s))
+    """, (nbytes, files, user_id, USER_QUOTA_BYTES, nbytes, USER_QUOTA_BYTES))
+    return cur.rowcount == 1
+
+def release(cur, files):
+    """Subtract deleted files, given as (owner_id, size) pairs, from their owners; the caller commits"""
+    freed = {}
+    for owner_id, size in files:
+        nbytes, count = freed.get(owner_id, (0, 0))
+        freed[owner_id] = (nbytes + (size or 0), count + 1)
+    if freed:
+        cur.executemany("""
+            UPDATE user_usage
+            SET bytes_used = bytes_used - %s, file_count = file_count - %s
+            WHERE user_id = %s
+        """, [(nbytes, count, owner_id) for owner_id, (nbytes, count) in sorted(freed.items())])
+
+def set_quota(user_id, quota_bytes):
+    """Set a user's quota in bytes (0 = unlimited, None = USER_QUOTA_BYTES)"""
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute("INSERT IGNORE INTO user_usage (user_id) VALUES (%s)", (user_id,))
+        cur.execute("UPDATE user_usage SET quota_bytes = %s WHERE user_id = %s", (quota_bytes, user_id))
+        conn.commit()
+        return cur.rowcount == 1
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+
+def usage_report():
+    """Usage of every user from the counters, largest first; one row per user"""
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT u.id, u.username, COALESCE(uu.bytes_used, 0), COALESCE(uu.file_count, 0),
+                   uu.quota_bytes, uu.reconciled_at
+            FROM users u
+            LEFT JOIN user_usage uu ON uu.user_id = u.id
+            ORDER BY COALESCE(uu.bytes_used, 0) DESC, u.id
+        """)
+        report = []
+        for user_id, username, used, count, quota, reconciled_at in cur.fetchall():
+            quota = USER_QUOTA_BYTES if quota is None else quota
+            report.append({
+                'user_id': user_id,
+                'username': username,
+                'bytes_used': used,
+                'file_count': count,
+                'quota_bytes': quota,
+                'percent_used': round(100 * used / quota, 1) if quota else None,
+                'reconciled_at': reconciled_at
+            })
+        return report
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+
+def _write_sizes(batch):
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.executemany("UPDATE files SET size = %s WHERE id = %s", batch)
+        conn.commit()
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+
+def _recount(user_id):
+    """Recompute one user's counters from files.size.
+
+    The usage row is locked first, so an upload or delete for this user either
+    finishes before the sums are read or waits for them.
+    """
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute("SELECT user_id FROM user_usage WHERE user_id = %s FOR UPDATE", (user_id,))
+        cur.execute("SELECT COALESCE(SUM(size), 0), COUNT(*) FROM files WHERE owner_id = %s", (user_id,))
+        used, count = cur.fetchone()
+        cur.execute("""
+            UPDATE user_usage SET bytes_used = %s, file_count = %s, reconciled_at = CURRENT_TIMESTAMP
+            WHERE user_id = %s
+        """, (used, count, user_id))
+        conn.commit()
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+
+def reconcile_usage(progress=None):
+    """Correct drift: refresh files.size from disk, then recount every user.
+
+    Sizes change outside upload and delete when a backup is restored or files
+    are edited on the server directly. Files missing from disk keep their last
+    known size. Returns a summary string.
+    """
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute("INSERT IGNORE INTO user_usage (user_id) SELECT id FROM users")
+        conn.commit()
+        cur.execute("SELECT COUNT(*) FROM files")
+        total = cur.fetchone()[0]
+        cur.execute("SELECT id FROM users ORDER BY id")
+        users = [row[0] for row in cur.fetchall()]
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+    if progress:
+        progress.set_total(0, total)
+
+    changed, batch = 0, []
+    for file_id, path, size in iter_rows("SELECT id, path, size FROM files ORDER BY id"):
+        try:
+            actual = os.stat(DATA_ROOT / path).st_size
+        except (FileNotFoundError, NotADirectoryError):
+            actual = size
+        if actual != size:
+            batch.append((actual, file_id))
+        if len(batch) >= USAGE_RECONCILE_BATCH:
+            _write_sizes(batch)
+            changed += len(batch)
+            batch = []
+        if progress:
+            progress.advance(files=1)
+    if batch:
+        _write_sizes(batch)
+        changed += len(batch)
+
+    for user_id in users:
+        _recount(user_id)
+    return f"{changed} file sizes corrected, {len(users)} users recounted"
@@ -0,0 +1,102 @@
+import os
+from nas.db_pool import get_db, iter_rows
+
+SEARCH_MIN_QUERY = 3
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "50"))
+SEARCH_MAX_CANDIDATES = int(os.getenv("SEARCH_MAX_CANDIDATES", "5000"))
+SEARCH_REINDEX_BATCH = int(os.getenv("SEARCH_REINDEX_BATCH", "1000"))
+
+def file_name(path):
+    return path.rsplit("/", 1)[-1]
+
+def trigrams(text):
+    """Lower-cased 3-character substrings of text"""
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def index_file(cur, file_id, path):
+    """(Re)write the trigram postings for one file's name; the caller commits.
+
+    Only the file name is indexed, so renaming or moving a folder leaves the
+    postings of everything inside it valid. Rows are removed with the file
+    (ON DELETE CASCADE).
+    """
+    cur.execute("DELETE FROM file_trigrams WHERE file_id = %s", (file_id,))
+    grams = trigrams(file_name(path))
+    if grams:
+        cur.executemany("INSERT INTO file_trigrams (trigram, file_id) VALUES (%s, %s)",
+                        [(g, file_id) for g in grams])
+
+def candidates_clause(query):
+    """WHERE clause selecting files whose names contain every trigram of query"""
+    grams = sorted(trigrams(query))
+    sql = """f.id IN (
+        SELECT file_id FROM file_trigrams
+        WHERE trigram IN (%s)
+        GROUP BY file_id HAVING COUNT(*) = %%s
+    )""" % ", ".join(["%s"] * len(grams))
+    return sql, grams + [len(grams)]
+
+def rank(path, query):
+    """Sort key for a match: exact name, then name prefix, then word start, then anywhere"""
+    name = file_name(path).lower()
+    query = query.lower()
+    pos = name.find(query)
+    if pos < 0:
+        return None
+    if name == query:
+        tier = 0
+    elif pos == 0:
+        tier = 1
+    elif not name[pos - 1].isalnum():
+        tier = 2
+    else:
+        tier = 3
+    return (tier, len(name), path.count("/"), path)
+
+def _write_batch(batch):
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        ids = [file_id for file_id, _ in batch]
+        cur.execute("DELETE FROM file_trigrams WHERE file_id IN (%s)" % ", ".join(["%s"] * len(ids)), ids)
+        cur.executemany("INSERT INTO file_trigrams (trigram, file_id) VALUES (%s, %s)",
+                        [(g, file_id) for file_id, path in batch for g in trigrams(file_name(path))])
+        conn.commit()
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+
+def reindex_all(progress=None):
+    """Rebuild the postings of every file, one batch per transaction; returns files indexed"""
+    if progress:
+        try:
+            conn = get_db()
+            cur = conn.cursor()
+            cur.execute("SELECT COUNT(*) FROM files")
+            progress.set_total(0, cur.fetchone()[0])
+        finally:
+            try:
+                cur.close()
+                conn.close()
+            except:
+                pass
+    count = 0
+    batch = []
+    for file_id, path in iter_rows("SELECT id, path FROM files ORDER BY id"):
+        batch.append((file_id, path))
+        if len(batch) >= SEARCH_REINDEX_BATCH:
+            _write_batch(batch)
+            count += len(batch)
+            if progress:
+                progress.advance(files=len(batch))
+            batch = []
+    if batch:
+        _write_batch(batch)
+        count += len(batch)
+        if progress:
+            progress.advance(files=len(batch))
+    return count
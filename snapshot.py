@@ -0,0 +1,226 @@
+import os, stat, json, errno, fcntl, shutil, tarfile, time
+from pathlib import Path
+from nas.archive import stream_tar
+
+DATA_ROOT = Path(os.getenv("DATA_ROOT","/srv/nas_data"))
+# Inside DATA_ROOT so hardlinks and reflinks never cross a filesystem boundary
+SNAPSHOT_ROOT = DATA_ROOT / ".snapshots"
+# reflink, copy, or (opt-in, see _Cloner) hardlink or auto
+SNAPSHOT_MODE = os.getenv("SNAPSHOT_MODE", "reflink")
+
+FICLONE = 0x40049409  # _IOW(0x94, 9, int) from linux/fs.h
+
+# Errors meaning "this filesystem can't do that", as opposed to a problem with one file
+_UNSUPPORTED = {errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV, errno.ENOSYS, errno.EPERM}
+
+_FALLBACKS = {
+    'auto': ["reflink", "hardlink", "copy"],
+    'reflink': ["reflink", "copy"],
+    'hardlink': ["hardlink", "copy"],
+    'copy': ["copy"],
+}
+
+def _reflink(src, dst):
+    """Copy-on-write clone of src (btrfs, XFS, bcachefs); no data is copied"""
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    shutil.copystat(src, dst)
+
+class _Cloner:
+    """Clones files by reflink, hardlink or plain copy, falling back in that order.
+
+    Hardlinks are only used in the hardlink and auto modes. They share the
+    inode with DATA_ROOT, so the snapshot is only as safe as every writer:
+    this app replaces files (temp file + rename), but anything that writes
+    into a file in place, such as an editor, rsync --inplace or a shell on
+    the server, changes the snapshot copy too, without any error.
+    """
+
+    def __init__(self, mode=None):
+        self.methods = list(_FALLBACKS.get(mode or SNAPSHOT_MODE, _FALLBACKS['auto']))
+        self.counts = {}
+        self.copied_bytes = 0
+
+    def clone(self, src, dst, size):
+        while True:
+            method = self.methods[0]
+            try:
+                if method == "reflink":
+                    _reflink(src, dst)
+                elif method == "hardlink":
+                    os.link(src, dst)
+                else:
+                    shutil.copy2(src, dst)
+                    self.copied_bytes += size
+                break
+            except OSError as e:
+                if method == "reflink":
+                    Path(dst).unlink(missing_ok=True)
+                if method == "hardlink" and e.errno == errno.EMLINK:
+                    shutil.copy2(src, dst)  # link count limit on this one file
+                    self.copied_bytes += size
+                    method = "copy"
+                    break
+                if method == "copy" or e.errno not in _UNSUPPORTED:
+                    raise
+                self.methods.pop(0)
+        self.counts[method] = self.counts.get(method, 0) + 1
+        return method
+
+def snapshot_path(name):
+    return SNAPSHOT_ROOT / name
+
+def header_path(name):
+    return SNAPSHOT_ROOT / f"{name}.json"
+
+def snapshot_exists(name):
+    return snapshot_path(name).is_dir() and header_path(name).is_file()
+
+def snapshot_header(name):
+    """Totals recorded when the snapshot was taken"""
+    with open(header_path(name), encoding="utf-8") as f:
+        return json.load(f)
+
+def _walk(root, skip_dirs=()):
+    """Yield (rel_dir, dirnames, filenames) under root, skipping skip_dirs at the top"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel_root = os.path.relpath(dirpath, root)
+        rel_root = "" if rel_root == "." else rel_root
+        if not rel_root:
+            dirnames[:] = [d for d in dirnames if d not in skip_dirs]
+        dirnames.sort()
+        yield rel_root, dirnames, sorted(filenames)
+
+def create_snapshot(name, data_root, skip_dirs=(), progress=None):
+    """Capture data_root as a tree of clones under SNAPSHOT_ROOT.
+
+    With reflinks (or hardlinks, if enabled) this takes seconds rather than the
+    time to read every file, and only costs disk space once files change. The tree is built under a temporary name and
+    renamed into place when complete. Returns the snapshot header.
+    """
+    started = time.monotonic()
+    SNAPSHOT_ROOT.mkdir(mode=0o700, parents=True, exist_ok=True)
+    root = snapshot_path(name)
+    tmp = root.with_name(root.name + ".partial")
+    shutil.rmtree(tmp, ignore_errors=True)
+    cloner = _Cloner()
+    file_count = logical_bytes = 0
+    try:
+        for rel_root, _, filenames in _walk(data_root, skip_dirs):
+            target = tmp / rel_root
+            target.mkdir(parents=True, exist_ok=True)
+            for fname in filenames:
+                src = os.path.join(data_root, rel_root, fname)
+                try:
+                    st = os.lstat(src)
+                    if not stat.S_ISREG(st.st_mode):
+                        continue
+                    cloner.clone(src, target / fname, st.st_size)
+                except FileNotFoundError:
+                    continue  # removed while the snapshot was being taken
+                file_count += 1
+                logical_bytes += st.st_size
+                if progress:
+                    progress.advance(st.st_size, 1)
+        header = {
+            'name': name,
+            'created': time.strftime("%Y%m%d_%H%M%S"),
+            'file_count': file_count,
+            'logical_bytes': logical_bytes,
+            'stored_bytes': cloner.copied_bytes,
+            'methods': cloner.counts,
+            'duration_ms': int((time.monotonic() - started) * 1000),
+        }
+        os.replace(tmp, root)
+        with open(header_path(name), "w", encoding="utf-8") as f:
+            json.dump(header, f)
+        return header
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+def restore_snapshot(name, data_root, skip_dirs=(), progress=None):
+    """Roll data_root back to a snapshot, in place.
+
+    Files that still share the snapshot's inode, or match its size and mtime,
+    are left alone; others are cloned back from the snapshot to a temp name and
+    renamed over the current file. Files that are not in the snapshot are
+    removed. Returns {'restored', 'skipped', 'deleted'}.
+    """
+    root = snapshot_path(name)
+    data_root = Path(data_root)
+    stats = {'restored': 0, 'skipped': 0, 'deleted': 0}
+    if progress:
+        header = snapshot_header(name)
+        progress.set_total(header['logical_bytes'], header['file_count'])
+    cloner = _Cloner()
+    kept = set()
+    for rel_root, _, filenames in _walk(root):
+        (data_root / rel_root).mkdir(parents=True, exist_ok=True)
+        for fname in filenames:
+            rel = os.path.join(rel_root, fname)
+            kept.add(rel)
+            src = root / rel
+            dest = data_root / rel
+            st = os.lstat(src)
+            try:
+                cur = os.lstat(dest)
+                if (cur.st_ino, cur.st_dev) == (st.st_ino, st.st_dev) or \
+                        (cur.st_size, cur.st_mtime_ns) == (st.st_size, st.st_mtime_ns):
+                    stats['skipped'] += 1
+                    if progress:
+                        progress.advance(st.st_size, 1)
+                    continue
+            except FileNotFoundError:
+                pass
+            tmp = dest.with_name(f".{dest.name}.{os.getpid()}.restore")
+            try:
+                cloner.clone(src, tmp, st.st_size)
+                os.replace(tmp, dest)
+            except BaseException:
+                tmp.unlink(missing_ok=True)
+                raise
+            stats['restored'] += 1
+            if progress:
+                progress.advance(st.st_size, 1)
+
+    for rel_root, _, filenames in _walk(data_root, skip_dirs):
+        for fname in filenames:
+            rel = os.path.join(rel_root, fname)
+            if rel not in kept and (data_root / rel).is_file():
+                (data_root / rel).unlink()
+                stats['deleted'] += 1
+    return stats
+
+def stream_snapshot_tar(name, arcroot="nas_data"):
+    """Generate an uncompressed tar of a snapshot tree"""
+    root = snapshot_path(name)
+    def members():
+        for rel_root, dirnames, filenames in _walk(root):
+            for d in dirnames:
+                info = tarfile.TarInfo(f"{arcroot}/{os.path.join(rel_root, d)}")
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                yield info, None
+            for fname in filenames:
+                full = root / rel_root / fname
+                st = os.lstat(full)
+                info = tarfile.TarInfo(f"{arcroot}/{os.path.join(rel_root, fname)}")
+                info.size = st.st_size
+                info.mtime = int(st.st_mtime)
+                info.mode = stat.S_IMODE(st.st_mode)
+                with open(full, "rb") as f:
+                    yield info, f
+    return stream_tar(members())
+
+def delete_snapshot(name):
+    """Remove a snapshot tree; returns the bytes it alone was holding"""
+    freed = 0
+    for rel_root, _, filenames in _walk(snapshot_path(name)):
+        for fname in filenames:
+            st = os.lstat(snapshot_path(name) / rel_root / fname)
+            if st.st_nlink == 1:
+                freed += st.st_size
+    shutil.rmtree(snapshot_path(name), ignore_errors=True)
+    header_path(name).unlink(missing_ok=True)
+    return freed
@@ -0,0 +1,196 @@
+import os, time, mimetypes, unicodedata, uuid
+from datetime import datetime, timezone
+from urllib.parse import quote
+from flask import request, current_app
+from nas.metrics import record, count_bytes
+
+BLOCK_SIZE = int(os.getenv("TRANSFER_BLOCK_SIZE", str(1024 * 1024)))
+MAX_RANGES = int(os.getenv("TRANSFER_MAX_RANGES", "64"))
+
+def file_etag(st):
+    """Strong ETag derived from inode, mtime and size"""
+    return f"{st.st_ino:x}-{st.st_mtime_ns:x}-{st.st_size:x}"
+
+def _last_modified(st):
+    return datetime.fromtimestamp(int(st.st_mtime), tz=timezone.utc)
+
+def _not_modified(etag, last_modified):
+    """True if the client's cached copy is still current (RFC 7232)"""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    ims = request.if_modified_since
+    return ims is not None and last_modified <= ims
+
+def _precondition_failed(etag, last_modified):
+    if request.if_match:
+        return not request.if_match.contains(etag)
+    ius = request.if_unmodified_since
+    return ius is not None and last_modified > ius
+
+def _range_applies(etag, last_modified):
+    """Honour Range only when If-Range (if any) still matches this file"""
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return if_range.date == last_modified
+    return True
+
+def resolve_ranges(rng, size):
+    """Turn a parsed Range header into sorted, merged (start, stop) byte spans.
+
+    Returns None to serve the whole file and [] if nothing is satisfiable.
+    """
+    if rng is None or rng.units != "bytes":
+        return None
+    spans = []
+    for start, stop in rng.ranges:
+        if start < 0:
+            start, stop = max(size + start, 0), size
+        else:
+            stop = size if stop is None else min(stop, size)
+        if start < stop:
+            spans.append((start, stop))
+    spans.sort()
+    merged = []
+    for start, stop in spans:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    if len(merged) > MAX_RANGES or merged == [(0, size)]:
+        return None
+    return merged
+
+def _read_span(path, start, stop):
+    """Yield bytes [start, stop) using positional reads"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        offset = start
+        while offset < stop:
+            t = time.perf_counter()
+            chunk = os.pread(fd, min(BLOCK_SIZE, stop - offset), offset)
+            record("fs", time.perf_counter() - t, "read")
+            if not chunk:
+                break
+            offset += len(chunk)
+            yield chunk
+    finally:
+        os.close(fd)
+        count_bytes("download", offset - start)
+
+def _file_body(path, start, stop, size):
+    """Response body for one span.
+
+    A span that runs to end of file is handed to the server's
+    wsgi.file_wrapper (gunicorn/uWSGI serve it with os.sendfile, zero-copy);
+    anything else is streamed with pread.
+    """
+    file_wrapper = request.environ.get("wsgi.file_wrapper")
+    if file_wrapper is not None and stop == size:
+        f = open(path, "rb")
+        f.seek(start)
+        count_bytes("download", stop - start)  # sent by the server, so counted up front
+        return file_wrapper(f, BLOCK_SIZE)
+    return _read_span(path, start, stop)
+
+def _multipart_body(path, spans, size, mimetype, boundary):
+    parts = []
+    for start, stop in spans:
+        header = (f"\r\n--{boundary}\r\n"
+                  f"Content-Type: {mimetype}\r\n"
+                  f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n").encode("ascii")
+        parts.append((header, start, stop))
+    trailer = f"\r\n--{boundary}--\r\n".encode("ascii")
+    length = sum(len(h) + stop - start for h, start, stop in parts) + len(trailer)
+
+    def generate():
+        for header, start, stop in parts:
+            yield header
+            yield from _read_span(path, start, stop)
+        yield trailer
+
+    return generate(), length
+
+def _content_disposition(rv, download_name):
+    try:
+        download_name.encode("ascii")
+        value = {"filename": download_name}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", download_name)
+        simple = simple.encode("ascii", "ignore").decode("ascii")
+        quoted = quote(download_name, safe="!#$&+^`|~")
+        value = {"filename": simple, "filename*": f"UTF-8''{quoted}"}
+    rv.headers.set("Content-Disposition", "attachment", **value)
+
+def send_file_ranged(path, as_attachment=True, download_name=None):
+    """Serve a file with ETag/Last-Modified validation and Range/If-Range support.
+
+    Handles 304/412 conditional requests, single ranges (206 with
+    Content-Range), multiple ranges (multipart/byteranges) and 416 for
+    unsatisfiable ranges.
+    """
+    path = os.fspath(path)
+    st = os.stat(path)
+    size = st.st_size
+    etag = file_etag(st)
+    last_modified = _last_modified(st)
+    download_name = download_name or os.path.basename(path)
+    mimetype = mimetypes.guess_type(download_name)[0] or "application/octet-stream"
+    response_class = current_app.response_class
+
+    def finish(rv):
+        rv.set_etag(etag)
+        rv.last_modified = last_modified
+        rv.accept_ranges = "bytes"
+        rv.cache_control.private = True
+        rv.cache_control.no_cache = True
+        if as_attachment:
+            _content_disposition(rv, download_name)
+        return rv
+
+    if _precondition_failed(etag, last_modified):
+        return finish(response_class(status=412))
+    if _not_modified(etag, last_modified):
+        return finish(response_class(status=304))
+
+    spans = None
+    if request.range is not None and _range_applies(etag, last_modified):
+        # Malformed Range headers parse to None and are ignored (RFC 7233 §3.1)
+        spans = resolve_ranges(request.range, size)
+
+    if spans == []:
+        rv = response_class(status=416)
+        rv.headers["Content-Range"] = f"bytes */{size}"
+        return finish(rv)
+
+    head = request.method == "HEAD"
+    if spans is None:
+        body = () if head else _file_body(path, 0, size, size)
+        rv = response_class(body, status=200, mimetype=mimetype, direct_passthrough=True)
+        rv.content_length = size
+    elif len(spans) == 1:
+        start, stop = spans[0]
+        body = () if head else _file_body(path, start, stop, size)
+        rv = response_class(body, status=206, mimetype=mimetype, direct_passthrough=True)
+        rv.content_length = stop - start
+        rv.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+    else:
+        boundary = uuid.uuid4().hex
+        body, length = _multipart_body(path, spans, size, mimetype, boundary)
+        rv = response_class(() if head else body, status=206, direct_passthrough=True)
+        rv.headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+        rv.content_length = length
+    return finish(rv)
+
+def send_stream(chunks, download_name, mimetype="application/octet-stream"):
+    """Serve a generated body as an attachment; the length is unknown, so no ranges"""
+    def counted():
+        for chunk in chunks:
+            count_bytes("download", len(chunk))
+            yield chunk
+    rv = current_app.response_class(counted(), mimetype=mimetype, direct_passthrough=True)
+    rv.cache_control.private = True
+    rv.cache_control.no_cache = True
+    _content_disposition(rv, download_name)
+    return rv